@@ -0,0 +1,198 @@
+import asyncio
+import json
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+from fastapi import HTTPException
+
+_REJECT_DETAIL = "Quá nhiều yêu cầu tới dịch vụ AI, vui lòng thử lại sau"
+
+# ============================================================================
+# TOKEN BUCKET
+# ============================================================================
+
+class TokenBucket:
+    """Token bucket cho phép "đặt trước": số dư âm là các request đang chờ tới lượt"""
+
+    def __init__(self, rate_per_sec: float, capacity: float):
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, cost: float, now: float) -> float:
+        """Số giây cần chờ để đủ cost token (chưa trừ)"""
+        self._refill(now)
+        if self.tokens >= cost:
+            return 0.0
+        if self.rate <= 0:
+            return math.inf
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost: float):
+        self.tokens -= cost
+
+# ============================================================================
+# ADMISSION CONTROLLER
+# ============================================================================
+
+class AdmissionController:
+    """Kiểm soát tải đầu vào theo số lời gọi LLM ước tính của mỗi route.
+
+    Mỗi request POST tới route có chi phí > 0 phải lấy đủ token từ cả bucket
+    của client lẫn bucket của route. Thiếu token nhưng chờ được trong max_wait
+    (và hàng chờ chưa đầy) thì request được xếp hàng; còn lại trả 429 ngay.
+    Route chỉ biết chi phí thật sau khi đọc body (batch) trừ thêm qua charge().
+    """
+
+    def __init__(
+        self,
+        route_costs: Dict[str, int],
+        client_rate_per_min: float,
+        client_burst: float,
+        route_rate_per_min: float,
+        route_burst: float,
+        max_wait: float,
+        max_queue: int,
+        max_clients: int = 10000
+    ):
+        self.route_costs = route_costs
+        self.client_rate = client_rate_per_min / 60.0
+        self.client_burst = client_burst
+        self.route_rate = route_rate_per_min / 60.0
+        self.route_burst = route_burst
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.max_clients = max_clients
+        self._clients: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._routes: Dict[str, TokenBucket] = {}
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def cost_for(self, method: str, path: str) -> int:
+        if method != "POST":
+            return 0
+        return self.route_costs.get(path, 0)
+
+    def _client_bucket(self, client_id: str) -> TokenBucket:
+        bucket = self._clients.get(client_id)
+        if bucket is None:
+            bucket = TokenBucket(self.client_rate, self.client_burst)
+            self._clients[client_id] = bucket
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        self._clients.move_to_end(client_id)
+        return bucket
+
+    def _route_bucket(self, path: str) -> TokenBucket:
+        bucket = self._routes.get(path)
+        if bucket is None:
+            bucket = self._routes[path] = TokenBucket(self.route_rate, self.route_burst)
+        return bucket
+
+    def reserve(self, client_id: str, path: str, cost: int, count: bool = True) -> Tuple[bool, float]:
+        """Trả (được nhận, số giây phải chờ hoặc Retry-After nếu bị từ chối)"""
+        now = time.monotonic()
+        buckets = (self._client_bucket(client_id), self._route_bucket(path))
+        # Request lớn hơn cả burst thì không bao giờ đủ token: chỉ cần đủ capacity để được nhận,
+        # nhưng vẫn trừ đủ cost - phần vượt thành số dư âm mà các request sau phải chờ trả
+        wait = max(bucket.wait_for(min(cost, bucket.capacity), now) for bucket in buckets)
+        if wait > 0 and (wait > self.max_wait or self.queued >= self.max_queue):
+            self.rejected += 1
+            return False, wait
+        for bucket in buckets:
+            bucket.take(cost)
+        if count:
+            self.admitted += 1
+        return True, wait
+
+    async def wait_admitted(self, wait: float):
+        if wait <= 0:
+            return
+        self.queued += 1
+        try:
+            await asyncio.sleep(wait)
+        finally:
+            self.queued -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "clients": len(self._clients),
+        }
+
+def _retry_after(wait: float) -> str:
+    return "3600" if math.isinf(wait) else str(max(1, math.ceil(wait)))
+
+async def charge(scope, cost: int):
+    """Trừ thêm cost token cho request đã qua middleware (vd. batch: theo số item).
+
+    Không có admission control (tắt hoặc route miễn phí) thì không làm gì; thiếu token
+    quá max_wait thì 429 như ở middleware.
+    """
+    admission = scope.get("admission")
+    if admission is None or cost <= 0:
+        return
+    controller, client_id = admission
+    admitted, wait = controller.reserve(client_id, scope["path"], cost, count=False)
+    if not admitted:
+        raise HTTPException(status_code=429, detail=_REJECT_DETAIL, headers={"Retry-After": _retry_after(wait)})
+    await controller.wait_admitted(wait)
+
+# ============================================================================
+# ASGI MIDDLEWARE
+# ============================================================================
+
+class AdmissionControlMiddleware:
+    """Middleware ASGI: áp AdmissionController trước khi request vào router"""
+
+    def __init__(self, app, controller: AdmissionController, trust_forwarded: bool = False):
+        self.app = app
+        self.controller = controller
+        self.trust_forwarded = trust_forwarded
+
+    def _client_id(self, scope) -> str:
+        if self.trust_forwarded:
+            for name, value in scope.get("headers", []):
+                if name == b"x-forwarded-for":
+                    return value.decode("latin-1").split(",")[0].strip()
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        cost = self.controller.cost_for(scope["method"], scope["path"])
+        if cost <= 0:
+            return await self.app(scope, receive, send)
+
+        client_id = self._client_id(scope)
+        admitted, wait = self.controller.reserve(client_id, scope["path"], cost)
+        if not admitted:
+            return await self._reject(send, wait)
+        await self.controller.wait_admitted(wait)
+        # Cho route trừ thêm token khi biết chi phí thật (xem charge)
+        scope["admission"] = (self.controller, client_id)
+        await self.app(scope, receive, send)
+
+    async def _reject(self, send, wait: float):
+        body = json.dumps({"detail": _REJECT_DETAIL}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", _retry_after(wait).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
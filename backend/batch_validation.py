@@ -0,0 +1,456 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+import services
+from jobs import OWNER_ID
+from models import BatchItemStatus, BatchStatus, ClaimValidationResult, ValidateClaimRequest
+from config import (
+    BATCH_DB_PATH, BATCH_WORKERS, BATCH_MAX_RPM, BATCH_MAX_RETAINED, BATCH_MAX_PENDING, BATCH_POLL_INTERVAL,
+    JOB_HEARTBEAT_INTERVAL, JOB_OWNER_TIMEOUT
+)
+
+# Số lần thử lại khi gateway báo quá tải (503) trước khi đánh dấu item lỗi
+_MAX_OVERLOAD_RETRIES = 5
+# Số dòng kết quả đọc mỗi lần khi stream NDJSON
+_RESULTS_PAGE = 200
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# ============================================================================
+# BATCH STORE (SQLite)
+# ============================================================================
+
+class BatchStore:
+    """Trạng thái và kết quả batch trong SQLite: mọi worker process tra cứu/stream được.
+
+    Worker nhận batch giữ vai trò chủ (owner + heartbeat như job nền); payload của
+    item chưa xong được lưu kèm để worker khác chạy tiếp nếu chủ batch chết.
+    """
+
+    def __init__(self, db_path: str):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS batches (
+                batch_id TEXT PRIMARY KEY,
+                total INTEGER NOT NULL,
+                owner TEXT,
+                heartbeat_at REAL,
+                created_at REAL NOT NULL,
+                finished_at REAL
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS batch_items (
+                batch_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                request TEXT,
+                result TEXT,
+                error TEXT,
+                seq INTEGER,
+                PRIMARY KEY (batch_id, idx)
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_items_seq ON batch_items (batch_id, seq)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_batches_finished ON batches (finished_at)")
+        self._conn.commit()
+
+    def insert(
+        self,
+        batch_id: str,
+        requests: List[Optional[ValidateClaimRequest]],
+        errors: Dict[int, str],
+        owner: str
+    ):
+        """Tạo batch cùng mọi item trong một transaction; item lỗi đầu vào ghi failed ngay"""
+        now = time.time()
+        items, seq = [], 0
+        for index, request in enumerate(requests):
+            if index in errors:
+                seq += 1
+                items.append((batch_id, index, FAILED, None, errors[index], seq))
+            else:
+                items.append((batch_id, index, PENDING, json.dumps(request.dict(), ensure_ascii=False), None, None))
+        finished = now if seq == len(requests) else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO batches (batch_id, total, owner, heartbeat_at, created_at, finished_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (batch_id, len(requests), owner, now, now, finished)
+            )
+            self._conn.executemany(
+                "INSERT INTO batch_items (batch_id, idx, status, request, error, seq) VALUES (?, ?, ?, ?, ?, ?)",
+                items
+            )
+            self._conn.commit()
+
+    def mark_running(self, batch_id: str, index: int):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE batch_items SET status = ? WHERE batch_id = ? AND idx = ? AND seq IS NULL",
+                (RUNNING, batch_id, index)
+            )
+            self._conn.commit()
+
+    def mark_done(self, batch_id: str, index: int, status: str, result: Optional[str], error: Optional[str]):
+        """Ghi kết quả item (giải phóng payload) và đóng batch khi item cuối xong"""
+        with self._lock:
+            cursor = self._conn.execute(
+                """UPDATE batch_items SET status = ?, result = ?, error = ?, request = NULL,
+                       seq = (SELECT COALESCE(MAX(seq), 0) + 1 FROM batch_items WHERE batch_id = ?)
+                   WHERE batch_id = ? AND idx = ? AND seq IS NULL""",
+                (status, result, error, batch_id, batch_id, index)
+            )
+            if cursor.rowcount:
+                self._conn.execute(
+                    "UPDATE batches SET finished_at = ? WHERE batch_id = ? AND finished_at IS NULL "
+                    "AND NOT EXISTS (SELECT 1 FROM batch_items WHERE batch_id = ? AND seq IS NULL)",
+                    (time.time(), batch_id, batch_id)
+                )
+            self._conn.commit()
+
+    def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+        return dict(row) if row else None
+
+    def items(self, batch_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, status, error FROM batch_items WHERE batch_id = ? ORDER BY idx", (batch_id,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def completed_after(self, batch_id: str, seq: int, limit: int) -> List[Dict[str, Any]]:
+        """Item đã xong theo thứ tự hoàn thành, sau vị trí seq"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, status, result, error, seq FROM batch_items "
+                "WHERE batch_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (batch_id, seq, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def heartbeat(self, owner: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE batches SET heartbeat_at = ? WHERE owner = ? AND finished_at IS NULL",
+                (time.time(), owner)
+            )
+            self._conn.commit()
+
+    def orphans(self, owner: str, stale_before: float) -> List[Dict[str, Any]]:
+        """Batch chưa xong của owner khác đã ngừng heartbeat"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT batch_id, owner, (SELECT COUNT(*) FROM batch_items i "
+                "WHERE i.batch_id = batches.batch_id AND i.seq IS NULL) AS remaining "
+                "FROM batches WHERE finished_at IS NULL "
+                "AND owner IS NOT ? AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (owner, stale_before)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def claim_orphan(
+        self, batch_id: str, old_owner: Optional[str], owner: str, stale_before: float
+    ) -> List[Tuple[int, str]]:
+        """Nhận batch mồ côi (chỉ một worker thắng), trả về các item chưa xong kèm payload"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE batches SET owner = ?, heartbeat_at = ? WHERE batch_id = ? AND owner IS ? "
+                "AND (heartbeat_at IS NULL OR heartbeat_at < ?) AND finished_at IS NULL",
+                (owner, time.time(), batch_id, old_owner, stale_before)
+            )
+            if cursor.rowcount != 1:
+                self._conn.commit()
+                return []
+            # Item đang chạy dở ở worker cũ được chạy lại từ đầu
+            self._conn.execute(
+                "UPDATE batch_items SET status = ? WHERE batch_id = ? AND seq IS NULL", (PENDING, batch_id)
+            )
+            self._conn.commit()
+            rows = self._conn.execute(
+                "SELECT idx, request FROM batch_items WHERE batch_id = ? AND seq IS NULL ORDER BY idx",
+                (batch_id,)
+            ).fetchall()
+        return [(row["idx"], row["request"]) for row in rows]
+
+    def evict_finished(self, max_retained: int):
+        """Chỉ giữ max_retained batch đã xong gần nhất"""
+        with self._lock:
+            stale = [row["batch_id"] for row in self._conn.execute(
+                "SELECT batch_id FROM batches WHERE finished_at IS NOT NULL "
+                "ORDER BY finished_at DESC LIMIT -1 OFFSET ?",
+                (max_retained,)
+            ).fetchall()]
+            if stale:
+                marks = ", ".join("?" * len(stale))
+                self._conn.execute(f"DELETE FROM batch_items WHERE batch_id IN ({marks})", stale)
+                self._conn.execute(f"DELETE FROM batches WHERE batch_id IN ({marks})", stale)
+            self._conn.commit()
+
+# ============================================================================
+# WORKER POOL
+# ============================================================================
+
+class BatchValidationManager:
+    """Pool worker bất đồng bộ có giới hạn, chạy các item của mọi batch.
+
+    Số worker giới hạn độ song song; BATCH_MAX_RPM giãn cách các lời gọi
+    để batch lớn không đốt hết quota model của các request tương tác.
+    Trạng thái/kết quả nằm trong BatchStore nên worker process nào cũng trả lời
+    được /batch/{id} và stream kết quả; item chỉ chạy ở process chủ batch.
+    Tổng số item đang chờ/chạy trong process không vượt max_pending: batch mới
+    nhận 429, batch mồ côi chỉ được nhận khi còn đủ chỗ.
+    """
+
+    def __init__(
+        self,
+        store: BatchStore,
+        workers: int,
+        max_rpm: int,
+        max_retained: int,
+        max_pending: int = BATCH_MAX_PENDING,
+        poll_interval: float = BATCH_POLL_INTERVAL,
+        heartbeat_interval: float = JOB_HEARTBEAT_INTERVAL,
+        owner_timeout: float = JOB_OWNER_TIMEOUT
+    ):
+        self.store = store
+        self.workers = workers
+        self.min_interval = 60.0 / max_rpm if max_rpm > 0 else 0.0
+        self.max_retained = max_retained
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.owner_timeout = owner_timeout
+        self.owner = OWNER_ID
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        # Item đã nhận (đang chờ trong queue hoặc đang chạy) của process này
+        self._pending = 0
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._next_slot = 0.0
+        self._pace_lock: Optional[asyncio.Lock] = None
+        # Đánh thức các stream NDJSON khi có item xong trong process này
+        self._changed: Optional[asyncio.Event] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _db(self, func, *args):
+        return await asyncio.to_thread(func, *args)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            self._pace_lock = asyncio.Lock()
+        # Worker chết thì khởi động lại trên chính queue cũ: item đã xếp hàng không bị bỏ rơi
+        alive = [task for task in self._tasks if not task.done()]
+        for worker_id in range(len(alive), self.workers):
+            alive.append(asyncio.create_task(self._worker(worker_id)))
+        self._tasks = alive
+        self._ensure_heartbeat()
+
+    def check_capacity(self, items: int):
+        """429 nếu nhận thêm items sẽ vượt max_pending"""
+        if self._pending + items > self.max_pending:
+            print(f"[LOG] Batch: đang chờ {self._pending} claim, từ chối batch {items} claim")
+            raise HTTPException(
+                status_code=429,
+                detail=f"Hàng chờ batch đã đầy ({self._pending}/{self.max_pending} claim), vui lòng thử lại sau",
+                headers={"Retry-After": "30"}
+            )
+
+    def _ensure_heartbeat(self):
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def shutdown(self):
+        tasks = list(self._tasks)
+        if self._heartbeat_task is not None:
+            tasks.append(self._heartbeat_task)
+            self._heartbeat_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, requests: List[Optional[ValidateClaimRequest]], errors: Dict[int, str]) -> str:
+        """Tạo batch, trả về batchId; các item có lỗi đầu vào (errors) được đánh dấu failed ngay"""
+        queued = len(requests) - len(errors)
+        self.check_capacity(queued)
+        self._ensure_workers()
+        # Giữ chỗ trước các await để các submit đồng thời không cùng vượt max_pending
+        self._pending += queued
+        batch_id = f"batch-{uuid.uuid4().hex}"
+        try:
+            await self._db(self.store.insert, batch_id, requests, errors, self.owner)
+        except BaseException:
+            self._pending -= queued
+            raise
+        await self._db(self.store.evict_finished, self.max_retained)
+
+        for index, request in enumerate(requests):
+            if index not in errors:
+                self._queue.put_nowait((batch_id, index, request))
+        print(f"[LOG] Batch {batch_id}: nhận {len(requests)} claim ({len(errors)} lỗi đầu vào)")
+        return batch_id
+
+    async def exists(self, batch_id: str) -> bool:
+        return await self._db(self.store.get, batch_id) is not None
+
+    async def status(self, batch_id: str, include_items: bool = True) -> Optional[BatchStatus]:
+        batch = await self._db(self.store.get, batch_id)
+        if batch is None:
+            return None
+        items = await self._db(self.store.items, batch_id)
+        counts = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for item in items:
+            counts[item["status"]] += 1
+        return BatchStatus(
+            batchId=batch_id,
+            total=batch["total"],
+            createdAt=datetime.fromtimestamp(batch["created_at"]).isoformat(),
+            finishedAt=datetime.fromtimestamp(batch["finished_at"]).isoformat() if batch["finished_at"] else None,
+            items=[
+                BatchItemStatus(index=item["idx"], status=item["status"], error=item["error"])
+                for item in items
+            ] if include_items else [],
+            **counts
+        )
+
+    async def iter_completed(self, batch_id: str) -> AsyncIterator[BatchItemStatus]:
+        """Yield từng item theo thứ tự hoàn thành, chờ tới khi cả batch xong.
+
+        Batch của process khác được đọc lại mỗi poll_interval giây.
+        """
+        sent = 0
+        while True:
+            # Đọc trạng thái batch TRƯỚC: đã xong thì mọi item đều đã có trong bảng
+            batch = await self._db(self.store.get, batch_id)
+            if batch is None:
+                return
+            rows = await self._db(self.store.completed_after, batch_id, sent, _RESULTS_PAGE)
+            for row in rows:
+                result = ClaimValidationResult(**json.loads(row["result"])) if row["result"] else None
+                yield BatchItemStatus(index=row["idx"], status=row["status"], result=result, error=row["error"])
+                sent = row["seq"]
+            if rows:
+                continue
+            if batch["finished_at"] is not None:
+                return
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def resume_orphans(self):
+        """Nhận và chạy tiếp batch dang dở của process đã dừng (startup và theo heartbeat)"""
+        self._ensure_heartbeat()
+        stale_before = time.time() - self.owner_timeout
+        for batch in await self._db(self.store.orphans, self.owner, stale_before):
+            if self._pending + batch["remaining"] > self.max_pending:
+                continue  # chưa đủ chỗ: để lần heartbeat sau hoặc worker khác nhận
+            self._pending += batch["remaining"]
+            items = []
+            try:
+                items = await self._db(
+                    self.store.claim_orphan, batch["batch_id"], batch["owner"], self.owner, stale_before
+                )
+            finally:
+                # Số item thực nhận có thể ít hơn lúc đếm (item vừa xong ở worker cũ, hoặc thua worker khác)
+                self._pending -= batch["remaining"] - len(items)
+            if not items:
+                continue
+            self._ensure_workers()
+            print(f"[LOG] Batch {batch['batch_id']}: tiếp tục {len(items)} claim dang dở")
+            for index, request in items:
+                self._queue.put_nowait((batch["batch_id"], index, ValidateClaimRequest(**json.loads(request))))
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self._db(self.store.heartbeat, self.owner)
+                await self.resume_orphans()
+            except Exception as e:
+                print(f"[LOG] Batch: heartbeat lỗi: {e}")
+
+    async def _pace(self):
+        if not self.min_interval:
+            return
+        async with self._pace_lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.min_interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def _worker(self, worker_id: int):
+        while True:
+            batch_id, index, request = await self._queue.get()
+            try:
+                await self._run_item(batch_id, index, request)
+            except Exception as e:
+                print(f"[LOG] Batch {batch_id}: không ghi được kết quả item {index}: {e}")
+            finally:
+                self._pending -= 1
+                self._queue.task_done()
+
+    async def _mark_done(self, batch_id: str, index: int, status: str, result=None, error: Optional[str] = None):
+        await self._db(self.store.mark_done, batch_id, index, status, json.dumps(result.dict(), ensure_ascii=False) if result else None, error)
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = asyncio.Event()
+
+    async def _run_item(self, batch_id: str, index: int, request: ValidateClaimRequest):
+        await self._db(self.store.mark_running, batch_id, index)
+        for attempt in range(_MAX_OVERLOAD_RETRIES + 1):
+            await self._pace()
+            try:
+                result = await services.validate_claim_with_ai(
+                    report_content=request.reportContent,
+                    policy_content=request.policyContent,
+                    mappings=request.mappings,
+                    customer_id=request.customerId
+                )
+                await self._mark_done(batch_id, index, DONE, result=result)
+                return
+            except HTTPException as e:
+                if e.status_code == 503 and attempt < _MAX_OVERLOAD_RETRIES:
+                    await asyncio.sleep(2 ** attempt)
+                    continue
+                await self._mark_done(batch_id, index, FAILED, error=str(e.detail))
+                return
+            except Exception as e:
+                print(f"[LOG] Batch {batch_id}: item {index} lỗi: {e}")
+                await self._mark_done(batch_id, index, FAILED, error=str(e))
+                return
+
+
+batch_manager = BatchValidationManager(BatchStore(BATCH_DB_PATH), BATCH_WORKERS, BATCH_MAX_RPM, BATCH_MAX_RETAINED)
@@ -0,0 +1,140 @@
+"""Micro-benchmark: chi phí parse và tỉ lệ cứu được output JSON lỗi của model.
+
+So sánh cách cũ (3 lượt regex bỏ ```json + json.loads) với llm_json.parse_json
+trên các output hợp lệ và các output bị hỏng kiểu thường gặp (cắt cụt, bọc
+markdown, có lời dẫn, thừa dấu phẩy, xuống dòng trong chuỗi).
+
+Chạy từ thư mục backend:
+    python -m benchmarks.json_parse [--iterations 2000] [--seed 7]
+"""
+import argparse
+import json
+import random
+import re
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from llm_json import parse_json
+
+# ============================================================================
+# SAMPLES
+# ============================================================================
+
+def _validation_sample(n_issues: int) -> Dict[str, Any]:
+    return {
+        "status": "needs_more_info",
+        "isValid": False,
+        "confidence": 0.72,
+        "estimatedAmount": 45000000,
+        "maxCoverageAmount": 100000000,
+        "issues": [
+            {
+                "issueType": "missing_document",
+                "severity": "warning",
+                "status": "pending",
+                "checklistItem": f"Giấy tờ số {i}",
+                "description": f"Thiếu bản gốc chứng từ số {i} có đóng dấu bệnh viện",
+                "affectedSections": ["report_sec_A", f"policy_sec_{i}"],
+                "recommendation": "Yêu cầu khách hàng bổ sung bản gốc",
+            }
+            for i in range(1, n_issues + 1)
+        ],
+        "summary": f"{n_issues} tiêu chí cần bổ sung",
+    }
+
+def _structure_sample(n_sections: int) -> List[Dict[str, str]]:
+    return [
+        {"id": f"policy_sec_{i}", "text": f"Điều {i}. Quyền lợi bảo hiểm cho chi phí y tế do tai nạn, tối đa {i * 10} triệu đồng."}
+        for i in range(1, n_sections + 1)
+    ]
+
+def _corruptions(text: str, rng: random.Random) -> List[Tuple[str, str]]:
+    """Các biến thể hỏng của một output hợp lệ"""
+    variants = [
+        ("fenced", f"```json\n{text}\n```"),
+        ("prose", f"Đây là kết quả phân tích:\n{text}\nHy vọng hữu ích!"),
+        ("trailing_comma", re.sub(r"\}(\s*)\]", r"},\1]", text, count=1)),
+        ("raw_newline", text.replace("tai nạn", "tai\nnạn", 1).replace("bản gốc", "bản\ngốc", 1)),
+    ]
+    for fraction in (0.35, 0.5, 0.65, 0.8, 0.95):
+        cut = int(len(text) * fraction) + rng.randint(-5, 5)
+        variants.append((f"truncated_{int(fraction * 100)}", text[:cut]))
+    return variants
+
+# ============================================================================
+# PARSERS
+# ============================================================================
+
+def _legacy_parse(response_text: str) -> Any:
+    """Cách cũ trong services._clean_json_response + json.loads"""
+    response_text = re.sub(r'^```json\s*', '', response_text)
+    response_text = re.sub(r'^```\s*', '', response_text)
+    response_text = re.sub(r'\s*```$', '', response_text)
+    return json.loads(response_text.strip())
+
+PARSERS: Dict[str, Callable[[str], Any]] = {
+    "legacy": _legacy_parse,
+    "tolerant": parse_json,
+}
+
+def _is_useful(value: Any, expected: type) -> bool:
+    return isinstance(value, expected) and len(value) > 0
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def _time_per_call(parser: Callable[[str], Any], text: str, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        parser(text)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def run(iterations: int, seed: int) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    samples = [
+        ("validation_12_issues", json.dumps(_validation_sample(12), ensure_ascii=False, indent=2), dict),
+        ("structure_40_sections", json.dumps(_structure_sample(40), ensure_ascii=False, indent=2), list),
+    ]
+    report: Dict[str, Any] = {"parse_us": {}, "salvage": {}}
+
+    for name, text, _ in samples:
+        fenced = f"```json\n{text}\n```"
+        report["parse_us"][name] = {
+            parser_name: round(_time_per_call(parser, fenced, iterations), 1)
+            for parser_name, parser in PARSERS.items()
+        }
+
+    for parser_name, parser in PARSERS.items():
+        ok, total, failures = 0, 0, []
+        for name, text, expected in samples:
+            for kind, corrupted in _corruptions(text, rng):
+                total += 1
+                try:
+                    if _is_useful(parser(corrupted), expected):
+                        ok += 1
+                        continue
+                except ValueError:
+                    pass
+                failures.append(f"{name}/{kind}")
+        report["salvage"][parser_name] = {"ok": ok, "total": total, "rate": round(ok / total, 3), "failed": failures}
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    report = run(args.iterations, args.seed)
+    print("Parse cost (µs/lần, output hợp lệ bọc ```json):")
+    for name, costs in report["parse_us"].items():
+        print(f"  {name:<24} " + "  ".join(f"{k}={v}" for k, v in costs.items()))
+    print("Salvage rate (output bị hỏng):")
+    for name, stats in report["salvage"].items():
+        print(f"  {name:<10} {stats['ok']}/{stats['total']} ({stats['rate']:.0%})")
+        for failed in stats["failed"]:
+            print(f"    - {failed}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,487 @@
+"""Load benchmark end-to-end: throughput, latency p50/p95/p99 và peak RSS theo route /api.
+
+Mặc định chạy app trong process qua httpx.ASGITransport với MODEL_BACKEND=stub
+(latency model giả lập), tài liệu .docx và ảnh tổng hợp theo mẫu
+source_slide/report.docx và policy_backend.docx. LLM cache và admission control
+tắt mặc định để đo năng lực thật của một worker (bật lại bằng --cache/--admission).
+
+Chạy từ thư mục backend:
+    python -m benchmarks.load [--requests 40] [--concurrency 8] [--latency 0.3] [--routes chat,validate-claim]
+    python -m benchmarks.load --save benchmarks/baseline_load.json
+    python -m benchmarks.load --compare benchmarks/baseline_load.json [--tolerance 0.25]
+
+Đo một uvicorn đang chạy (khởi động với MODEL_BACKEND=stub ADMISSION_ENABLED=0):
+    python -m benchmarks.load --url http://localhost:8000 [--pid <pid của uvicorn>]
+
+/validate-claim/batch chỉ đo lúc nộp và đọc trạng thái: worker của batch được
+giới hạn theo BATCH_MAX_RPM nên thời gian hoàn tất không phản ánh năng lực route.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+# ============================================================================
+# SYNTHETIC DATA
+# ============================================================================
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+_INCIDENTS = [
+    "Xe va chạm với xe tải do tránh người băng qua đường; phần đầu xe bị biến dạng, hư cụm đèn và nắp ca-pô.",
+    "Xe bị ngập nước khi di chuyển qua đoạn đường ngập sâu, động cơ chết máy không khởi động lại được.",
+    "Xe máy quẹt vào sườn xe khi chuyển làn, trầy xước cửa trước và gãy gương chiếu hậu bên phải.",
+    "Xe trượt bánh trên đường mưa và đâm vào dải phân cách, vỡ cản trước và két nước.",
+]
+
+def _docx_bytes(build: Callable[[Any], None]) -> bytes:
+    from docx import Document
+
+    document = Document()
+    build(document)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+def make_report_docx(index: int, sections: int = 4) -> bytes:
+    """Đơn yêu cầu bồi thường theo mẫu report.docx, nội dung khác nhau theo index"""
+    rng = random.Random(index)
+
+    def build(document):
+        document.add_heading("Đơn yêu cầu bồi thường (Claim Form)", level=2)
+        for line in (
+            f"Số hồ sơ: CLM-MTR-2025-{index:04d}",
+            f"Ngày nộp: {rng.randint(1, 28):02d}/03/2025",
+            "Người yêu cầu: Nguyễn Văn Minh",
+            "Số hợp đồng: PJICO/MCAR/2024/005712",
+            f"Biển số xe: 51H-{rng.randint(100, 999)}.{rng.randint(10, 99)}",
+            f"Thời gian xảy ra sự cố: {rng.randint(1, 28):02d}/03/2025 – {rng.randint(6, 23)}h{rng.randint(0, 59):02d}",
+            "Địa điểm: Ngã tư Nguyễn Thị Minh Khai – Cách Mạng Tháng Tám, Quận 3, TP.HCM",
+            f"Nguyên nhân: {rng.choice(_INCIDENTS)}",
+            f"Thiệt hại ước tính: Khoảng {rng.randint(10, 150) * 1000000:,} VND".replace(",", "."),
+        ):
+            document.add_paragraph(line)
+        for number in range(1, sections + 1):
+            document.add_heading(f"Tài liệu đính kèm {number}", level=3)
+            document.add_paragraph(
+                f"Hoá đơn sửa chữa số HD-{index:04d}-{number}: thay thế linh kiện, sơn và công lao động, "
+                f"tổng cộng {rng.randint(1, 40) * 1000000:,} VND. ".replace(",", ".")
+                + "Gara An Phát Auto xác nhận tình trạng xe và hạng mục sửa chữa."
+            )
+
+    return _docx_bytes(build)
+
+def make_policy_docx(clauses: int = 30) -> bytes:
+    """Hợp đồng bảo hiểm xe cơ giới theo mẫu policy_backend.docx"""
+
+    def build(document):
+        document.add_heading("HỢP ĐỒNG BẢO HIỂM XE CƠ GIỚI", level=2)
+        for line in (
+            "Số hợp đồng: PJICO/MCAR/2024/005712",
+            "Hiệu lực: 01/01/2024 – 31/12/2025",
+            "Người được bảo hiểm: Nguyễn Văn Minh",
+            "Giá trị bảo hiểm: 520.000.000 VND",
+        ):
+            document.add_paragraph(line)
+        for number in range(1, clauses + 1):
+            document.add_heading(f"Điều {number}. Quyền lợi và điều kiện bảo hiểm số {number}", level=3)
+            document.add_paragraph(
+                f"Công ty bảo hiểm bồi thường thiệt hại vật chất do tai nạn, va chạm, lật, đổ, cháy, nổ theo hạng mục {number}, "
+                f"giới hạn tối đa {number * 10}.000.000 VND mỗi vụ, mức khấu trừ 1.000.000 VND/lần tổn thất."
+            )
+            document.add_paragraph(
+                "Không bồi thường trong trường hợp lái xe không có giấy phép hợp lệ, sử dụng rượu bia "
+                "hoặc chất kích thích vượt mức quy định."
+            )
+
+    return _docx_bytes(build)
+
+def make_image(index: int, size=(1280, 960)) -> bytes:
+    """Ảnh hiện trường tổng hợp (JPEG), khác nhau theo index để không trùng hash"""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(index)
+    image = Image.new("RGB", size, tuple(rng.randint(60, 200) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randint(0, size[0] - 100), rng.randint(0, size[1] - 100)
+        w, h = rng.randint(40, 400), rng.randint(40, 300)
+        color = tuple(rng.randint(0, 255) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.rectangle((x, y, x + w, y + h), fill=color)
+        else:
+            draw.ellipse((x, y, x + w, y + h), fill=color)
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+# ============================================================================
+# RSS SAMPLER
+# ============================================================================
+
+def _rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+class RssSampler:
+    """Lấy mẫu RSS của process (Linux /proc) trên thread riêng; peak được reset theo từng route"""
+
+    def __init__(self, pid: int, interval: float = 0.02):
+        self.pid = pid
+        self.interval = interval
+        self.peak: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def reset(self):
+        self.peak = _rss_bytes(self.pid)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = _rss_bytes(self.pid)
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+# ============================================================================
+# SCENARIOS
+# ============================================================================
+
+class BenchContext:
+    """Dữ liệu dùng chung giữa các scenario (workspace, claim tạo lúc setup)"""
+
+    def __init__(self, client: httpx.AsyncClient, report_sections: int):
+        self.client = client
+        self.report_sections = report_sections
+        self.workspace_id: Optional[str] = None
+        self.claim_id: Optional[str] = None
+
+async def _check(response: httpx.Response, expected: int = 200) -> httpx.Response:
+    if response.status_code != expected:
+        raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+    return response
+
+async def _wait_job(ctx: BenchContext, job_id: str, poll: float = 0.02) -> Dict[str, Any]:
+    while True:
+        job = (await _check(await ctx.client.get(f"/api/full-analysis/{job_id}"))).json()
+        if job["status"] == "succeeded":
+            return job
+        if job["status"] in ("failed", "cancelled"):
+            raise RuntimeError(f"Job {job_id}: {job['status']} ({job.get('error')})")
+        await asyncio.sleep(poll)
+
+async def upload_report(ctx: BenchContext, i: int):
+    files = {"file": (f"report_{i}.docx", make_report_docx(i, ctx.report_sections), DOCX_MIME)}
+    await _check(await ctx.client.post("/api/upload-report", files=files))
+
+async def chat(ctx: BenchContext, i: int):
+    body = {"workspaceId": ctx.workspace_id, "message": f"Chi phí sửa chữa hạng mục {i} có được bồi thường không?"}
+    await _check(await ctx.client.post("/api/chat", json=body))
+
+async def chat_stream(ctx: BenchContext, i: int):
+    body = {"workspaceId": ctx.workspace_id, "message": f"Tóm tắt quyền lợi áp dụng cho hồ sơ số {i}"}
+    async with ctx.client.stream("POST", "/api/chat/stream", json=body) as response:
+        await _check(response)
+        async for _ in response.aiter_bytes():
+            pass
+
+async def validate_claim(ctx: BenchContext, i: int):
+    await _check(await ctx.client.post("/api/validate-claim", json={"workspaceId": ctx.workspace_id}))
+
+async def validate_claim_batch(ctx: BenchContext, i: int):
+    items = [{"workspaceId": ctx.workspace_id}] * 2
+    batch = (await _check(await ctx.client.post("/api/validate-claim/batch", json={"items": items}), 202)).json()
+    await _check(await ctx.client.get(f"/api/validate-claim/batch/{batch['batchId']}"))
+
+async def suggest_plan(ctx: BenchContext, i: int):
+    await _check(await ctx.client.post("/api/suggest-plan", json={"workspaceId": ctx.workspace_id}))
+
+def _full_analysis(mode: str) -> Callable[[BenchContext, int], Awaitable[None]]:
+    async def run(ctx: BenchContext, i: int):
+        response = await ctx.client.post(f"/api/full-analysis?mode={mode}", json={"workspaceId": ctx.workspace_id})
+        await _wait_job(ctx, (await _check(response, 202)).json()["jobId"])
+
+    return run
+
+async def full_analysis_cancel(ctx: BenchContext, i: int):
+    response = await ctx.client.post("/api/full-analysis", json={"workspaceId": ctx.workspace_id})
+    job_id = (await _check(response, 202)).json()["jobId"]
+    response = await ctx.client.delete(f"/api/full-analysis/{job_id}")
+    # Job có thể đã xong trước khi lệnh huỷ tới (409) - vẫn là phản hồi hợp lệ
+    if response.status_code not in (200, 409):
+        await _check(response)
+
+async def claim_status(ctx: BenchContext, i: int):
+    await _check(await ctx.client.get(f"/api/claim-status/{ctx.claim_id}"))
+
+async def verify_claim(ctx: BenchContext, i: int):
+    files = [("file_anh", (f"img_{i}_{k}.jpg", make_image(i * 10 + k), "image/jpeg")) for k in range(2)]
+    data = {"claim_text": f"Xe va chạm tại giao lộ, hư hỏng phần đầu xe (hồ sơ {i})"}
+    await _check(await ctx.client.post("/api/verify_claim", data=data, files=files))
+
+async def calculate_payout(ctx: BenchContext, i: int):
+    body = {
+        "contract_text": f"Hợp đồng PJICO/MCAR/2024/005712, thiệt hại ước tính {i + 10}.000.000 VND.",
+        "claim_id": ctx.claim_id
+    }
+    await _check(await ctx.client.post("/api/calculate_max_payout/", json=body))
+
+async def payout_results(ctx: BenchContext, i: int):
+    await _check(await ctx.client.get("/api/payout-results", params={"claim_id": ctx.claim_id, "limit": 20}))
+
+async def health(ctx: BenchContext, i: int):
+    await _check(await ctx.client.get("/api/health"))
+
+SCENARIOS: Dict[str, Callable[[BenchContext, int], Awaitable[None]]] = {
+    "upload-report": upload_report,
+    "chat": chat,
+    "chat-stream": chat_stream,
+    "validate-claim": validate_claim,
+    "validate-claim-batch": validate_claim_batch,
+    "suggest-plan": suggest_plan,
+    "full-analysis": _full_analysis("two_call"),
+    "full-analysis-combined": _full_analysis("combined"),
+    "full-analysis-cancel": full_analysis_cancel,
+    "claim-status": claim_status,
+    "verify-claim": verify_claim,
+    "calculate-payout": calculate_payout,
+    "payout-results": payout_results,
+    "health": health,
+}
+
+async def setup(ctx: BenchContext):
+    """Upload một biên bản (cấu trúc sẵn hợp đồng) và tạo một claim để các route khác dùng"""
+    files = {"file": ("report_setup.docx", make_report_docx(0, ctx.report_sections), DOCX_MIME)}
+    report = (await _check(await ctx.client.post("/api/upload-report", files=files))).json()
+    ctx.workspace_id = report["workspaceId"]
+    response = await ctx.client.post("/api/full-analysis", json={"workspaceId": ctx.workspace_id})
+    job = await _wait_job(ctx, (await _check(response, 202)).json()["jobId"])
+    ctx.claim_id = job["claimId"]
+
+# ============================================================================
+# RUNNER
+# ============================================================================
+
+def _percentile(ordered: List[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))]
+
+async def run_route(
+    ctx: BenchContext,
+    name: str,
+    requests: int,
+    concurrency: int,
+    sampler: Optional[RssSampler]
+) -> Dict[str, Any]:
+    scenario = SCENARIOS[name]
+    latencies: List[float] = []
+    errors: List[str] = []
+    counter = iter(range(requests))
+
+    async def worker():
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                await scenario(ctx, i)
+            except Exception as e:
+                errors.append(str(e))
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    if sampler is not None:
+        sampler.reset()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+
+    ordered = sorted(latencies)
+    result = {
+        "requests": requests,
+        "errors": len(errors),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "p50_ms": round(_percentile(ordered, 0.50) * 1000, 1),
+        "p95_ms": round(_percentile(ordered, 0.95) * 1000, 1),
+        "p99_ms": round(_percentile(ordered, 0.99) * 1000, 1),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 1) if ordered else 0.0,
+        "peak_rss_mb": round(sampler.peak / 2**20, 1) if sampler is not None and sampler.peak else None,
+    }
+    if errors:
+        print(f"  {name}: {len(errors)} lỗi, ví dụ: {errors[0]}")
+    return result
+
+def _configure_in_process(args) -> str:
+    """Đặt biến môi trường cho app TRƯỚC khi import, tạo thư mục làm việc có hợp đồng tổng hợp"""
+    workdir = tempfile.mkdtemp(prefix="bench-load-")
+    with open(os.path.join(workdir, "policy_backend.docx"), "wb") as f:
+        f.write(make_policy_docx(args.policy_clauses))
+    os.environ.update({
+        "MODEL_BACKEND": "stub",
+        "STUB_LATENCY": str(args.latency),
+        "STUB_JITTER": str(args.latency * 0.2),
+        "STUB_ERROR_RATE": str(args.error_rate),
+        "STUB_SEED": str(args.seed),
+        "LLM_CACHE_ENABLED": "1" if args.cache else "0",
+        "ADMISSION_ENABLED": "1" if args.admission else "0",
+    })
+    os.chdir(workdir)
+    return workdir
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    routes = args.routes.split(",") if args.routes else list(SCENARIOS)
+    unknown = [r for r in routes if r not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Route không hợp lệ: {', '.join(unknown)} (có: {', '.join(SCENARIOS)})")
+
+    lifespan = None
+    workdir = None
+    original_cwd = os.getcwd()
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=300)
+        pid = args.pid
+    else:
+        workdir = _configure_in_process(args)
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import main
+
+        lifespan = main.app.router.lifespan_context(main.app)
+        await lifespan.__aenter__()
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app), base_url="http://bench", timeout=300
+        )
+        pid = os.getpid()
+
+    sampler = RssSampler(pid) if pid and _rss_bytes(pid) is not None else None
+    if sampler is not None:
+        sampler.start()
+    results: Dict[str, Any] = {}
+    try:
+        ctx = BenchContext(client, args.report_sections)
+        await setup(ctx)
+        for name in routes:
+            results[name] = await run_route(ctx, name, args.requests, args.concurrency, sampler)
+            print_row(name, results[name])
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        await client.aclose()
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+        if workdir is not None:
+            os.chdir(original_cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "config": {
+            "target": args.url or "in-process",
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "model_latency_s": None if args.url else args.latency,
+            "error_rate": None if args.url else args.error_rate,
+            "cache": args.cache,
+            "admission": args.admission,
+        },
+        "routes": results,
+    }
+
+# ============================================================================
+# REPORT & BASELINE
+# ============================================================================
+
+_COLUMNS = ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "peak_rss_mb", "errors")
+
+def print_header():
+    print(f"{'route':<24}" + "".join(f"{c:>16}" for c in _COLUMNS))
+
+def print_row(name: str, row: Dict[str, Any]):
+    cells = "".join(f"{'-' if row.get(c) is None else row[c]:>16}" for c in _COLUMNS)
+    print(f"{name:<24}{cells}")
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """In chênh lệch với baseline; trả về các dòng hồi quy vượt ngưỡng tolerance"""
+    regressions = []
+    print(f"\nSo với baseline (ngưỡng {tolerance:.0%}):")
+    for name, row in current["routes"].items():
+        base = baseline.get("routes", {}).get(name)
+        if base is None:
+            print(f"  {name:<24} (không có trong baseline)")
+            continue
+        deltas = []
+        for key, higher_is_better in (("throughput_rps", True), ("p95_ms", False), ("peak_rss_mb", False)):
+            old, new = base.get(key), row.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            deltas.append(f"{key} {old} -> {new} ({change:+.0%})")
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{name}: {key} {old} -> {new}")
+        if row["errors"] > base.get("errors", 0):
+            regressions.append(f"{name}: errors {base.get('errors', 0)} -> {row['errors']}")
+        print(f"  {name:<24} " + ", ".join(deltas))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=40, help="số request mỗi route")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--routes", default="", help=f"danh sách route, mặc định tất cả: {','.join(SCENARIOS)}")
+    parser.add_argument("--latency", type=float, default=0.3, help="latency giả lập của model (giây)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="tỉ lệ lỗi 429/503 giả lập của model")
+    parser.add_argument("--report-sections", type=int, default=4, help="số mục đính kèm trong biên bản tổng hợp")
+    parser.add_argument("--policy-clauses", type=int, default=30, help="số điều khoản của hợp đồng tổng hợp")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--cache", action="store_true", help="bật LLM response cache")
+    parser.add_argument("--admission", action="store_true", help="bật admission control")
+    parser.add_argument("--url", default="", help="đo server đang chạy thay vì chạy app trong process")
+    parser.add_argument("--pid", type=int, default=0, help="pid của server (đo RSS khi dùng --url)")
+    parser.add_argument("--save", default="", help="ghi kết quả ra file JSON (baseline)")
+    parser.add_argument("--compare", default="", help="so sánh với file baseline JSON")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="ngưỡng hồi quy tương đối khi --compare")
+    args = parser.parse_args()
+
+    # Đường dẫn --save/--compare tính theo thư mục hiện tại (chế độ in-process sẽ chdir)
+    save_path = os.path.abspath(args.save) if args.save else ""
+    compare_path = os.path.abspath(args.compare) if args.compare else ""
+
+    print_header()
+    result = asyncio.run(run_benchmark(args))
+
+    if save_path:
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nĐã ghi baseline: {save_path}")
+    if compare_path:
+        with open(compare_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print("\nHồi quy:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
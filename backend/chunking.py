@@ -0,0 +1,76 @@
+# Chia văn bản dài (hợp đồng, biên bản) thành các chunk theo ranh giới điều khoản.
+# Module thuần (không import config/fastapi) để dùng được ở mọi nơi.
+import re
+from typing import Callable, List
+
+# Dòng mở đầu một điều khoản: heading từ DOCX ('#'), "Điều 5", "Chương II", "Mục 3", "Phần A"
+_CLAUSE_START_RE = re.compile(
+    r"^\s*(#+\s|(điều|chương|mục|phần)\s+[0-9ivxlcdm]+\b)",
+    re.IGNORECASE
+)
+_BLANK_LINES_RE = re.compile(r"\n\s*\n")
+
+# ============================================================================
+# BLOCKS
+# ============================================================================
+
+def split_clauses(text: str) -> List[str]:
+    """Tách văn bản thành các khối, mỗi khối bắt đầu ở một dòng mở đầu điều khoản.
+
+    Văn bản không có dấu hiệu điều khoản nào thì tách theo dòng trống,
+    cuối cùng theo từng dòng.
+    """
+    lines = text.strip().splitlines()
+    blocks: List[List[str]] = []
+    for line in lines:
+        if not blocks or _CLAUSE_START_RE.match(line):
+            blocks.append([line])
+        else:
+            blocks[-1].append(line)
+    clauses = ["\n".join(block).strip() for block in blocks]
+    clauses = [c for c in clauses if c]
+    if len(clauses) > 1:
+        return clauses
+
+    paragraphs = [p.strip() for p in _BLANK_LINES_RE.split(text) if p.strip()]
+    if len(paragraphs) > 1:
+        return paragraphs
+    return [line.strip() for line in lines if line.strip()]
+
+def _split_oversized(block: str, max_tokens: int, count_tokens: Callable[[str], int]) -> List[str]:
+    """Chia nhỏ một khối vượt ngân sách: theo dòng, rồi cắt cứng theo độ dài"""
+    if count_tokens(block) <= max_tokens:
+        return [block]
+    lines = block.splitlines()
+    if len(lines) > 1:
+        return pack(lines, max_tokens, count_tokens)
+    # Một dòng rất dài: cắt theo số ký tự tương ứng với ngân sách token
+    width = max(1, len(block) * max_tokens // count_tokens(block))
+    return [block[i:i + width] for i in range(0, len(block), width)]
+
+# ============================================================================
+# CHUNKS
+# ============================================================================
+
+def pack(blocks: List[str], max_tokens: int, count_tokens: Callable[[str], int]) -> List[str]:
+    """Gộp tham lam các khối liên tiếp thành chunk không vượt max_tokens"""
+    chunks: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    for block in blocks:
+        for piece in _split_oversized(block, max_tokens, count_tokens):
+            tokens = count_tokens(piece)
+            if current and current_tokens + tokens > max_tokens:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def split_into_chunks(text: str, max_tokens: int, count_tokens: Callable[[str], int]) -> List[str]:
+    """Chia văn bản thành các chunk <= max_tokens, cắt ở ranh giới điều khoản"""
+    if count_tokens(text) <= max_tokens:
+        return [text]
+    return pack(split_clauses(text), max_tokens, count_tokens)
@@ -1,5 +1,4 @@
 import os
-import google.generativeai as genai
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
@@ -18,16 +17,284 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Cho frontend đọc được timing/trace id của từng request
+    expose_headers=["Server-Timing", "X-Trace-Id", "X-Profile-Id"],
 )
 
 # ============================================================================
-# GEMINI AI CONFIGURATION
+# MODEL BACKEND CONFIGURATION
 # ============================================================================
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    print("Lỗi: Không tìm thấy GEMINI_API_KEY. Hãy chắc chắn file .env đã được cấu hình.")
+# "gemini": gọi API thật; "stub": model giả lập cục bộ (chạy offline, đo tải)
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gemini")
+if MODEL_BACKEND not in ("gemini", "stub"):
+    print(f"Lỗi: MODEL_BACKEND không hợp lệ: '{MODEL_BACKEND}' (gemini/stub)")
     exit(1)
 
-print(f"API_KEY: ...{GEMINI_API_KEY[-4:]}") # Che bớt key khi log
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.5-flash')
\ No newline at end of file
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+if MODEL_BACKEND == "gemini":
+    if GEMINI_API_KEY:
+        print(f"API_KEY: ...{GEMINI_API_KEY[-4:]}") # Che bớt key khi log
+    else:
+        # Model khởi tạo lười ở lời gọi đầu: server vẫn chạy, các route AI trả 503
+        print("Cảnh báo: Không tìm thấy GEMINI_API_KEY. Hãy chắc chắn file .env đã được cấu hình.")
+# Tên model cũng là namespace của LLM cache: kết quả của stub không lẫn với Gemini
+MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.5-flash") if MODEL_BACKEND == "gemini" else "stub"
+
+# Stub: latency ± jitter (giây), tỉ lệ lỗi 429/503 và lời gọi treo
+STUB_LATENCY = float(os.getenv("STUB_LATENCY", "0.5"))
+STUB_JITTER = float(os.getenv("STUB_JITTER", "0.2"))
+STUB_ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+STUB_HANG_RATE = float(os.getenv("STUB_HANG_RATE", "0"))
+# Kích thước output: số phần tử của mỗi mảng JSON và độ dài (ký tự) của câu trả lời dạng text
+STUB_OUTPUT_ITEMS = int(os.getenv("STUB_OUTPUT_ITEMS", "3"))
+STUB_OUTPUT_CHARS = int(os.getenv("STUB_OUTPUT_CHARS", "800"))
+# Đặt seed để kết quả (lỗi, latency) lặp lại được giữa các lần chạy
+STUB_SEED = int(os.environ["STUB_SEED"]) if os.getenv("STUB_SEED") else None
+
+# ============================================================================
+# LLM GATEWAY CONFIGURATION
+# ============================================================================
+# Số lời gọi Gemini chạy đồng thời tối đa trong một worker
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+# Số lời gọi được phép xếp hàng chờ; vượt quá sẽ trả 503 ngay
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))
+# Ép model trả JSON theo response_schema (sinh từ Pydantic models) ở các endpoint có JSON
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "1") == "1"
+
+# ============================================================================
+# POLICY CACHE CONFIGURATION
+# ============================================================================
+# Thư mục lưu các hợp đồng đã được AI cấu trúc (khoá theo hash nội dung file)
+POLICY_CACHE_DIR = os.getenv(
+    "POLICY_CACHE_DIR", ".cache/policies" if MODEL_BACKEND == "gemini" else ".cache/policies-stub"
+)
+POLICY_CACHE_MAX_ENTRIES = int(os.getenv("POLICY_CACHE_MAX_ENTRIES", "32"))
+# File hợp đồng dùng cho mọi biên bản (trong thực tế sẽ query theo mã khách hàng)
+POLICY_FILE_PATH = os.getenv("POLICY_FILE_PATH", "policy_backend.docx")
+# Warm-up lúc khởi động: cấu trúc sẵn các hợp đồng đã biết vào cache (phân tách bằng dấu phẩy)
+POLICY_WARMUP_ENABLED = os.getenv("POLICY_WARMUP_ENABLED", "1") == "1"
+POLICY_WARMUP_FILES = [
+    path.strip() for path in os.getenv("POLICY_WARMUP_FILES", POLICY_FILE_PATH).split(",") if path.strip()
+]
+
+# ============================================================================
+# LLM RESPONSE CACHE CONFIGURATION
+# ============================================================================
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_DB_PATH = os.getenv("LLM_CACHE_DB_PATH", ".cache/llm_cache.sqlite3")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2048"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+LLM_CACHE_DEFAULT_TTL = int(os.getenv("LLM_CACHE_DEFAULT_TTL", "3600"))
+# Tầng SQLite: số dòng tối đa (vượt thì xoá dòng cũ nhất) và dọn entry hết hạn mỗi N lần ghi
+LLM_CACHE_DB_MAX_ROWS = int(os.getenv("LLM_CACHE_DB_MAX_ROWS", "100000"))
+LLM_CACHE_PURGE_EVERY = int(os.getenv("LLM_CACHE_PURGE_EVERY", "500"))
+
+def _parse_ttls(raw: str) -> dict:
+    """Đọc cấu hình theo endpoint dạng "chat=600,validation=3600" (giây; với TTL, 0 = không cache)"""
+    ttls = {}
+    for item in raw.split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            ttls[name.strip()] = int(value)
+    return ttls
+
+# TTL (giây) theo endpoint của gateway
+LLM_CACHE_TTLS = {
+    "analysis": 3600,
+    "image_analysis": 7 * 24 * 3600,
+    "structure": 7 * 24 * 3600,
+    "customer_id": 7 * 24 * 3600,
+    "mapping": 24 * 3600,
+    "validation": 3600,
+    "plan": 3600,
+    "chat": 600,
+    "payout": 3600,
+    **_parse_ttls(os.getenv("LLM_CACHE_TTLS", "")),
+}
+
+# ============================================================================
+# LLM RESILIENCE CONFIGURATION
+# ============================================================================
+# Deadline (giây) cho mỗi lời gọi logic tới model, tính cả các lần thử lại
+LLM_DEFAULT_TIMEOUT = int(os.getenv("LLM_DEFAULT_TIMEOUT", "60"))
+LLM_TIMEOUTS = {
+    "structure": 120,
+    "analysis": 120,
+    "validation": 90,
+    "plan": 90,
+    "customer_id": 20,
+    "chat": 45,
+    **_parse_ttls(os.getenv("LLM_TIMEOUTS", "")),
+}
+# Thử lại lỗi tạm thời (429/5xx/timeout) với backoff mũ + full jitter
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+# Hedged request: gửi thêm một bản sao khi lời gọi chậm hơn p95 của endpoint
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "1") == "1"
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "2"))
+# Circuit breaker: số lỗi liên tiếp để ngắt mạch (0 = tắt) và thời gian ngắt
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+# ============================================================================
+# DOCUMENT INGESTION CONFIGURATION
+# ============================================================================
+# Số process dùng để parse tài liệu lớn (0 = parse ngay trong event loop)
+INGEST_POOL_WORKERS = int(os.getenv("INGEST_POOL_WORKERS", "2"))
+# File nhỏ hơn ngưỡng này được parse inline, tránh chi phí gửi sang process khác
+INGEST_INLINE_MAX_BYTES = int(os.getenv("INGEST_INLINE_MAX_BYTES", str(256 * 1024)))
+
+# ============================================================================
+# CUSTOMER ID EXTRACTION CONFIGURATION
+# ============================================================================
+# Điểm tối thiểu và khoảng cách với ứng viên thứ hai để bỏ qua lời gọi AI
+CUSTOMER_ID_MIN_CONFIDENCE = float(os.getenv("CUSTOMER_ID_MIN_CONFIDENCE", "0.8"))
+CUSTOMER_ID_MIN_MARGIN = float(os.getenv("CUSTOMER_ID_MIN_MARGIN", "0.15"))
+
+# ============================================================================
+# REPORT/POLICY MAPPING CONFIGURATION
+# ============================================================================
+# "local": chỉ dùng chỉ mục TF-IDF; "hybrid": AI chọn trong top-k ứng viên; "llm": gửi toàn bộ
+MAPPING_MODE = os.getenv("MAPPING_MODE", "hybrid")
+MAPPING_TOP_K = int(os.getenv("MAPPING_TOP_K", "3"))
+# Ngưỡng cosine tối thiểu để chấp nhận một mapping ở chế độ local/fallback
+MAPPING_MIN_SCORE = float(os.getenv("MAPPING_MIN_SCORE", "0.08"))
+
+# ============================================================================
+# CHAT RETRIEVAL CONFIGURATION
+# ============================================================================
+# Số section tối đa và ngân sách token cho phần bối cảnh của mỗi câu hỏi chat
+CHAT_TOP_K = int(os.getenv("CHAT_TOP_K", "8"))
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "3000"))
+
+# ============================================================================
+# CLAIM WORKSPACE CONFIGURATION
+# ============================================================================
+WORKSPACE_MAX_ENTRIES = int(os.getenv("WORKSPACE_MAX_ENTRIES", "256"))
+WORKSPACE_TTL_SECONDS = int(os.getenv("WORKSPACE_TTL_SECONDS", str(24 * 3600)))
+# Thư mục lưu workspace bị đẩy khỏi RAM (để trống = bỏ hẳn, không lưu đĩa)
+WORKSPACE_SPILL_DIR = os.getenv("WORKSPACE_SPILL_DIR", ".cache/workspaces")
+# Tổng dung lượng tối đa của thư mục spill; vượt quá thì xoá file cũ nhất
+WORKSPACE_SPILL_MAX_BYTES = int(os.getenv("WORKSPACE_SPILL_MAX_BYTES", str(512 * 1024 * 1024)))
+# Chu kỳ (giây) dọn file spill hết hạn / vượt dung lượng (kiểm tra khi có workspace bị đẩy ra)
+WORKSPACE_SPILL_SWEEP_SECONDS = int(os.getenv("WORKSPACE_SPILL_SWEEP_SECONDS", "300"))
+# Workspace được ghi thẳng xuống WORKSPACE_SPILL_DIR để worker nào cũng đọc được
+# (main.py tự bật khi chạy --workers > 1)
+WORKSPACE_SHARED = os.getenv("WORKSPACE_SHARED", "0") == "1"
+
+# ============================================================================
+# BATCH VALIDATION CONFIGURATION
+# ============================================================================
+# Số worker xử lý batch (nên nhỏ hơn LLM_MAX_CONCURRENCY để chừa chỗ cho request thường)
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+# Giới hạn số lời gọi model mỗi phút của các batch (0 = không giới hạn)
+BATCH_MAX_RPM = int(os.getenv("BATCH_MAX_RPM", "60"))
+# Số claim tối đa trong một batch (vượt quá trả 400)
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "5000"))
+# Tổng số claim đang chờ/chạy trong mỗi worker process; vượt quá thì batch mới nhận 429
+BATCH_MAX_PENDING = int(os.getenv("BATCH_MAX_PENDING", "20000"))
+# Số batch đã xong được giữ lại để tra cứu
+BATCH_MAX_RETAINED = int(os.getenv("BATCH_MAX_RETAINED", "100"))
+# Trạng thái/kết quả batch dùng chung giữa các worker process
+BATCH_DB_PATH = os.getenv("BATCH_DB_PATH", ".cache/batches.sqlite3")
+# Chu kỳ (giây) stream NDJSON đọc lại kết quả của batch đang chạy ở worker khác
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "1"))
+
+# ============================================================================
+# BACKGROUND JOB CONFIGURATION
+# ============================================================================
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", ".cache/jobs.sqlite3")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_MAX_CONCURRENT = int(os.getenv("JOB_MAX_CONCURRENT", "8"))
+# Mỗi process ghi heartbeat cho job mình đang giữ; job có heartbeat cũ hơn
+# JOB_OWNER_TIMEOUT giây được coi là mồ côi và được process khác chạy tiếp
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "5"))
+JOB_OWNER_TIMEOUT = float(os.getenv("JOB_OWNER_TIMEOUT", "30"))
+
+# ============================================================================
+# PAYOUT STORE CONFIGURATION
+# ============================================================================
+# Kết quả /calculate_max_payout được ghi nền theo batch vào SQLite (thay cho mỗi request một file JSON)
+PAYOUT_DB_PATH = os.getenv("PAYOUT_DB_PATH", "outputs/payout_results.sqlite3")
+PAYOUT_WRITE_BATCH = int(os.getenv("PAYOUT_WRITE_BATCH", "100"))
+# Thời gian tối đa (giây) gom bản ghi trước khi ghi một batch
+PAYOUT_FLUSH_INTERVAL = float(os.getenv("PAYOUT_FLUSH_INTERVAL", "0.5"))
+# Số kết quả chờ ghi tối đa
+PAYOUT_MAX_PENDING = int(os.getenv("PAYOUT_MAX_PENDING", "10000"))
+# Hàng chờ đầy: request chờ tối đa chừng này giây để có chỗ; quá hạn thì không lưu (resultId = null)
+PAYOUT_SUBMIT_TIMEOUT = float(os.getenv("PAYOUT_SUBMIT_TIMEOUT", "2"))
+
+# ============================================================================
+# FULL ANALYSIS CONFIGURATION
+# ============================================================================
+# "two_call": validation rồi action plan (2 lời gọi); "combined": 1 lời gọi chung bối cảnh
+FULL_ANALYSIS_MODE = os.getenv("FULL_ANALYSIS_MODE", "two_call")
+
+# ============================================================================
+# IMAGE PREPROCESSING CONFIGURATION
+# ============================================================================
+# Cạnh dài tối đa (pixel) của ảnh trước khi gửi cho model
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1600"))
+# Số ảnh tối đa mỗi yêu cầu /verify_claim và số ảnh phân tích song song
+IMAGE_MAX_FILES = int(os.getenv("IMAGE_MAX_FILES", "20"))
+IMAGE_ANALYSIS_CONCURRENCY = int(os.getenv("IMAGE_ANALYSIS_CONCURRENCY", "6"))
+
+# ============================================================================
+# STRUCTURING CONFIGURATION
+# ============================================================================
+# Văn bản dài hơn ngưỡng (token ước lượng) được chia chunk và cấu trúc song song
+STRUCTURE_CHUNK_TOKENS = int(os.getenv("STRUCTURE_CHUNK_TOKENS", "6000"))
+STRUCTURE_MAX_PARALLEL = int(os.getenv("STRUCTURE_MAX_PARALLEL", "4"))
+
+# ============================================================================
+# ADMISSION CONTROL CONFIGURATION
+# ============================================================================
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+# Chi phí mỗi request = số lời gọi LLM ước tính của route (đơn vị token của bucket)
+ADMISSION_ROUTE_COSTS = {
+    "/api/upload-report": 4,
+    "/api/verify_claim": 3,
+    "/api/full-analysis": 2,
+    "/api/validate-claim": 1,
+    # Chi phí cơ bản; route trừ thêm ADMISSION_BATCH_ITEM_COST cho mỗi claim sau khi đọc body
+    "/api/validate-claim/batch": 1,
+    "/api/suggest-plan": 1,
+    "/api/chat": 1,
+    "/api/chat/stream": 1,
+    "/api/calculate_max_payout/": 1,
+    **_parse_ttls(os.getenv("ADMISSION_ROUTE_COSTS", "")),
+}
+# Số lời gọi LLM của mỗi claim trong batch (batch lớn hơn burst để lại số dư âm cho client)
+ADMISSION_BATCH_ITEM_COST = int(os.getenv("ADMISSION_BATCH_ITEM_COST", "1"))
+# Ngân sách lời gọi LLM/phút cho mỗi client và cho mỗi route (kèm burst)
+ADMISSION_CLIENT_CALLS_PER_MIN = float(os.getenv("ADMISSION_CLIENT_CALLS_PER_MIN", "120"))
+ADMISSION_CLIENT_BURST = float(os.getenv("ADMISSION_CLIENT_BURST", "30"))
+ADMISSION_ROUTE_CALLS_PER_MIN = float(os.getenv("ADMISSION_ROUTE_CALLS_PER_MIN", "600"))
+ADMISSION_ROUTE_BURST = float(os.getenv("ADMISSION_ROUTE_BURST", "100"))
+# Request thiếu token được chờ tối đa MAX_WAIT giây, tối đa MAX_QUEUE request cùng chờ
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "2"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+# Lấy IP client từ X-Forwarded-For (chỉ bật khi chạy sau reverse proxy tin cậy)
+ADMISSION_TRUST_FORWARDED = os.getenv("ADMISSION_TRUST_FORWARDED", "0") == "1"
+
+# ============================================================================
+# TRACING CONFIGURATION
+# ============================================================================
+# Header Server-Timing/X-Trace-Id cho mọi request
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") == "1"
+# Request chậm hơn ngưỡng (ms) được ghi cây span đầy đủ vào file JSONL
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "2000"))
+TRACE_SLOW_LOG = os.getenv("TRACE_SLOW_LOG", ".cache/slow_traces.jsonl")
+# Profiler lấy mẫu bật theo request bằng header "X-Profile: 1" (chỉ bật ở môi trường dev)
+TRACE_PROFILE_ENABLED = os.getenv("TRACE_PROFILE_ENABLED", "0") == "1"
+TRACE_PROFILE_INTERVAL_MS = float(os.getenv("TRACE_PROFILE_INTERVAL_MS", "5"))
+TRACE_PROFILE_DIR = os.getenv("TRACE_PROFILE_DIR", ".cache/profiles")
+
+# ============================================================================
+# SERVER CONFIGURATION
+# ============================================================================
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+# Số worker process (uvicorn --workers); mỗi worker có event loop, gateway và cache RAM riêng
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
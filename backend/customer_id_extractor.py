@@ -0,0 +1,112 @@
+import re
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+from config import CUSTOMER_ID_MIN_CONFIDENCE, CUSTOMER_ID_MIN_MARGIN
+
+# ============================================================================
+# PATTERNS
+# ============================================================================
+
+# Giá trị mã: bắt đầu/kết thúc bằng chữ hoặc số, ở giữa cho phép / - .
+_VALUE = r"([A-Za-z0-9][A-Za-z0-9/\-\.]{2,}[A-Za-z0-9])"
+_SEP = r"\s*[:：]\s*"
+
+# (tên pattern, regex, trọng số) - trọng số càng cao càng đáng tin
+DEFAULT_PATTERNS: List[Tuple[str, str, float]] = [
+    ("ma_kh", r"(?:Mã\s*KH|Mã\s*khách\s*hàng|\bID)" + _SEP + _VALUE, 1.0),
+    ("so_hd", r"(?:Số\s*HĐ|Số\s*hợp\s*đồng)" + _SEP + _VALUE, 0.85),
+    ("cmnd_cccd", r"(?:CMND\s*/\s*CCCD|CMND|CCCD)" + _SEP + r"(\d{9,12})\b", 0.8),
+    ("ma_bh", r"\b((?:BH|INS)-[A-Z0-9]{3,}(?:-[A-Z0-9]+)*)\b", 0.6),
+]
+
+# Mỗi lần xuất hiện thêm của cùng một mã được cộng điểm (có giới hạn)
+_REPEAT_BONUS = 0.1
+_MAX_REPEAT_BONUS = 0.3
+
+# ============================================================================
+# EXTRACTOR
+# ============================================================================
+
+class CustomerIdCandidate:
+    def __init__(self, value: str, pattern: str, score: float, position: int):
+        self.value = value
+        self.pattern = pattern
+        self.score = score
+        self.position = position
+        self.occurrences = 1
+
+    def to_dict(self) -> Dict:
+        return {"value": self.value, "pattern": self.pattern, "score": round(self.score, 3)}
+
+
+class CustomerIdResult:
+    def __init__(
+        self,
+        customer_id: str,
+        source: str,  # "pattern" | "llm" | "none"
+        confidence: float,
+        candidates: List[CustomerIdCandidate]
+    ):
+        self.customer_id = customer_id
+        self.source = source
+        self.confidence = confidence
+        self.candidates = candidates
+
+
+class CustomerIdExtractor:
+    """Trích xuất mã khách hàng bằng regex đã compile, chấm điểm các ứng viên.
+
+    Chỉ trả kết quả khi đủ tự tin; ngược lại để tầng trên fallback sang AI.
+    """
+
+    def __init__(
+        self,
+        patterns: List[Tuple[str, str, float]] = DEFAULT_PATTERNS,
+        min_confidence: float = CUSTOMER_ID_MIN_CONFIDENCE,
+        min_margin: float = CUSTOMER_ID_MIN_MARGIN
+    ):
+        self.patterns = [
+            (name, re.compile(regex, re.IGNORECASE), weight)
+            for name, regex, weight in patterns
+        ]
+        self.min_confidence = min_confidence
+        self.min_margin = min_margin
+
+    def candidates(self, text: str) -> List[CustomerIdCandidate]:
+        text = unicodedata.normalize("NFC", text)
+        found: Dict[str, CustomerIdCandidate] = {}
+        for name, regex, weight in self.patterns:
+            for match in regex.finditer(text):
+                value = match.group(1)
+                candidate = found.get(value.upper())
+                if candidate is None:
+                    found[value.upper()] = CustomerIdCandidate(value, name, weight, match.start())
+                    continue
+                candidate.occurrences += 1
+                candidate.position = min(candidate.position, match.start())
+                if weight > candidate.score:
+                    candidate.pattern = name
+                    candidate.score = weight
+
+        for candidate in found.values():
+            candidate.score += min(_REPEAT_BONUS * (candidate.occurrences - 1), _MAX_REPEAT_BONUS)
+
+        # Điểm cao hơn đứng trước; bằng điểm thì mã xuất hiện sớm hơn đứng trước
+        return sorted(found.values(), key=lambda c: (-c.score, c.position))
+
+    def extract(self, text: str) -> Optional[CustomerIdResult]:
+        """Trả về kết quả nếu đủ tự tin, None nếu cần hỏi AI"""
+        candidates = self.candidates(text)
+        if not candidates:
+            return None
+
+        best = candidates[0]
+        runner_up = candidates[1].score if len(candidates) > 1 else 0.0
+        confident = best.score >= self.min_confidence and best.score - runner_up >= self.min_margin
+        if not confident:
+            return None
+        return CustomerIdResult(best.value, "pattern", min(best.score, 1.0), candidates)
+
+
+customer_id_extractor = CustomerIdExtractor()
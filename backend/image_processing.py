@@ -0,0 +1,51 @@
+import hashlib
+import io
+from typing import Tuple
+
+from PIL import Image, ImageOps
+
+# ============================================================================
+# IMAGE PREPROCESSING
+# ============================================================================
+
+def preprocess_image(image_data: bytes, max_edge: int) -> Image.Image:
+    """Giải mã ảnh ở kích thước vừa đủ, xoay theo EXIF và thu nhỏ về max_edge.
+
+    Với JPEG, draft() cho phép decoder giải mã thẳng ở tỉ lệ 1/2, 1/4, 1/8
+    nên ảnh 12MP không bao giờ được bung ra đủ độ phân giải trong RAM.
+    """
+    img = Image.open(io.BytesIO(image_data))
+    if img.format == "JPEG":
+        img.draft("RGB", (max_edge, max_edge))
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    return img
+
+def perceptual_hash(img: Image.Image, hash_size: int = 8) -> str:
+    """dHash 64-bit: so sánh độ sáng các pixel liền kề trên ảnh xám thu nhỏ.
+
+    Ổn định trước resize/nén lại, nhưng hai ảnh khác nhau trông giống nhau cũng
+    có thể trùng hash: chỉ dùng để phát hiện ảnh trùng trong cùng một request,
+    không dùng làm khoá cache giữa các hồ sơ (xem content_hash).
+    """
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+def content_hash(img: Image.Image) -> str:
+    """SHA-256 của pixel sau chuẩn hoá (mode, kích thước, dữ liệu): định danh chính xác của ảnh gửi cho model"""
+    digest = hashlib.sha256(f"{img.mode}:{img.size[0]}x{img.size[1]}:".encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+def prepare_image(image_data: bytes, max_edge: int) -> Tuple[Image.Image, str, str]:
+    """Tiền xử lý + tính (content_hash, perceptual_hash) (CPU-bound, nên gọi qua asyncio.to_thread)"""
+    img = preprocess_image(image_data, max_edge)
+    return img, content_hash(img), perceptual_hash(img)
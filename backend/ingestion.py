@@ -0,0 +1,146 @@
+# Bộ đọc tài liệu (DOCX, PDF, TXT) chạy hoàn toàn trên bộ nhớ.
+# Module này cố ý không import config/fastapi để có thể chạy trong process pool;
+# lỗi định dạng được báo bằng ValueError, tầng gọi (utils.py) đổi sang HTTPException.
+import io
+from typing import List
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+PDF_MIME = "application/pdf"
+TEXT_MIME = "text/plain"
+
+_EXTENSIONS = {
+    ".docx": DOCX_MIME,
+    ".pdf": PDF_MIME,
+    ".txt": TEXT_MIME,
+}
+
+# ============================================================================
+# DETECT
+# ============================================================================
+
+def detect_mime(content_type: str, filename: str, file_bytes: bytes) -> str:
+    """Xác định loại file theo content-type, đuôi file rồi tới magic bytes"""
+    if content_type in (DOCX_MIME, PDF_MIME, TEXT_MIME):
+        return content_type
+
+    lower_name = (filename or "").lower()
+    for ext, mime in _EXTENSIONS.items():
+        if lower_name.endswith(ext):
+            return mime
+
+    if file_bytes.startswith(b"%PDF"):
+        return PDF_MIME
+    if file_bytes.startswith(b"PK\x03\x04"):
+        return DOCX_MIME
+    raise ValueError("Loại file không được hỗ trợ")
+
+# ============================================================================
+# DOCX
+# ============================================================================
+
+def _heading_level(paragraph) -> int:
+    style_name = paragraph.style.name if paragraph.style is not None else ""
+    if style_name == "Title":
+        return 1
+    if style_name.startswith("Heading"):
+        level = style_name.replace("Heading", "").strip()
+        return int(level) if level.isdigit() else 1
+    return 0
+
+def _table_to_text(table) -> str:
+    lines = []
+    for row in table.rows:
+        cells = []
+        for cell in row.cells:
+            text = " ".join(cell.text.split())
+            # Ô gộp (merged) bị python-docx lặp lại => bỏ bản trùng liền kề
+            if not cells or cells[-1] != text:
+                cells.append(text)
+        if any(cells):
+            lines.append("| " + " | ".join(cells) + " |")
+    return "\n".join(lines)
+
+def parse_docx(file_bytes: bytes) -> str:
+    """Đọc DOCX theo đúng thứ tự đoạn văn/bảng; heading được đánh dấu bằng '#'"""
+    from docx import Document
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+
+    try:
+        doc = Document(io.BytesIO(file_bytes))
+    except Exception as e:
+        raise ValueError(f"Lỗi đọc DOCX: {e}")
+
+    blocks = []
+    for child in doc.element.body.iterchildren():
+        tag = child.tag.rsplit("}", 1)[-1]
+        if tag == "p":
+            paragraph = Paragraph(child, doc)
+            text = paragraph.text.strip()
+            if not text:
+                continue
+            level = _heading_level(paragraph)
+            blocks.append(f"{'#' * level} {text}" if level else text)
+        elif tag == "tbl":
+            table_text = _table_to_text(Table(child, doc))
+            if table_text:
+                blocks.append(table_text)
+
+    return "\n".join(blocks).strip()
+
+# ============================================================================
+# PDF
+# ============================================================================
+
+def parse_pdf_pages(file_bytes: bytes) -> List[str]:
+    """Trích xuất text theo từng trang PDF (cần thư viện pypdf)"""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise ValueError("Chưa cài đặt pypdf, không thể đọc file PDF")
+
+    try:
+        reader = PdfReader(io.BytesIO(file_bytes))
+        return [(page.extract_text() or "").strip() for page in reader.pages]
+    except Exception as e:
+        raise ValueError(f"Lỗi đọc PDF: {e}")
+
+def parse_pdf(file_bytes: bytes) -> str:
+    pages = parse_pdf_pages(file_bytes)
+    return "\n\n".join(
+        f"--- Trang {idx} ---\n{text}" for idx, text in enumerate(pages, start=1) if text
+    ).strip()
+
+# ============================================================================
+# TXT
+# ============================================================================
+
+def parse_text(file_bytes: bytes) -> str:
+    try:
+        return file_bytes.decode("utf-8-sig").strip()
+    except UnicodeDecodeError:
+        raise ValueError("File text không phải UTF-8")
+
+# ============================================================================
+# ENTRY POINT
+# ============================================================================
+
+_PARSERS = {
+    DOCX_MIME: parse_docx,
+    PDF_MIME: parse_pdf,
+    TEXT_MIME: parse_text,
+}
+
+def extract_text(mime: str, file_bytes: bytes) -> str:
+    """Hàm top-level (picklable) để chạy trong process pool"""
+    parser = _PARSERS.get(mime)
+    if parser is None:
+        raise ValueError("Loại file không được hỗ trợ")
+    try:
+        return parser(file_bytes)
+    except (ValueError, MemoryError):
+        raise
+    except Exception as e:
+        # File hỏng có thể làm python-docx/pypdf/lxml ném lỗi bất kỳ (KeyError, XMLSyntaxError...):
+        # đó là lỗi của input, không phải lỗi server
+        raise ValueError(f"Lỗi đọc file: {type(e).__name__}: {e}")
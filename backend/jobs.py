@@ -0,0 +1,328 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from metrics import observe_stage_timings
+from config import (
+    JOBS_DB_PATH, JOB_MAX_ATTEMPTS, JOB_MAX_CONCURRENT, JOB_HEARTBEAT_INTERVAL, JOB_OWNER_TIMEOUT
+)
+
+# Trạng thái job
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+# handler(payload, progress) -> result (dict, lưu dạng JSON)
+ProgressFunc = Callable[[str, int], Awaitable[None]]
+JobHandler = Callable[[Dict[str, Any], ProgressFunc], Awaitable[Dict[str, Any]]]
+
+# Định danh chủ job theo từng lần khởi động process. PID bị tái sử dụng sau restart
+# container (thường lại là PID 1) nên không dùng để biết chủ job còn sống hay không.
+OWNER_ID = f"{os.getpid()}-{uuid.uuid4().hex}"
+
+# ============================================================================
+# JOB STORE (SQLite)
+# ============================================================================
+
+class JobStore:
+    """Lưu job trong SQLite để tra cứu được qua restart và giữa các worker"""
+
+    def __init__(self, db_path: str):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                claim_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                progress INTEGER NOT NULL DEFAULT 0,
+                stages TEXT NOT NULL DEFAULT '{}',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                owner TEXT,
+                heartbeat_at REAL,
+                payload TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "heartbeat_at" not in columns:
+            # DB tạo trước khi có heartbeat: job cũ có heartbeat NULL => được coi là mồ côi
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (claim_id, created_at)")
+        self._conn.commit()
+
+    def insert(self, job_id: str, kind: str, claim_id: str, payload: Dict, max_attempts: int):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """INSERT INTO jobs (job_id, kind, claim_id, status, max_attempts, owner,
+                                     heartbeat_at, payload, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (job_id, kind, claim_id, QUEUED, max_attempts, OWNER_ID, now,
+                 json.dumps(payload, ensure_ascii=False), now, now)
+            )
+            self._conn.commit()
+
+    def update(self, job_id: str, **fields) -> bool:
+        """Cập nhật job đang chạy; trả False (không đổi gì) nếu job đã bị huỷ ở worker khác"""
+        if "stages" in fields:
+            fields["stages"] = json.dumps(fields["stages"], ensure_ascii=False)
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"], ensure_ascii=False)
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET {columns} WHERE job_id = ? AND status != ?",
+                (*fields.values(), job_id, CANCELLED)
+            )
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def cancel(self, job_id: str, error: str) -> bool:
+        """Huỷ job còn đang chờ/chạy; False nếu job đã kết thúc (không ghi đè kết quả)"""
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET status = ?, error = ?, updated_at = ? "
+                f"WHERE job_id = ? AND status IN ({', '.join('?' * len(ACTIVE_STATUSES))})",
+                (CANCELLED, error, time.time(), job_id, *ACTIVE_STATUSES)
+            )
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def heartbeat(self, owner: str):
+        """Đánh dấu các job đang giữ bởi owner là còn sống"""
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET heartbeat_at = ? "
+                f"WHERE owner = ? AND status IN ({', '.join('?' * len(ACTIVE_STATUSES))})",
+                (time.time(), owner, *ACTIVE_STATUSES)
+            )
+            self._conn.commit()
+
+    def orphans(self, owner: str, stale_before: float) -> List[Dict[str, Any]]:
+        """Job đang chờ/chạy của owner khác đã ngừng heartbeat"""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM jobs WHERE status IN ({', '.join('?' * len(ACTIVE_STATUSES))}) "
+                "AND owner IS NOT ? AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (*ACTIVE_STATUSES, owner, stale_before)
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def claim_orphan(self, job_id: str, old_owner: Optional[str], owner: str, stale_before: float) -> bool:
+        """Nhận job mồ côi; chỉ một worker thắng nhờ điều kiện owner cũ + heartbeat vẫn cũ"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET owner = ?, status = ?, heartbeat_at = ?, updated_at = ? "
+                f"WHERE job_id = ? AND owner IS ? AND (heartbeat_at IS NULL OR heartbeat_at < ?) "
+                f"AND status IN ({', '.join('?' * len(ACTIVE_STATUSES))})",
+                (owner, QUEUED, now, now, job_id, old_owner, stale_before, *ACTIVE_STATUSES)
+            )
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def latest_for_claim(self, claim_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE claim_id = ? ORDER BY created_at DESC LIMIT 1",
+                (claim_id,)
+            ).fetchone()
+        return self._to_dict(row) if row else None
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["stages"] = json.loads(job["stages"] or "{}")
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+# ============================================================================
+# JOB ENGINE
+# ============================================================================
+
+class JobEngine:
+    """Chạy job nền bằng asyncio task, có retry (backoff mũ) và huỷ được.
+
+    Tiến độ từng stage được ghi vào SQLite để /claim-status đọc lại.
+    Mọi chuyển trạng thái đều có điều kiện "chưa bị huỷ": DELETE từ worker khác
+    không bị ghi đè, job dừng ở lần cập nhật kế tiếp.
+    Chủ job là OWNER_ID của lần khởi động process kèm heartbeat định kỳ; job có
+    heartbeat quá owner_timeout được worker còn sống nhận và chạy tiếp.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        max_attempts: int,
+        max_concurrent: int,
+        heartbeat_interval: float = JOB_HEARTBEAT_INTERVAL,
+        owner_timeout: float = JOB_OWNER_TIMEOUT
+    ):
+        self.store = store
+        self.max_attempts = max_attempts
+        self.max_concurrent = max_concurrent
+        self.heartbeat_interval = heartbeat_interval
+        self.owner_timeout = owner_timeout
+        self.owner = OWNER_ID
+        self._handlers: Dict[str, JobHandler] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> int:
+        return len(self._tasks)
+
+    def register(self, kind: str, handler: JobHandler):
+        self._handlers[kind] = handler
+
+    async def _db(self, func, *args, **kwargs):
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def submit(self, kind: str, claim_id: str, payload: Dict[str, Any]) -> str:
+        if kind not in self._handlers:
+            raise ValueError(f"Chưa đăng ký handler cho job '{kind}'")
+        job_id = f"job-{uuid.uuid4().hex}"
+        await self._db(self.store.insert, job_id, kind, claim_id, payload, self.max_attempts)
+        self._start(job_id, kind, payload)
+        return job_id
+
+    def _start(self, job_id: str, kind: str, payload: Dict[str, Any]):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        self._ensure_heartbeat()
+        task = asyncio.create_task(self._run(job_id, kind, payload))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self._db(self.store.get, job_id)
+
+    async def latest_for_claim(self, claim_id: str) -> Optional[Dict[str, Any]]:
+        return await self._db(self.store.latest_for_claim, claim_id)
+
+    async def cancel(self, job_id: str) -> bool:
+        # Ghi CANCELLED trước: job ở worker khác sẽ dừng ở lần chuyển trạng thái kế tiếp
+        if not await self._db(self.store.cancel, job_id, "Đã huỷ theo yêu cầu"):
+            return False
+        task = self._tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        return True
+
+    async def resume_orphans(self):
+        """Chạy tiếp các job dang dở của process đã dừng (lúc startup và định kỳ theo heartbeat)"""
+        self._ensure_heartbeat()
+        stale_before = time.time() - self.owner_timeout
+        for job in await self._db(self.store.orphans, self.owner, stale_before):
+            if job["kind"] not in self._handlers:
+                continue
+            if await self._db(self.store.claim_orphan, job["job_id"], job["owner"], self.owner, stale_before):
+                print(f"[LOG] Jobs: tiếp tục job {job['job_id']} ({job['kind']})")
+                self._start(job["job_id"], job["kind"], job["payload"])
+
+    def _ensure_heartbeat(self):
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self._db(self.store.heartbeat, self.owner)
+                await self.resume_orphans()
+            except Exception as e:
+                print(f"[LOG] Jobs: heartbeat lỗi: {e}")
+
+    async def shutdown(self):
+        tasks = list(self._tasks.values())
+        if self._heartbeat_task is not None:
+            tasks.append(self._heartbeat_task)
+            self._heartbeat_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, job_id: str, kind: str, payload: Dict[str, Any]):
+        handler = self._handlers[kind]
+        stages: Dict[str, Dict[str, Any]] = {}
+        current = {"stage": None, "started": 0.0}
+
+        async def progress(stage: str, percent: int):
+            now = time.perf_counter()
+            if current["stage"] and current["stage"] in stages:
+                stages[current["stage"]]["status"] = "done"
+                stages[current["stage"]]["durationMs"] = round((now - current["started"]) * 1000, 1)
+            stages[stage] = {"status": "running", "startedAt": datetime.now().isoformat()}
+            current.update(stage=stage, started=now)
+            # Job có thể bị huỷ từ worker khác: cập nhật không có hiệu lực thì dừng
+            if not await self._db(self.store.update, job_id, stage=stage, progress=percent, stages=stages):
+                raise asyncio.CancelledError()
+
+        async with self._semaphore:
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    if not await self._db(self.store.update, job_id, status=RUNNING, attempts=attempt):
+                        print(f"[LOG] Jobs: job {job_id} đã bị huỷ, dừng")
+                        return
+                    result = await handler(payload, progress)
+                    if current["stage"]:
+                        stages[current["stage"]]["status"] = "done"
+                        stages[current["stage"]]["durationMs"] = round(
+                            (time.perf_counter() - current["started"]) * 1000, 1
+                        )
+                    if not await self._db(
+                        self.store.update, job_id,
+                        status=SUCCEEDED, progress=100, stages=stages, result=result, error=None
+                    ):
+                        print(f"[LOG] Jobs: job {job_id} đã bị huỷ, bỏ kết quả")
+                        return
+                    observe_stage_timings(kind, {
+                        name: info["durationMs"] for name, info in stages.items() if "durationMs" in info
+                    })
+                    return
+                except asyncio.CancelledError:
+                    print(f"[LOG] Jobs: job {job_id} bị huỷ")
+                    raise
+                except Exception as e:
+                    print(f"[LOG] Jobs: job {job_id} lỗi lần {attempt}/{self.max_attempts}: {e}")
+                    if current["stage"]:
+                        stages[current["stage"]]["status"] = "failed"
+                    if attempt == self.max_attempts:
+                        await self._db(self.store.update, job_id, status=FAILED, stages=stages, error=str(e))
+                        return
+                    if not await self._db(self.store.update, job_id, status=QUEUED, stages=stages, error=str(e)):
+                        print(f"[LOG] Jobs: job {job_id} đã bị huỷ, không thử lại")
+                        return
+                    await asyncio.sleep(2 ** attempt)
+
+job_engine = JobEngine(JobStore(JOBS_DB_PATH), JOB_MAX_ATTEMPTS, JOB_MAX_CONCURRENT)
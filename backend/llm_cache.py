@@ -0,0 +1,281 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import (
+    MODEL_NAME, LLM_CACHE_ENABLED, LLM_CACHE_DB_PATH, LLM_CACHE_MAX_ENTRIES,
+    LLM_CACHE_MAX_BYTES, LLM_CACHE_DEFAULT_TTL, LLM_CACHE_TTLS, LLM_CACHE_DB_MAX_ROWS, LLM_CACHE_PURGE_EVERY
+)
+
+# ============================================================================
+# CACHE KEY
+# ============================================================================
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def normalize_prompt(contents: Any) -> Optional[str]:
+    """Chuẩn hoá prompt để hash; trả None nếu có phần không phải text (ảnh...)"""
+    if isinstance(contents, str):
+        parts = [contents]
+    elif isinstance(contents, (list, tuple)) and all(isinstance(p, str) for p in contents):
+        parts = list(contents)
+    else:
+        return None
+    return "\x1e".join(_WHITESPACE_RE.sub(" ", p).strip() for p in parts)
+
+def make_key(
+    model_name: str,
+    contents: Any,
+    content_id: Optional[str] = None,
+    endpoint: str = "default",
+    response_schema: Optional[Dict[str, Any]] = None
+) -> Optional[str]:
+    """content_id thay cho phần không phải text (vd. hash nội dung ảnh).
+
+    Key gồm cả endpoint và schema output: cùng prompt nhưng khác hợp đồng output
+    (validate/schema khác nhau) thì không dùng chung entry.
+    """
+    if content_id is not None:
+        contents = [p for p in contents if isinstance(p, str)] + [f"content:{content_id}"]
+    normalized = normalize_prompt(contents)
+    if normalized is None:
+        return None
+    schema = json.dumps(response_schema, sort_keys=True, ensure_ascii=False) if response_schema else ""
+    digest = hashlib.sha256("\x1f".join((endpoint, schema, normalized)).encode("utf-8")).hexdigest()
+    return f"{model_name}:{digest}"
+
+# ============================================================================
+# CACHE TIERS
+# ============================================================================
+
+class CacheTier:
+    """Interface cho một tầng cache: get/set theo key, hết hạn theo expires_at"""
+
+    name = "tier"
+    blocking = False  # True => chạy trong thread pool để không chặn event loop
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        raise NotImplementedError
+
+    def set(self, key: str, endpoint: str, value: str, expires_at: float):
+        raise NotImplementedError
+
+    def purge(self) -> int:
+        """Dọn entry hết hạn/vượt giới hạn, trả về số entry đã xoá"""
+        return 0
+
+
+class MemoryTier(CacheTier):
+    """LRU trong process, giới hạn theo số entry và tổng số byte"""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] <= time.time():
+            self._evict(key)
+            return None
+        self._data.move_to_end(key)
+        return item
+
+    def set(self, key: str, endpoint: str, value: str, expires_at: float):
+        if key in self._data:
+            self._evict(key)
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        self._data[key] = (value, expires_at)
+        self._bytes += size
+        while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+            self._evict(next(iter(self._data)))
+
+    def _evict(self, key: str):
+        value, _ = self._data.pop(key)
+        self._bytes -= len(value.encode("utf-8"))
+
+
+class SQLiteTier(CacheTier):
+    """Tầng bền vững trên SQLite, giữ được cache qua các lần restart.
+
+    Entry hết hạn được dọn lúc khởi động và mỗi purge_every lần ghi;
+    bảng không vượt max_rows dòng (xoá dòng cũ nhất).
+    """
+
+    name = "sqlite"
+    blocking = True
+
+    def __init__(self, db_path: str, max_rows: int = LLM_CACHE_DB_MAX_ROWS, purge_every: int = LLM_CACHE_PURGE_EVERY):
+        self.db_path = db_path
+        self.max_rows = max_rows
+        self.purge_every = purge_every
+        self._writes = 0
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_expires ON llm_cache (expires_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache (created_at)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, expires_at FROM llm_cache WHERE key = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def set(self, key: str, endpoint: str, value: str, expires_at: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?)",
+                (key, endpoint, value, time.time(), expires_at)
+            )
+            self._conn.commit()
+            self._writes += 1
+            due = self.purge_every > 0 and self._writes % self.purge_every == 0
+        if due:
+            self.purge()
+
+    def purge(self) -> int:
+        with self._lock:
+            removed = self._conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+            if self.max_rows > 0:
+                removed += self._conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN "
+                    "(SELECT key FROM llm_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_rows,)
+                ).rowcount
+            self._conn.commit()
+        return removed
+
+# ============================================================================
+# LLM RESPONSE CACHE
+# ============================================================================
+
+class LLMResponseCache:
+    """Cache response của model theo (tên model, hash prompt đã chuẩn hoá).
+
+    Đọc lần lượt các tầng (RAM -> SQLite); hit ở tầng dưới sẽ được nạp lên tầng trên.
+    """
+
+    def __init__(
+        self,
+        tiers: List[CacheTier],
+        model_name: str,
+        ttls: Dict[str, int],
+        default_ttl: int
+    ):
+        self.tiers = tiers
+        self.model_name = model_name
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+
+    def ttl_for(self, endpoint: str) -> int:
+        return self.ttls.get(endpoint, self.default_ttl)
+
+    def key_for(
+        self,
+        contents: Any,
+        endpoint: str,
+        content_id: Optional[str] = None,
+        response_schema: Optional[Dict[str, Any]] = None
+    ) -> Optional[str]:
+        if self.ttl_for(endpoint) <= 0:
+            return None
+        return make_key(self.model_name, contents, content_id, endpoint, response_schema)
+
+    async def _call(self, tier: CacheTier, method: str, *args):
+        func = getattr(tier, method)
+        if tier.blocking:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    async def get(self, key: str, endpoint: str) -> Optional[str]:
+        value = None
+        for idx, tier in enumerate(self.tiers):
+            try:
+                item = await self._call(tier, "get", key)
+            except Exception as e:
+                print(f"[LOG] LLM cache: tầng {tier.name} lỗi khi đọc: {e}")
+                continue
+            if item is not None:
+                value = item[0]
+                for upper in self.tiers[:idx]:
+                    await self._call(upper, "set", key, endpoint, item[0], item[1])
+                break
+        counter = self.hits if value is not None else self.misses
+        counter[endpoint] = counter.get(endpoint, 0) + 1
+        return value
+
+    async def set(self, key: str, endpoint: str, value: str):
+        expires_at = time.time() + self.ttl_for(endpoint)
+        for tier in self.tiers:
+            try:
+                await self._call(tier, "set", key, endpoint, value, expires_at)
+            except Exception as e:
+                print(f"[LOG] LLM cache: tầng {tier.name} không lưu được '{endpoint}': {e}")
+
+    async def purge(self) -> int:
+        """Dọn các tầng (gọi lúc startup; tầng SQLite tự dọn định kỳ khi ghi)"""
+        removed = 0
+        for tier in self.tiers:
+            try:
+                removed += await self._call(tier, "purge")
+            except Exception as e:
+                print(f"[LOG] LLM cache: tầng {tier.name} lỗi khi dọn: {e}")
+        if removed:
+            print(f"[LOG] LLM cache: dọn {removed} entry hết hạn/vượt giới hạn")
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        endpoints = sorted(set(self.hits) | set(self.misses))
+        return {
+            endpoint: {
+                "hits": self.hits.get(endpoint, 0),
+                "misses": self.misses.get(endpoint, 0),
+            }
+            for endpoint in endpoints
+        }
+
+
+def _build_default_cache() -> Optional[LLMResponseCache]:
+    if not LLM_CACHE_ENABLED:
+        return None
+    tiers: List[CacheTier] = [MemoryTier(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_MAX_BYTES)]
+    try:
+        tiers.append(SQLiteTier(LLM_CACHE_DB_PATH))
+    except (sqlite3.Error, OSError) as e:
+        print(f"[LOG] LLM cache: không mở được SQLite ({e}), chỉ dùng cache RAM")
+    return LLMResponseCache(tiers, MODEL_NAME, LLM_CACHE_TTLS, LLM_CACHE_DEFAULT_TTL)
+
+
+response_cache = _build_default_cache()
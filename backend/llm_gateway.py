@@ -0,0 +1,301 @@
+import asyncio
+import time
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+from fastapi import HTTPException
+
+from config import (
+    LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE,
+    LLM_DEFAULT_TIMEOUT, LLM_TIMEOUTS, LLM_MAX_RETRIES, LLM_BACKOFF_BASE, LLM_BACKOFF_MAX,
+    LLM_HEDGE_ENABLED, LLM_HEDGE_MIN_DELAY, LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN
+)
+from llm_cache import LLMResponseCache, response_cache
+from model_backend import ModelBackend, create_backend
+from resilience import CircuitBreaker, ResiliencePolicy, is_retryable
+import metrics
+import tracing
+
+# ============================================================================
+# LLM GATEWAY
+# ============================================================================
+
+# validate(text): ném exception hoặc trả False nếu output không dùng được -> không cache
+Validator = Callable[[str], Any]
+
+def _finished_normally(response) -> bool:
+    """False nếu model dừng vì giới hạn token/an toàn (output bị cắt); stub không có candidates"""
+    candidates = getattr(response, "candidates", None)
+    if not candidates:
+        return True
+    reason = getattr(candidates[0], "finish_reason", None)
+    if reason is None:
+        return True
+    return getattr(reason, "name", str(reason)) in ("STOP", "FINISH_REASON_UNSPECIFIED")
+
+def _is_usable(text: str, validate: Optional[Validator]) -> bool:
+    if validate is None:
+        return True
+    try:
+        return validate(text) is not False
+    except Exception:
+        return False
+
+class LLMGateway:
+    """Cổng gọi model bất đồng bộ dùng chung cho tất cả services.
+
+    - Giới hạn số lời gọi chạy đồng thời bằng semaphore
+    - Hàng chờ có giới hạn: khi đầy thì trả 503 thay vì treo request
+    - Prompt trùng lặp được trả từ cache (nếu có) mà không chiếm slot
+    - Deadline, retry, hedged request và circuit breaker qua ResiliencePolicy
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_queue: int,
+        cache: Optional[LLMResponseCache] = None,
+        resilience: Optional[ResiliencePolicy] = None,
+        backend: Optional[ModelBackend] = None
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.cache = cache
+        self.resilience = resilience
+        # Gemini hoặc stub cục bộ (MODEL_BACKEND); kiểm thử có thể truyền StubModel riêng
+        self.backend = backend
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._waiting = 0
+        self._in_flight = 0
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def _acquire(self, endpoint: str):
+        if self._semaphore.locked() and self._waiting >= self.max_queue:
+            print(f"[LOG] LLM gateway: hàng chờ đầy ({self._waiting}), từ chối '{endpoint}'")
+            raise HTTPException(
+                status_code=503,
+                detail="Hệ thống AI đang quá tải, vui lòng thử lại sau",
+                headers={"Retry-After": "1"}
+            )
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+        self._in_flight += 1
+
+    def _release(self):
+        self._in_flight -= 1
+        self._semaphore.release()
+
+    @staticmethod
+    def _record_error(endpoint: str, error: BaseException):
+        metrics.LLM_CALLS.inc(endpoint, "error")
+        error_type = f"HTTP{error.status_code}" if isinstance(error, HTTPException) else type(error).__name__
+        metrics.ERRORS.inc("llm", error_type)
+
+    async def generate(
+        self,
+        contents: Any,
+        endpoint: str = "default",
+        content_id: Optional[str] = None,
+        response_schema: Optional[Dict[str, Any]] = None,
+        validate: Optional[Validator] = None
+    ) -> str:
+        """Gọi model bất đồng bộ và trả về text của response.
+
+        content_id cho phép cache cả prompt có ảnh (key theo hash nội dung ảnh).
+        response_schema: ép model trả JSON đúng schema (application/json).
+        validate: chỉ output qua được validate (và không bị cắt vì giới hạn token)
+        mới được ghi vào cache; entry cũ không qua validate bị coi như miss.
+        Output không hợp lệ vẫn được trả về để caller tự xử lý (fallback/lỗi).
+        """
+        with tracing.span(f"llm.{endpoint}"):
+            return await self._generate(contents, endpoint, content_id, response_schema, validate)
+
+    async def _generate(
+        self,
+        contents: Any,
+        endpoint: str,
+        content_id: Optional[str],
+        response_schema: Optional[Dict[str, Any]],
+        validate: Optional[Validator]
+    ) -> str:
+        cache_key = self.cache.key_for(contents, endpoint, content_id, response_schema) if self.cache else None
+        if cache_key:
+            cached = await self.cache.get(cache_key, endpoint)
+            if cached is not None and _is_usable(cached, validate):
+                metrics.LLM_CALLS.inc(endpoint, "cache_hit")
+                tracing.annotate(cache="hit")
+                return cached
+
+        finished = True
+
+        async def call() -> str:
+            nonlocal finished
+            # Mỗi bản (kể cả hedge/retry) chiếm slot riêng: upstream không vượt quá max_concurrency
+            await self._acquire(endpoint)
+            try:
+                with tracing.span("llm.upstream"):
+                    response = await self.backend.generate(contents, endpoint=endpoint, response_schema=response_schema)
+            finally:
+                self._release()
+            # Đếm cả các bản hedge/retry: đó là chi phí thật với upstream
+            metrics.record_usage(endpoint, response)
+            finished = _finished_normally(response)
+            return response.text
+
+        started = time.perf_counter()
+        try:
+            if self.resilience is not None:
+                text = await self.resilience.call(call, endpoint)
+            else:
+                text = await call()
+        except Exception as e:
+            self._record_error(endpoint, e)
+            raise
+        metrics.LLM_CALLS.inc(endpoint, "ok")
+        metrics.LLM_LATENCY.observe(time.perf_counter() - started, endpoint)
+        metrics.LLM_PROMPT_CHARS.observe(metrics.prompt_chars(contents), endpoint)
+        metrics.LLM_RESPONSE_CHARS.observe(len(text), endpoint)
+
+        if cache_key:
+            await self._cache_if_usable(cache_key, endpoint, text, finished, validate)
+        return text
+
+    async def _cache_if_usable(
+        self, cache_key: str, endpoint: str, text: str, finished: bool, validate: Optional[Validator]
+    ):
+        if finished and _is_usable(text, validate):
+            await self.cache.set(cache_key, endpoint, text)
+        else:
+            print(f"[LOG] LLM gateway: output '{endpoint}' bị cắt hoặc không hợp lệ, không cache")
+
+    async def stream(
+        self, contents: Any, endpoint: str = "default", validate: Optional[Validator] = None
+    ) -> AsyncIterator[str]:
+        """Gọi model ở chế độ stream, yield từng đoạn text khi model sinh ra.
+
+        Nếu consumer dừng giữa chừng (client ngắt kết nối) thì generator bị đóng,
+        slot được trả lại và phần còn lại của stream không được đọc tiếp.
+        validate: như generate - chỉ toàn văn hợp lệ, không bị cắt mới được cache.
+        """
+        trace_span = tracing.open_span(f"llm.{endpoint}", stream=True)
+        try:
+            # aclosing: đóng generator bên trong ngay khi consumer dừng để trả slot kịp thời
+            async with aclosing(self._stream(contents, endpoint, trace_span, validate)) as chunks:
+                async for text in chunks:
+                    yield text
+        finally:
+            if trace_span is not None:
+                trace_span.finish()
+
+    async def _stream(
+        self, contents: Any, endpoint: str, trace_span, validate: Optional[Validator]
+    ) -> AsyncIterator[str]:
+        cache_key = self.cache.key_for(contents, endpoint) if self.cache else None
+        if cache_key:
+            cached = await self.cache.get(cache_key, endpoint)
+            if cached is not None and _is_usable(cached, validate):
+                metrics.LLM_CALLS.inc(endpoint, "cache_hit")
+                if trace_span is not None:
+                    trace_span.attrs["cache"] = "hit"
+                yield cached
+                return
+
+        # Stream không retry/hedge được sau khi đã gửi chunk cho client;
+        # chỉ áp dụng circuit breaker và deadline cho lúc mở stream.
+        breaker = self.resilience.breaker if self.resilience is not None else None
+        timeout = self.resilience.timeout_for(endpoint) if self.resilience is not None else None
+        chunks = []
+        completed = False
+        finished = True
+        started = time.perf_counter()
+        try:
+            await self._acquire(endpoint)
+        except Exception as e:
+            self._record_error(endpoint, e)
+            raise
+        try:
+            if breaker is not None:
+                breaker.before_call()
+            try:
+                response = await asyncio.wait_for(
+                    self.backend.generate(contents, endpoint=endpoint, stream=True), timeout=timeout
+                )
+                async for chunk in response:
+                    text = chunk.text
+                    if text:
+                        chunks.append(text)
+                        yield text
+                metrics.record_usage(endpoint, response)
+                finished = _finished_normally(response)
+            except BaseException as e:
+                if isinstance(e, Exception):
+                    self._record_error(endpoint, e)
+                # Lỗi không tạm thời hay client ngắt sau khi đã có chunk: upstream vẫn phản hồi bình thường;
+                # bị huỷ trước chunk đầu thì chưa biết gì, chỉ trả lượt thăm dò
+                if breaker is not None and is_retryable(e):
+                    breaker.record_failure()
+                elif breaker is not None and (isinstance(e, Exception) or chunks):
+                    breaker.record_success()
+                elif breaker is not None:
+                    breaker.release_probe()
+                raise
+            if breaker is not None:
+                breaker.record_success()
+            completed = True
+            metrics.LLM_CALLS.inc(endpoint, "ok")
+            metrics.LLM_LATENCY.observe(time.perf_counter() - started, endpoint)
+            metrics.LLM_PROMPT_CHARS.observe(metrics.prompt_chars(contents), endpoint)
+            metrics.LLM_RESPONSE_CHARS.observe(sum(len(c) for c in chunks), endpoint)
+        finally:
+            self._release()
+            if not completed:
+                print(f"[LOG] LLM gateway: stream '{endpoint}' bị huỷ sau {len(chunks)} chunk")
+
+        if cache_key:
+            await self._cache_if_usable(cache_key, endpoint, "".join(chunks), finished, validate)
+
+
+gateway = LLMGateway(
+    LLM_MAX_CONCURRENCY,
+    LLM_MAX_QUEUE,
+    cache=response_cache,
+    resilience=ResiliencePolicy(
+        timeouts=LLM_TIMEOUTS,
+        default_timeout=LLM_DEFAULT_TIMEOUT,
+        max_retries=LLM_MAX_RETRIES,
+        backoff_base=LLM_BACKOFF_BASE,
+        backoff_max=LLM_BACKOFF_MAX,
+        hedge_enabled=LLM_HEDGE_ENABLED,
+        hedge_min_delay=LLM_HEDGE_MIN_DELAY,
+        breaker=CircuitBreaker(LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN)
+    ),
+    backend=create_backend()
+)
+
+
+async def generate(
+    contents: Any,
+    endpoint: str = "default",
+    content_id: Optional[str] = None,
+    response_schema: Optional[Dict[str, Any]] = None,
+    validate: Optional[Validator] = None
+) -> str:
+    """Shortcut tới gateway mặc định của process"""
+    return await gateway.generate(
+        contents, endpoint=endpoint, content_id=content_id, response_schema=response_schema, validate=validate
+    )
+
+
+def stream(contents: Any, endpoint: str = "default", validate: Optional[Validator] = None) -> AsyncIterator[str]:
+    """Shortcut tới gateway.stream của process"""
+    return gateway.stream(contents, endpoint=endpoint, validate=validate)
@@ -0,0 +1,212 @@
+# JSON cho output của model: response_schema sinh từ Pydantic models và
+# parser chịu lỗi (cứu được JSON bị cắt cụt, bọc markdown, thừa dấu phẩy).
+# JSON bị cắt cụt chỉ cứu được một phần: caller nào cần đủ dữ liệu thì dùng
+# allow_partial=False (hoặc parse_json_checked) để từ chối thay vì dùng bản thiếu.
+# Module thuần (không import config/fastapi) để benchmark chạy độc lập.
+import json
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type
+
+from pydantic import BaseModel
+
+# ============================================================================
+# RESPONSE SCHEMA
+# ============================================================================
+
+# Các trường Gemini (OpenAPI subset) chấp nhận trong response_schema
+_SCHEMA_KEYS = ("type", "format", "description", "nullable", "enum", "items", "properties", "required")
+
+def _json_schema(model: Type[BaseModel]) -> Dict[str, Any]:
+    if hasattr(model, "model_json_schema"):
+        return model.model_json_schema()
+    return model.schema()  # pydantic v1
+
+def _convert(node: Dict[str, Any], defs: Dict[str, Any]) -> Dict[str, Any]:
+    """Inline $ref, đổi anyOf[..., null] thành nullable và bỏ các key không hỗ trợ"""
+    if "$ref" in node:
+        node = {**defs[node["$ref"].rsplit("/", 1)[-1]], **{k: v for k, v in node.items() if k != "$ref"}}
+    if len(node.get("allOf", [])) == 1:
+        node = {**_convert(node["allOf"][0], defs), **{k: v for k, v in node.items() if k != "allOf"}}
+
+    nullable = False
+    if "anyOf" in node:
+        variants = [v for v in node["anyOf"] if v.get("type") != "null"]
+        nullable = len(variants) < len(node["anyOf"])
+        node = {**_convert(variants[0], defs), **{k: v for k, v in node.items() if k != "anyOf"}}
+
+    out: Dict[str, Any] = {}
+    for key in _SCHEMA_KEYS:
+        if key not in node:
+            continue
+        if key == "items":
+            out["items"] = _convert(node["items"], defs)
+        elif key == "properties":
+            out["properties"] = {name: _convert(prop, defs) for name, prop in node["properties"].items()}
+        else:
+            out[key] = node[key]
+    if "const" in node:
+        out.setdefault("type", "string")
+        out["enum"] = [node["const"]]
+    if nullable:
+        out["nullable"] = True
+    return out
+
+def response_schema(model: Type[BaseModel], exclude: Iterable[str] = ()) -> Dict[str, Any]:
+    """Sinh response_schema cho Gemini từ Pydantic model.
+
+    exclude: các trường do server tự điền (claimId, timestamp...) nên model không cần sinh.
+    """
+    raw = _json_schema(model)
+    schema = _convert(raw, raw.get("$defs", raw.get("definitions", {})))
+    excluded = set(exclude)
+    if excluded:
+        schema["properties"] = {k: v for k, v in schema["properties"].items() if k not in excluded}
+        schema["required"] = [k for k in schema.get("required", []) if k not in excluded]
+    return schema
+
+def array_schema(item_schema: Dict[str, Any]) -> Dict[str, Any]:
+    return {"type": "array", "items": item_schema}
+
+def object_schema(properties: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+# ============================================================================
+# TOLERANT PARSER
+# ============================================================================
+
+_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_SCALAR_RE = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null")
+_WHITESPACE = " \t\r\n"
+
+def strip_fences(text: str) -> str:
+    """Bỏ khối ```json ... ``` bao quanh (không dùng regex)"""
+    text = text.strip()
+    if text.startswith("```"):
+        newline = text.find("\n")
+        text = text[newline + 1:] if newline != -1 else text[3:]
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
+
+def _repair(s: str) -> Optional[Tuple[str, bool]]:
+    """Quét một lượt, trả về (tiền tố hợp lệ dài nhất của s đã được đóng ngoặc, partial).
+
+    - Giá trị đầu tiên hoàn chỉnh ở top-level: bỏ phần rác phía sau
+    - Bị cắt cụt: cắt về giá trị hoàn chỉnh gần nhất rồi đóng các ngoặc còn mở (partial=True)
+    - Dấu phẩy thừa trước '}' / ']' bị bỏ
+    Object/array là phần tử của array được giữ nguyên khối: hoặc đủ, hoặc bỏ hẳn.
+    """
+    # stack: [ký tự mở, atomic, đang chờ key]
+    stack: List[List[Any]] = []
+    removed: List[int] = []
+    safe: Optional[Tuple[int, str, int]] = None
+    pending_comma: Optional[int] = None
+
+    def closers() -> str:
+        return "".join("}" if level[0] == "{" else "]" for level in reversed(stack))
+
+    def build(end: int, suffix: str, n_removed: int) -> str:
+        pieces, start = [], 0
+        for idx in removed[:n_removed]:
+            pieces.append(s[start:idx])
+            start = idx + 1
+        pieces.append(s[start:end])
+        return "".join(pieces) + suffix
+
+    def value_done(end: int):
+        nonlocal safe, pending_comma
+        pending_comma = None
+        if stack and not stack[-1][1]:
+            safe = (end, closers(), len(removed))
+
+    i, n = 0, len(s)
+    while i < n:
+        ch = s[i]
+        if ch in _WHITESPACE or ch == ":":
+            i += 1
+        elif ch == '"':
+            match = _STRING_RE.match(s, i)
+            if match is None:
+                break
+            i = match.end()
+            if not stack:
+                return s[:i], False
+            if stack[-1][0] == "{" and stack[-1][2]:
+                stack[-1][2] = False
+            else:
+                value_done(i)
+        elif ch in "{[":
+            atomic = bool(stack) and (stack[-1][0] == "[" or stack[-1][1])
+            stack.append([ch, atomic, ch == "{"])
+            pending_comma = None
+            i += 1
+            if len(stack) == 1:
+                safe = (i, closers(), len(removed))
+        elif ch in "}]":
+            if not stack or (stack[-1][0] == "{") != (ch == "}"):
+                break
+            if pending_comma is not None:
+                removed.append(pending_comma)
+            stack.pop()
+            i += 1
+            if not stack:
+                return build(i, "", len(removed)), False
+            value_done(i)
+        elif ch == ",":
+            if not stack:
+                break
+            pending_comma = i
+            if stack[-1][0] == "{":
+                stack[-1][2] = True
+            i += 1
+        else:
+            match = _SCALAR_RE.match(s, i)
+            # Số/literal ở cuối input có thể đang bị cắt dở ("12.", "tru")
+            if match is None or match.end() == n or s[match.end()] not in _WHITESPACE + ",]}":
+                break
+            i = match.end()
+            if not stack:
+                return s[:i], False
+            value_done(i)
+
+    if safe is None:
+        return None
+    return build(*safe), True
+
+class PartialJSONError(json.JSONDecodeError):
+    """JSON bị cắt cụt: chỉ cứu được một phần (giá trị đã cứu nằm ở .value)"""
+
+    def __init__(self, text: str, value: Any):
+        super().__init__("JSON bị cắt cụt, chỉ cứu được một phần", text, len(text))
+        self.value = value
+
+def parse_json_checked(text: str) -> Tuple[Any, bool]:
+    """Như parse_json nhưng trả về (value, partial); partial=True khi JSON bị cắt cụt
+    và phần cuối đã bị bỏ. Sửa lỗi hình thức (markdown, dấu phẩy thừa, rác phía sau)
+    không tính là partial. Ném json.JSONDecodeError nếu không cứu được."""
+    text = strip_fences(text)
+    try:
+        return json.loads(text, strict=False), False
+    except json.JSONDecodeError as e:
+        error = e
+
+    starts = [idx for idx in (text.find("{"), text.find("[")) if idx != -1]
+    if not starts:
+        raise error
+    repaired = _repair(text[min(starts):])
+    if repaired is None:
+        raise error
+    try:
+        return json.loads(repaired[0], strict=False), repaired[1]
+    except json.JSONDecodeError:
+        raise error
+
+def parse_json(text: str, allow_partial: bool = True) -> Any:
+    """json.loads chịu lỗi cho output của model; ném json.JSONDecodeError nếu không cứu được.
+
+    allow_partial=False: JSON bị cắt cụt ném PartialJSONError thay vì trả về bản thiếu.
+    """
+    value, partial = parse_json_checked(text)
+    if partial and not allow_partial:
+        raise PartialJSONError(text, value)
+    return value
@@ -1,13 +1,43 @@
+import argparse
+import asyncio
+import os
+import sys
+
 import uvicorn
 from dotenv import load_dotenv
 
+# Worker (multiprocessing spawn) nạp file này với tên "__mp_main__"; đăng ký thêm tên
+# "main" để uvicorn import "main:app" dùng lại module này thay vì cấu hình app lần hai.
+if __name__ == "__mp_main__":
+    sys.modules.setdefault("main", sys.modules[__name__])
+
 # Tải .env TRƯỚC khi import config
 load_dotenv() 
 
 # Import app đã được cấu hình từ config
-from config import app 
+from config import (
+    app, ADMISSION_ENABLED, ADMISSION_ROUTE_COSTS, ADMISSION_CLIENT_CALLS_PER_MIN,
+    ADMISSION_CLIENT_BURST, ADMISSION_ROUTE_CALLS_PER_MIN, ADMISSION_ROUTE_BURST,
+    ADMISSION_MAX_WAIT, ADMISSION_MAX_QUEUE, ADMISSION_TRUST_FORWARDED,
+    TRACING_ENABLED, TRACE_SLOW_MS, TRACE_SLOW_LOG, TRACE_PROFILE_ENABLED,
+    TRACE_PROFILE_INTERVAL_MS, TRACE_PROFILE_DIR, POLICY_WARMUP_ENABLED, POLICY_WARMUP_FILES,
+    SERVER_HOST, SERVER_PORT, SERVER_WORKERS, WORKSPACE_SPILL_DIR
+)
+from starlette.middleware import Middleware
 # Import các routes từ routers
 from routers import router 
+import utils
+import services
+from batch_validation import batch_manager
+from jobs import job_engine
+from payout_store import payout_writer
+from admission import AdmissionController, AdmissionControlMiddleware
+from tracing import TracingMiddleware
+from fastapi.responses import PlainTextResponse
+import metrics
+import llm_gateway
+from llm_cache import response_cache
+from workspace_store import workspace_store
 
 # ============================================================================
 # ROOT ENDPOINT (Để ở main cho đơn giản)
@@ -23,9 +53,154 @@ async def root():
 # Thêm prefix="/api" để tất cả các route đều bắt đầu bằng /api/...
 app.include_router(router, prefix="/api")
 
+# ============================================================================
+# ADMISSION CONTROL
+# ============================================================================
+admission_controller = AdmissionController(
+    route_costs=ADMISSION_ROUTE_COSTS,
+    client_rate_per_min=ADMISSION_CLIENT_CALLS_PER_MIN,
+    client_burst=ADMISSION_CLIENT_BURST,
+    route_rate_per_min=ADMISSION_ROUTE_CALLS_PER_MIN,
+    route_burst=ADMISSION_ROUTE_BURST,
+    max_wait=ADMISSION_MAX_WAIT,
+    max_queue=ADMISSION_MAX_QUEUE
+)
+# Middleware thêm vào cuối danh sách nằm bên trong CORS (response 429 vẫn có header CORS);
+# tracing và metrics đứng ngoài admission control để đo cả thời gian xếp hàng.
+if TRACING_ENABLED:
+    app.user_middleware.append(Middleware(
+        TracingMiddleware,
+        slow_ms=TRACE_SLOW_MS,
+        slow_log=TRACE_SLOW_LOG,
+        profile_enabled=TRACE_PROFILE_ENABLED,
+        profile_interval=TRACE_PROFILE_INTERVAL_MS / 1000.0,
+        profile_dir=TRACE_PROFILE_DIR
+    ))
+app.user_middleware.append(Middleware(metrics.MetricsMiddleware))
+if ADMISSION_ENABLED:
+    app.user_middleware.append(Middleware(
+        AdmissionControlMiddleware,
+        controller=admission_controller,
+        trust_forwarded=ADMISSION_TRUST_FORWARDED
+    ))
+
+# ============================================================================
+# METRICS
+# ============================================================================
+def _gateway_gauges():
+    gateway = llm_gateway.gateway
+    return {("waiting",): gateway.waiting, ("in_flight",): gateway.in_flight}
+
+def _cache_counts():
+    if response_cache is None:
+        return {}
+    stats = response_cache.stats()
+    return {
+        (endpoint, outcome): counts[key]
+        for endpoint, counts in stats.items()
+        for outcome, key in (("hit", "hits"), ("miss", "misses"))
+    }
+
+def _cache_hit_ratio():
+    if response_cache is None:
+        return {}
+    return {
+        (endpoint,): counts["hits"] / (counts["hits"] + counts["misses"])
+        for endpoint, counts in response_cache.stats().items()
+        if counts["hits"] + counts["misses"]
+    }
+
+def _resilience_counts():
+    policy = llm_gateway.gateway.resilience
+    if policy is None:
+        return {}
+    return {("retry",): policy.retries, ("hedge_sent",): policy.hedges_sent, ("hedge_won",): policy.hedges_won}
+
+def _breaker_open():
+    policy = llm_gateway.gateway.resilience
+    return {(): 0 if policy is None or policy.breaker.state == "closed" else 1}
+
+def _queue_depths():
+    return {
+        ("llm_gateway",): llm_gateway.gateway.waiting,
+        ("admission",): admission_controller.queued,
+        ("batch_validation",): batch_manager.queue_depth,
+        ("payout_writer",): payout_writer.pending,
+    }
+
+def _admission_counts():
+    stats = admission_controller.stats()
+    return {("admitted",): stats["admitted"], ("rejected",): stats["rejected"]}
+
+metrics.registry.callback("llm_gateway_calls", "Lời gọi LLM đang chờ slot / đang chạy", _gateway_gauges, ("state",))
+metrics.registry.callback(
+    "llm_cache_requests_total", "Tra cứu LLM cache theo endpoint (hit/miss)", _cache_counts,
+    ("endpoint", "outcome"), kind="counter"
+)
+metrics.registry.callback("llm_cache_hit_ratio", "Tỉ lệ hit của LLM cache", _cache_hit_ratio, ("endpoint",))
+metrics.registry.callback(
+    "llm_resilience_events_total", "Retry và hedged request tới model", _resilience_counts, ("event",), kind="counter"
+)
+metrics.registry.callback("llm_circuit_open", "1 nếu circuit breaker đang mở/half-open", _breaker_open)
+metrics.registry.callback("queue_depth", "Độ sâu các hàng chờ", _queue_depths, ("queue",))
+metrics.registry.callback(
+    "admission_requests_total", "Quyết định của admission control", _admission_counts, ("decision",), kind="counter"
+)
+metrics.registry.callback("jobs_running", "Job nền đang chạy trong worker", lambda: {(): job_engine.running})
+metrics.registry.callback("workspaces_in_memory", "Workspace đang giữ trong RAM", lambda: {(): len(workspace_store)})
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Metrics dạng Prometheus text exposition"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.on_event("startup")
+async def startup():
+    await job_engine.resume_orphans()
+    await batch_manager.resume_orphans()
+    await workspace_store.sweep_spilled()
+    if response_cache is not None:
+        await response_cache.purge()
+    if POLICY_WARMUP_ENABLED:
+        # Cache đã được warm trước khi fork worker thì bước này chỉ đọc file vào RAM
+        await services.warm_policy_cache(POLICY_WARMUP_FILES)
+
+@app.on_event("shutdown")
+async def shutdown():
+    utils.shutdown_ingest_pool()
+    await batch_manager.shutdown()
+    await job_engine.shutdown()
+    await payout_writer.shutdown()
+
 # ============================================================================
 # MAIN
 # ============================================================================
 if __name__ == "__main__":
-    print("Khởi chạy Insurance Workspace API tại http://0.0.0.0:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Insurance Workspace API")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="số worker process")
+    args = parser.parse_args()
+
+    print(f"Khởi chạy Insurance Workspace API tại http://{args.host}:{args.port} ({args.workers} worker)")
+    if args.workers <= 1:
+        uvicorn.run(app, host=args.host, port=args.port)
+    else:
+        # Workspace phải nằm trên đĩa dùng chung thì workspaceId tạo ở worker này mới dùng được
+        # ở worker khác (batch và job đã nằm trong SQLite dùng chung)
+        if not WORKSPACE_SPILL_DIR or os.getenv("WORKSPACE_SHARED", "1") != "1":
+            parser.error("--workers > 1 cần WORKSPACE_SPILL_DIR và WORKSPACE_SHARED=1 để chia sẻ workspace")
+        # Worker là process spawn mới, đọc lại config từ biến môi trường
+        os.environ["WORKSPACE_SHARED"] = "1"
+        if POLICY_WARMUP_ENABLED:
+            # Warm-up một lần ở process cha: các worker khởi động với policy cache trên đĩa đã đầy
+            asyncio.run(services.warm_policy_cache(POLICY_WARMUP_FILES))
+            utils.shutdown_ingest_pool()
+        # Nhiều worker cần import string để mỗi process tự nạp app
+        uvicorn.run(
+            "main:app",
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            app_dir=os.path.dirname(os.path.abspath(__file__))
+        )
@@ -0,0 +1,274 @@
+# Metrics dạng Prometheus text (không cần thư viện prometheus_client).
+# Module thuần, không import config: các module khác chỉ việc import và ghi số liệu.
+import bisect
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+# Bucket latency (giây): từ thao tác cục bộ tới lời gọi model dài
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+# ============================================================================
+# METRIC TYPES
+# ============================================================================
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> (số đếm theo bucket, sum, count)
+        self._values: Dict[LabelValues, List] = {}
+
+    def observe(self, value: float, *labels: str):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for labels, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _format_labels(self.labelnames, labels, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _format_labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {count}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+class CallbackMetric(Metric):
+    """Giá trị đọc lúc scrape từ callback: trả về {label values: value}"""
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        callback: Callable[[], Dict[LabelValues, float]],
+        labelnames: Sequence[str] = (),
+        kind: str = "gauge"
+    ):
+        super().__init__(name, help_text, labelnames)
+        self.kind = kind
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        try:
+            values = self.callback()
+        except Exception as e:
+            print(f"[LOG] Metrics: không đọc được {self.name}: {e}")
+            return lines
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+# ============================================================================
+# REGISTRY
+# ============================================================================
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric '{metric.name}' đã được đăng ký")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, labelnames))
+
+    def histogram(
+        self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def callback(
+        self,
+        name: str,
+        help_text: str,
+        callback: Callable[[], Dict[LabelValues, float]],
+        labelnames: Sequence[str] = (),
+        kind: str = "gauge"
+    ) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help_text, callback, labelnames, kind))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# ============================================================================
+# METRICS CỦA ỨNG DỤNG
+# ============================================================================
+
+HTTP_REQUESTS = registry.counter(
+    "http_requests_total", "Số HTTP request theo route, method và status", ("route", "method", "status")
+)
+HTTP_LATENCY = registry.histogram(
+    "http_request_duration_seconds", "Thời gian xử lý HTTP request", ("route", "method")
+)
+STAGE_LATENCY = registry.histogram(
+    "pipeline_stage_duration_seconds", "Thời gian từng stage của pipeline/job", ("pipeline", "stage")
+)
+LLM_CALLS = registry.counter(
+    "llm_calls_total", "Số lời gọi LLM theo endpoint và kết quả (ok/error/cache_hit)", ("endpoint", "outcome")
+)
+LLM_LATENCY = registry.histogram(
+    "llm_call_duration_seconds", "Thời gian một lời gọi LLM (gồm retry/hedge)", ("endpoint",)
+)
+LLM_PROMPT_CHARS = registry.histogram(
+    "llm_prompt_chars", "Độ dài prompt (ký tự, phần text)", ("endpoint",), buckets=SIZE_BUCKETS
+)
+LLM_RESPONSE_CHARS = registry.histogram(
+    "llm_response_chars", "Độ dài response (ký tự)", ("endpoint",), buckets=SIZE_BUCKETS
+)
+LLM_TOKENS = registry.counter(
+    "llm_tokens_total", "Token theo usage_metadata của model (prompt/response)", ("endpoint", "kind")
+)
+ERRORS = registry.counter(
+    "errors_total", "Lỗi theo nơi phát sinh và loại exception", ("source", "type")
+)
+
+def observe_stage_timings(pipeline: str, timings_ms: Dict[str, float]):
+    """Ghi timings (ms) của Pipeline/Job vào histogram theo stage"""
+    for stage, ms in timings_ms.items():
+        STAGE_LATENCY.observe(ms / 1000.0, pipeline, stage)
+
+def prompt_chars(contents) -> int:
+    if isinstance(contents, str):
+        return len(contents)
+    if isinstance(contents, (list, tuple)):
+        return sum(len(part) for part in contents if isinstance(part, str))
+    return 0
+
+def record_usage(endpoint: str, response) -> None:
+    """Đọc usage_metadata (nếu SDK trả về) để đếm token thật"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    response_tokens = getattr(usage, "candidates_token_count", 0) or 0
+    if prompt_tokens:
+        LLM_TOKENS.inc(endpoint, "prompt", amount=prompt_tokens)
+    if response_tokens:
+        LLM_TOKENS.inc(endpoint, "response", amount=response_tokens)
+
+# ============================================================================
+# ASGI MIDDLEWARE
+# ============================================================================
+
+def _route_template(scope) -> str:
+    """Path thật -> template ("/api/full-analysis/{job_id}") để nhãn không bùng nổ theo ID.
+
+    Dựng lại từ path_params thay vì route.path vì route.path không chứa prefix của router.
+    """
+    if scope.get("route") is None:
+        return "unmatched"
+    path = scope["path"]
+    for name, value in scope.get("path_params", {}).items():
+        head, sep, tail = path.rpartition(str(value))
+        if sep:
+            path = f"{head}{{{name}}}{tail}"
+    return path
+
+class MetricsMiddleware:
+    """Đo latency/status mọi HTTP request, gắn nhãn theo route template (không theo path thật)"""
+
+    def __init__(self, app, exclude_paths: Iterable[str] = ("/metrics",)):
+        self.app = app
+        self.exclude_paths = set(exclude_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude_paths:
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status: Dict[str, Optional[int]] = {"code": None}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            status["code"] = status["code"] or 500
+            ERRORS.inc("http", type(e).__name__)
+            raise
+        finally:
+            route_label = _route_template(scope)
+            method = scope["method"]
+            HTTP_REQUESTS.inc(route_label, method, str(status["code"] or 500))
+            HTTP_LATENCY.observe(time.perf_counter() - started, route_label, method)
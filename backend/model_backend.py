@@ -0,0 +1,84 @@
+# Interface backend model cho LLM gateway. Gateway chỉ làm việc với ModelBackend,
+# nên có thể thay Gemini bằng stub cục bộ (model_stub) để chạy offline / đo tải.
+# Chỉ create_backend() đọc config; SDK Gemini chỉ được import khi thật sự gọi model.
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException
+
+class ModelBackend:
+    """Một lời gọi model: trả về object có .text, hoặc async iterable các chunk có .text khi stream.
+
+    endpoint: loại prompt (structure, mapping, chat...) - backend có thể dùng để chọn hành vi.
+    response_schema: schema JSON mong đợi (None nếu output là text tự do).
+    """
+
+    name = "base"
+
+    async def generate(
+        self,
+        contents: Any,
+        endpoint: str = "default",
+        response_schema: Optional[Dict[str, Any]] = None,
+        stream: bool = False
+    ) -> Any:
+        raise NotImplementedError
+
+class GeminiBackend(ModelBackend):
+    """Gọi Gemini qua google-generativeai.
+
+    SDK được import và model được tạo ở lời gọi đầu tiên: process (và từng worker)
+    khởi động nhanh, thiếu API key chỉ làm các lời gọi AI trả 503 chứ không dừng server.
+    """
+
+    def __init__(self, model_name: str, api_key: Optional[str], structured_output: bool = True):
+        self.name = model_name
+        self.api_key = api_key
+        self.structured_output = structured_output
+        self._model = None
+
+    def _get_model(self):
+        if self._model is None:
+            if not self.api_key:
+                raise HTTPException(status_code=503, detail="Dịch vụ AI chưa được cấu hình (thiếu GEMINI_API_KEY)")
+            import google.generativeai as genai
+
+            genai.configure(api_key=self.api_key)
+            self._model = genai.GenerativeModel(self.name)
+        return self._model
+
+    async def generate(
+        self,
+        contents: Any,
+        endpoint: str = "default",
+        response_schema: Optional[Dict[str, Any]] = None,
+        stream: bool = False
+    ) -> Any:
+        kwargs = {}
+        if response_schema is not None and self.structured_output:
+            kwargs["generation_config"] = {
+                "response_mime_type": "application/json",
+                "response_schema": response_schema,
+            }
+        return await self._get_model().generate_content_async(contents, stream=stream, **kwargs)
+
+def create_backend() -> ModelBackend:
+    """Backend theo MODEL_BACKEND của config"""
+    from config import (
+        MODEL_BACKEND, MODEL_NAME, GEMINI_API_KEY, LLM_STRUCTURED_OUTPUT, STUB_LATENCY, STUB_JITTER,
+        STUB_ERROR_RATE, STUB_HANG_RATE, STUB_OUTPUT_ITEMS, STUB_OUTPUT_CHARS, STUB_SEED
+    )
+
+    if MODEL_BACKEND == "stub":
+        from model_stub import InsuranceStubModel
+
+        print(f"[LOG] Model backend: stub (latency {STUB_LATENCY}s ± {STUB_JITTER}s, lỗi {STUB_ERROR_RATE:.0%})")
+        return InsuranceStubModel(
+            latency=STUB_LATENCY,
+            jitter=STUB_JITTER,
+            error_rate=STUB_ERROR_RATE,
+            hang_rate=STUB_HANG_RATE,
+            output_items=STUB_OUTPUT_ITEMS,
+            output_chars=STUB_OUTPUT_CHARS,
+            seed=STUB_SEED
+        )
+    return GeminiBackend(MODEL_NAME, GEMINI_API_KEY, structured_output=LLM_STRUCTURED_OUTPUT)
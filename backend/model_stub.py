@@ -0,0 +1,221 @@
+# Model giả lập chạy cục bộ, cùng interface ModelBackend với Gemini, dùng để
+# kiểm thử gateway / chạy offline mà không gọi API thật: latency có jitter,
+# lỗi upstream (429/503), lời gọi treo theo tỉ lệ cấu hình, và (InsuranceStubModel)
+# output hợp lệ theo từng loại prompt của services.py.
+import asyncio
+import json
+import random
+import re
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence
+
+import chunking
+from model_backend import ModelBackend
+
+class StubUpstreamError(Exception):
+    """Lỗi giả lập của upstream; .code giống google.api_core.exceptions"""
+
+    def __init__(self, code: int, message: str = ""):
+        super().__init__(message or f"Stub upstream error {code}")
+        self.code = code
+
+class StubResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+class _StubStream:
+    def __init__(self, text: str, chunk_size: int, delay: float):
+        self.text = text
+        self._chunk_size = chunk_size
+        self._delay = delay
+
+    async def __aiter__(self) -> AsyncIterator[StubResponse]:
+        for start in range(0, len(self.text), self._chunk_size):
+            await asyncio.sleep(self._delay)
+            yield StubResponse(self.text[start:start + self._chunk_size])
+
+def _prompt_text(contents: Any) -> str:
+    if isinstance(contents, str):
+        return contents
+    return "\n".join(part for part in contents if isinstance(part, str))
+
+class StubModel(ModelBackend):
+    """Thay thế Gemini với hành vi điều khiển được.
+
+    - latency ± jitter (giây) cho mỗi lời gọi
+    - error_rate: tỉ lệ lời gọi ném StubUpstreamError với mã trong error_codes
+    - hang_rate: tỉ lệ lời gọi treo (để kiểm tra deadline/hedging)
+    - responder(prompt) -> text: nội dung trả về (mặc định "OK")
+    """
+
+    name = "stub"
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        error_codes: Sequence[int] = (429, 503),
+        hang_rate: float = 0.0,
+        responder: Optional[Callable[[str], str]] = None,
+        seed: Optional[int] = None
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.hang_rate = hang_rate
+        self.responder = responder or (lambda prompt: "OK")
+        self.calls = 0
+        self._rng = random.Random(seed)
+
+    async def _simulate(self):
+        self.calls += 1
+        roll = self._rng.random()
+        if roll < self.hang_rate:
+            await asyncio.Event().wait()
+        delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+        await asyncio.sleep(delay)
+        if roll < self.hang_rate + self.error_rate:
+            raise StubUpstreamError(self._rng.choice(self.error_codes))
+
+    def respond(self, prompt: str, endpoint: str, response_schema: Optional[Dict[str, Any]]) -> str:
+        return self.responder(prompt)
+
+    async def generate(
+        self,
+        contents: Any,
+        endpoint: str = "default",
+        response_schema: Optional[Dict[str, Any]] = None,
+        stream: bool = False
+    ) -> Any:
+        await self._simulate()
+        text = self.respond(_prompt_text(contents), endpoint, response_schema)
+        if stream:
+            return _StubStream(text, chunk_size=64, delay=self.latency / 10)
+        return StubResponse(text)
+
+# ============================================================================
+# OUTPUT GIẢ LẬP THEO LOẠI PROMPT
+# ============================================================================
+
+_FILLER = (
+    "Hồ sơ ghi nhận tai nạn giao thông, người được bảo hiểm điều trị tại bệnh viện "
+    "và nộp đầy đủ hoá đơn viện phí; các điều khoản quyền lợi tai nạn được áp dụng. "
+)
+
+def filler_text(chars: int) -> str:
+    """Văn bản tiếng Việt dài đúng `chars` ký tự (cắt/lặp câu mẫu)"""
+    if chars <= 0:
+        return ""
+    repeated = _FILLER * (chars // len(_FILLER) + 1)
+    return repeated[:chars].rstrip()
+
+def sample_from_schema(schema: Dict[str, Any], items: int, text_chars: int, field: str = "") -> Any:
+    """Sinh giá trị hợp lệ với response_schema (dạng llm_json.response_schema)"""
+    if "enum" in schema:
+        return schema["enum"][0]
+    kind = str(schema.get("type", "string")).lower()
+    if kind == "object":
+        properties = schema.get("properties", {})
+        return {
+            name: sample_from_schema(sub, items, text_chars, name)
+            for name, sub in properties.items()
+        }
+    if kind == "array":
+        item_schema = schema.get("items", {"type": "string"})
+        return [sample_from_schema(item_schema, items, text_chars, field) for _ in range(items)]
+    if kind == "boolean":
+        return True
+    if kind == "integer":
+        return 1
+    if kind == "number":
+        return 0.85 if "confidence" in field.lower() else 50000000
+    return filler_text(text_chars) if text_chars else field
+
+def _between(prompt: str, start: str, end: str) -> str:
+    head, sep, tail = prompt.partition(start)
+    if not sep:
+        return ""
+    return tail.split(end, 1)[0].strip()
+
+class InsuranceStubModel(StubModel):
+    """Stub trả output đúng định dạng mà services.py mong đợi cho từng endpoint.
+
+    - output_items: số phần tử mỗi mảng JSON sinh từ schema (issues, actions...)
+    - output_chars: độ dài câu trả lời text (chat, phân tích ảnh...);
+      các trường chuỗi trong JSON dài khoảng 1/8 giá trị này
+    Kết quả chỉ phụ thuộc vào prompt (không ngẫu nhiên) nên cache/so sánh được.
+    """
+
+    def __init__(self, output_items: int = 3, output_chars: int = 800, **kwargs):
+        super().__init__(**kwargs)
+        self.output_items = output_items
+        self.output_chars = output_chars
+
+    def respond(self, prompt: str, endpoint: str, response_schema: Optional[Dict[str, Any]]) -> str:
+        handler = getattr(self, f"_respond_{endpoint}", None)
+        if handler is not None:
+            return handler(prompt)
+        if response_schema is not None:
+            value = sample_from_schema(response_schema, self.output_items, self.output_chars // 8)
+            return json.dumps(value, ensure_ascii=False)
+        return filler_text(self.output_chars)
+
+    def _respond_structure(self, prompt: str) -> str:
+        if "Text biên bản:" in prompt:
+            text, prefix = _between(prompt, "Text biên bản:", "\n\nTrả về CHÍNH XÁC"), "report_sec_"
+        else:
+            text, prefix = _between(prompt, "Text hợp đồng:", "\n\nTrả về CHÍNH XÁC"), "policy_sec_"
+        # Mỗi điều khoản/đoạn là một section; ID sẽ được services đánh lại
+        sections = [
+            {"id": f"{prefix}{index + 1}", "text": block}
+            for index, block in enumerate(chunking.split_clauses(text))
+        ]
+        return json.dumps(sections, ensure_ascii=False)
+
+    def _respond_mapping(self, prompt: str) -> str:
+        policy_ids = re.findall(r"^ID: (policy_sec_\w+)", prompt, re.MULTILINE)
+        mappings: Dict[str, str] = {}
+        current = None
+        for line in prompt.splitlines():
+            if line.startswith("ID: report_sec_"):
+                current = line[len("ID: "):].strip()
+            elif line.startswith("Điều khoản ứng viên:") and current:
+                # Chế độ hybrid: chọn ứng viên đứng đầu
+                candidates = [c.strip() for c in line.split(":", 1)[1].split(",") if c.strip()]
+                if candidates:
+                    mappings[current] = candidates[0]
+        report_ids = re.findall(r"^ID: (report_sec_\w+)", prompt, re.MULTILINE)
+        for index, report_id in enumerate(report_ids):
+            if report_id not in mappings and policy_ids:
+                mappings[report_id] = policy_ids[index % len(policy_ids)]
+        return json.dumps(mappings, ensure_ascii=False)
+
+    def _respond_customer_id(self, prompt: str) -> str:
+        match = re.search(r"\b(?:BH|INS|KH)-?\d{3,}\b", _between(prompt, "Text biên bản:", "\n\nChỉ trả về"))
+        return match.group(0) if match else "UNKNOWN"
+
+    def _respond_image_analysis(self, prompt: str) -> str:
+        return (
+            "LOẠI ẢNH: TAI NẠN GIAO THÔNG\n"
+            "HIỆN TRƯỜNG: Va chạm giữa ô tô và xe máy tại giao lộ.\n"
+            "PHƯƠNG TIỆN: 1 ô tô 4 chỗ màu trắng, 1 xe máy màu đỏ\n"
+            f"CHI TIẾT: {filler_text(self.output_chars // 2)}"
+        )
+
+    def _respond_image_compare(self, prompt: str) -> str:
+        return (
+            "**KẾT QUẢ ĐỐI CHIẾU:** TRÙNG KHỚP\n\n"
+            "**PHÂN TÍCH CHI TIẾT:**\n"
+            f"* **Điểm trùng khớp:**\n    * {filler_text(self.output_chars // 2)}\n"
+            "* **Điểm mâu thuẫn hoặc thiếu thông tin:**\n    * Không có\n\n"
+            "**KẾT LUẬN CHUNG:** Hồ sơ phù hợp với hình ảnh hiện trường."
+        )
+
+    def _respond_payout(self, prompt: str) -> str:
+        return (
+            f"PHÂN TÍCH:\n{filler_text(self.output_chars)}\n\n"
+            "expected_value: 75000000\n"
+            "recommended_range: [50000000, 100000000]\n"
+            "probability_of_success: 85%"
+        )
@@ -41,6 +41,15 @@ class PolicyFile(BaseModel):
     uploadDate: str
     structuredContent: List[ContentSection]
 
+class ClaimWorkspace(BaseModel):
+    """Dữ liệu của một hồ sơ được giữ phía server sau /upload-report"""
+    workspaceId: str
+    customerId: str
+    reportContent: List[ContentSection]
+    policyContent: List[ContentSection]
+    mappings: Dict[str, str]
+    createdAt: str
+
 class ProcessedReport(BaseModel):
     reportId: str
     reportName: str
@@ -48,11 +57,15 @@ class ProcessedReport(BaseModel):
     reportSize: int
     reportContent: List[ContentSection]
     customerId: str
+    customerIdSource: Optional[str] = None  # "pattern" | "llm" | "none"
     policy: PolicyFile
     mappings: Dict[str, str]
+    stageTimings: Optional[Dict[str, float]] = None  # ms theo từng stage của pipeline
+    workspaceId: Optional[str] = None  # dùng cho các request sau thay vì gửi lại toàn bộ nội dung
 
 class ChatRequest(BaseModel):   
     message: str
+    workspaceId: Optional[str] = None
     reportContent: Optional[List[ContentSection]] = None
     policyContent: Optional[List[ContentSection]] = None
 
@@ -106,17 +119,55 @@ class ActionPlan(BaseModel):
     nextSteps: str
     timestamp: str
 
+# Các request dưới đây có thể gửi workspaceId thay cho nội dung đầy đủ;
+# trường nào được gửi kèm sẽ ghi đè dữ liệu trong workspace.
 class ValidateClaimRequest(BaseModel):
-    reportContent: List[ContentSection]
-    policyContent: List[ContentSection]
-    mappings: Dict[str, str]
-    customerId: str
+    workspaceId: Optional[str] = None
+    reportContent: Optional[List[ContentSection]] = None
+    policyContent: Optional[List[ContentSection]] = None
+    mappings: Optional[Dict[str, str]] = None
+    customerId: Optional[str] = None
 
 class SuggestPlanRequest(BaseModel):
-    reportContent: List[ContentSection]
-    policyContent: List[ContentSection]
+    workspaceId: Optional[str] = None
+    reportContent: Optional[List[ContentSection]] = None
+    policyContent: Optional[List[ContentSection]] = None
     validationResult: Optional[ClaimValidationResult] = None
-    customerId: str
+    customerId: Optional[str] = None
+
+class BatchValidateRequest(BaseModel):
+    items: List[ValidateClaimRequest]
+
+class BatchItemStatus(BaseModel):
+    index: int
+    status: Literal["pending", "running", "done", "failed"]
+    result: Optional[ClaimValidationResult] = None
+    error: Optional[str] = None
+
+class BatchStatus(BaseModel):
+    batchId: str
+    total: int
+    pending: int
+    running: int
+    done: int
+    failed: int
+    createdAt: str
+    finishedAt: Optional[str] = None
+    items: List[BatchItemStatus]
 
 class CalculatePayoutRequest(BaseModel):
-    contract_text: str
\ No newline at end of file
+    contract_text: str
+    # Gắn kết quả với claim để tra cứu lại qua /payout-results
+    claim_id: Optional[str] = None
+
+class PayoutData(BaseModel):
+    expected_value: Optional[int] = None
+    recommended_range: Optional[str] = None
+    probability_of_success: Optional[str] = None
+
+class PayoutResult(BaseModel):
+    resultId: str
+    claimId: Optional[str] = None
+    createdAt: str
+    data: PayoutData
+    rawText: str
@@ -0,0 +1,251 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import metrics
+from config import (
+    PAYOUT_DB_PATH, PAYOUT_WRITE_BATCH, PAYOUT_FLUSH_INTERVAL, PAYOUT_MAX_PENDING, PAYOUT_SUBMIT_TIMEOUT
+)
+
+# Số lần thử ghi một batch trước khi bỏ (lỗi đĩa/khoá DB tạm thời)
+_WRITE_ATTEMPTS = 3
+
+# ============================================================================
+# PAYOUT STORE (SQLite)
+# ============================================================================
+
+class PayoutStore:
+    """Kết quả /calculate_max_payout trong SQLite, tra cứu theo claim và khoảng thời gian"""
+
+    def __init__(self, db_path: str):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS payout_results (
+                result_id TEXT PRIMARY KEY,
+                claim_id TEXT,
+                expected_value INTEGER,
+                recommended_range TEXT,
+                probability_of_success TEXT,
+                raw_text TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_payout_claim ON payout_results (claim_id, created_at)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_payout_created ON payout_results (created_at)")
+        self._conn.commit()
+
+    def insert_many(self, records: List[Dict[str, Any]]):
+        """Ghi cả batch trong một transaction (một lần fsync cho nhiều kết quả)"""
+        with self._lock:
+            self._conn.executemany(
+                """INSERT OR REPLACE INTO payout_results (result_id, claim_id, expected_value,
+                       recommended_range, probability_of_success, raw_text, created_at)
+                   VALUES (:result_id, :claim_id, :expected_value, :recommended_range,
+                           :probability_of_success, :raw_text, :created_at)""",
+                records
+            )
+            self._conn.commit()
+
+    def query(
+        self,
+        claim_id: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 100
+    ) -> List[Dict[str, Any]]:
+        conditions, params = [], []
+        if claim_id is not None:
+            conditions.append("claim_id = ?")
+            params.append(claim_id)
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("created_at < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM payout_results {where} ORDER BY created_at DESC LIMIT ?",
+                (*params, limit)
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            "resultId": row["result_id"],
+            "claimId": row["claim_id"],
+            "createdAt": datetime.fromtimestamp(row["created_at"]).isoformat(),
+            "data": {
+                "expected_value": row["expected_value"],
+                "recommended_range": row["recommended_range"],
+                "probability_of_success": row["probability_of_success"],
+            },
+            "rawText": row["raw_text"],
+        }
+
+# ============================================================================
+# BACKGROUND WRITER
+# ============================================================================
+
+class PayoutResultWriter:
+    """Đưa việc ghi kết quả ra khỏi request: request chỉ xếp hàng, task nền ghi theo batch.
+
+    Task nền gom tối đa batch_size bản ghi hoặc chờ tối đa flush_interval giây
+    rồi ghi một transaction trên thread (không chặn event loop).
+    """
+
+    def __init__(
+        self,
+        store: PayoutStore,
+        batch_size: int,
+        flush_interval: float,
+        max_pending: int,
+        submit_timeout: float = PAYOUT_SUBMIT_TIMEOUT
+    ):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_requested: Optional[asyncio.Event] = None
+        self.written = 0
+        self.dropped = 0
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _ensure_worker(self):
+        if self._task is not None and not self._task.done():
+            return
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            self._flush_requested = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(
+        self,
+        data: Dict[str, Any],
+        raw_text: str,
+        claim_id: Optional[str] = None
+    ) -> Optional[str]:
+        """Xếp hàng một kết quả để ghi, trả về resultId (không chờ ghi đĩa).
+
+        Hàng chờ đầy thì chờ tối đa submit_timeout giây để có chỗ (back-pressure);
+        quá hạn thì bỏ bản ghi và trả None, không đưa ra resultId sẽ không tra cứu được.
+        """
+        self._ensure_worker()
+        result_id = f"payout-{uuid.uuid4().hex}"
+        record = {
+            "result_id": result_id,
+            "claim_id": claim_id,
+            "expected_value": data.get("expected_value"),
+            "recommended_range": data.get("recommended_range"),
+            "probability_of_success": data.get("probability_of_success"),
+            "raw_text": raw_text,
+            "created_at": time.time(),
+        }
+        try:
+            self._queue.put_nowait(record)
+            return result_id
+        except asyncio.QueueFull:
+            pass
+        try:
+            await asyncio.wait_for(self._queue.put(record), timeout=self.submit_timeout)
+            return result_id
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            metrics.ERRORS.inc("payout_store", "QueueFull")
+            print(f"[LOG] Payout store: hàng chờ ghi đầy ({self.max_pending}) quá {self.submit_timeout}s, không lưu kết quả")
+            return None
+
+    async def _next_batch(self) -> List[Dict[str, Any]]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and not self._flush_requested.is_set():
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Chờ bản ghi tiếp theo, hết hạn gom batch, hoặc có yêu cầu flush
+            getter = asyncio.ensure_future(self._queue.get())
+            flushed = asyncio.ensure_future(self._flush_requested.wait())
+            await asyncio.wait({getter, flushed}, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            flushed.cancel()
+            if getter.done():
+                batch.append(getter.result())
+            else:
+                getter.cancel()
+        self._flush_requested.clear()
+        return batch
+
+    async def _write(self, batch: List[Dict[str, Any]]):
+        try:
+            for attempt in range(1, _WRITE_ATTEMPTS + 1):
+                try:
+                    await asyncio.to_thread(self.store.insert_many, batch)
+                    self.written += len(batch)
+                    return
+                except Exception as e:
+                    metrics.ERRORS.inc("payout_store", type(e).__name__)
+                    print(f"[LOG] Payout store: ghi {len(batch)} kết quả thất bại (lần {attempt}/{_WRITE_ATTEMPTS}): {e}")
+                    if attempt < _WRITE_ATTEMPTS:
+                        await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+            self.dropped += len(batch)
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            # shield: shutdown huỷ task giữa lúc ghi thì batch vẫn được ghi trọn
+            await asyncio.shield(self._write(batch))
+
+    async def flush(self):
+        """Chờ mọi kết quả đã xếp hàng được ghi xong (để tra cứu đọc được ngay)"""
+        if self._queue is not None and self._task is not None and not self._task.done():
+            # Ghi ngay batch đang gom thay vì chờ hết PAYOUT_FLUSH_INTERVAL
+            self._flush_requested.set()
+            await self._queue.join()
+
+    async def shutdown(self):
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def query(
+        self,
+        claim_id: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 100
+    ) -> List[Dict[str, Any]]:
+        await self.flush()
+        return await asyncio.to_thread(self.store.query, claim_id, since, until, limit)
+
+
+payout_writer = PayoutResultWriter(
+    PayoutStore(PAYOUT_DB_PATH), PAYOUT_WRITE_BATCH, PAYOUT_FLUSH_INTERVAL, PAYOUT_MAX_PENDING
+)
@@ -0,0 +1,85 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List
+
+from metrics import observe_stage_timings
+from tracing import span
+
+# ============================================================================
+# DAG PIPELINE
+# ============================================================================
+
+StageFunc = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class Stage:
+    def __init__(self, name: str, func: StageFunc, deps: List[str]):
+        self.name = name
+        self.func = func
+        self.deps = deps
+
+
+class PipelineResult:
+    def __init__(self, results: Dict[str, Any], timings: Dict[str, float]):
+        self.results = results
+        self.timings = timings  # ms theo từng stage + "total"
+
+    def __getitem__(self, name: str) -> Any:
+        return self.results[name]
+
+
+class Pipeline:
+    """Chạy các stage theo đồ thị phụ thuộc: stage nào đủ input thì chạy ngay.
+
+    Mỗi stage nhận dict kết quả của các stage nó phụ thuộc.
+    Stage lỗi sẽ huỷ các stage còn lại và ném lại exception gốc.
+    """
+
+    def __init__(self, name: str = "pipeline"):
+        self.name = name
+        self._stages: Dict[str, Stage] = {}
+
+    def add(self, name: str, func: StageFunc, deps: Iterable[str] = ()) -> "Pipeline":
+        if name in self._stages:
+            raise ValueError(f"Stage '{name}' đã tồn tại")
+        deps = list(deps)
+        for dep in deps:
+            # Chỉ cho phụ thuộc vào stage đã khai báo trước => không thể có chu trình
+            if dep not in self._stages:
+                raise ValueError(f"Stage '{name}' phụ thuộc stage chưa khai báo '{dep}'")
+        self._stages[name] = Stage(name, func, deps)
+        return self
+
+    async def run(self) -> PipelineResult:
+        results: Dict[str, Any] = {}
+        timings: Dict[str, float] = {}
+        tasks: Dict[str, asyncio.Task] = {}
+        started = time.perf_counter()
+
+        async def run_stage(stage: Stage):
+            if stage.deps:
+                await asyncio.gather(*(tasks[dep] for dep in stage.deps))
+            inputs = {dep: results[dep] for dep in stage.deps}
+            t0 = time.perf_counter()
+            try:
+                with span(f"stage.{stage.name}"):
+                    results[stage.name] = await stage.func(inputs)
+            finally:
+                timings[stage.name] = round((time.perf_counter() - t0) * 1000, 1)
+
+        for stage in self._stages.values():
+            tasks[stage.name] = asyncio.create_task(run_stage(stage))
+
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        finally:
+            timings["total"] = round((time.perf_counter() - started) * 1000, 1)
+            print(f"[LOG] {self.name}: stage timings (ms) {timings}")
+            observe_stage_timings(self.name, timings)
+
+        return PipelineResult(results, timings)
@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có khoá file, mỗi worker tự cấu trúc khi cache trống
+    fcntl = None
+
+from models import ContentSection
+from config import POLICY_CACHE_DIR, POLICY_CACHE_MAX_ENTRIES
+
+# Tăng khi đổi prompt/cách cấu trúc để bỏ qua cache cũ
+CACHE_VERSION = "1"
+
+# ============================================================================
+# POLICY CACHE (LRU trong RAM + file JSON trên đĩa)
+# ============================================================================
+
+class DegradedResult(Exception):
+    """Factory ném kèm kết quả dự phòng (vd. AI trả JSON hỏng): vẫn dùng nhưng không cache"""
+
+    def __init__(self, sections: List[ContentSection], reason: str = ""):
+        super().__init__(reason or "Kết quả cấu trúc dự phòng")
+        self.sections = sections
+
+class PolicyCache:
+    """Cache structuredContent của hợp đồng, khoá theo SHA-256 nội dung file.
+
+    File nguồn thay đổi => hash đổi => tự động cấu trúc lại, không cần xoá tay.
+    Thư mục cache dùng chung giữa các worker: khoá file theo key đảm bảo chỉ một
+    process cấu trúc một hợp đồng, các process khác chờ rồi đọc lại file.
+    """
+
+    LOCK_POLL_SECONDS = 0.1
+
+    def __init__(self, cache_dir: str, max_entries: int):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[str, List[ContentSection]]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def content_key(file_bytes: bytes, file_type: str = "policy") -> str:
+        digest = hashlib.sha256(file_bytes).hexdigest()
+        return f"{file_type}-v{CACHE_VERSION}-{digest}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _remember(self, key: str, sections: List[ContentSection]):
+        self._memory[key] = sections
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[List[ContentSection]]:
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                sections = [ContentSection(**item) for item in json.load(f)]
+        except Exception as e:
+            print(f"[LOG] Policy cache: bỏ qua file hỏng {path}: {e}")
+            return None
+
+        self._remember(key, sections)
+        return sections
+
+    def put(self, key: str, sections: List[ContentSection]):
+        self._remember(key, sections)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump([s.dict() for s in sections], f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f"[LOG] Policy cache: không ghi được xuống đĩa: {e}")
+
+    async def get_or_create(
+        self,
+        key: str,
+        factory: Callable[[], Awaitable[List[ContentSection]]]
+    ) -> List[ContentSection]:
+        """Lấy từ cache hoặc gọi factory; các request đồng thời cùng key chỉ gọi factory một lần.
+
+        Factory ném DegradedResult thì kết quả được trả về nhưng không ghi vào RAM/đĩa,
+        request sau sẽ cấu trúc lại thay vì dùng bản dự phòng mãi mãi.
+        """
+        sections = self.get(key)
+        if sections is not None:
+            print(f"[LOG] Policy cache: HIT {key[:24]}...")
+            return sections
+
+        if key in self._pending:
+            return await asyncio.shield(self._pending[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            sections = await self._create_locked(key, factory)
+            future.set_result(sections)
+            return sections
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Tránh cảnh báo "exception was never retrieved" khi không ai chờ
+            future.exception()
+            raise
+        finally:
+            del self._pending[key]
+
+    async def _create_locked(
+        self,
+        key: str,
+        factory: Callable[[], Awaitable[List[ContentSection]]]
+    ) -> List[ContentSection]:
+        lock_file = None
+        if fcntl is not None:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                lock_file = open(os.path.join(self.cache_dir, f"{key}.lock"), "a")
+            except OSError as e:
+                print(f"[LOG] Policy cache: không tạo được file khoá: {e}")
+        try:
+            if lock_file is not None:
+                # Thử khoá không chặn để không giữ thread của event loop khi worker khác đang cấu trúc
+                while True:
+                    try:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        await asyncio.sleep(self.LOCK_POLL_SECONDS)
+                # Worker khác có thể vừa ghi xong trong lúc chờ khoá
+                sections = self.get(key)
+                if sections is not None:
+                    print(f"[LOG] Policy cache: HIT {key[:24]}... (worker khác vừa cấu trúc)")
+                    return sections
+
+            print(f"[LOG] Policy cache: MISS {key[:24]}..., đang cấu trúc lại hợp đồng")
+            try:
+                sections = await factory()
+            except DegradedResult as e:
+                print(f"[LOG] Policy cache: {e}, không lưu {key[:24]}...")
+                return e.sections
+            self.put(key, sections)
+            return sections
+        finally:
+            if lock_file is not None:
+                lock_file.close()  # đóng file cũng nhả khoá
+
+
+policy_cache = PolicyCache(POLICY_CACHE_DIR, POLICY_CACHE_MAX_ENTRIES)
@@ -0,0 +1,257 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from fastapi import HTTPException
+
+# Mã lỗi upstream đáng thử lại (quota, quá tải, lỗi tạm thời)
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def error_status(error: BaseException) -> Optional[int]:
+    """Mã HTTP của lỗi từ SDK (google.api_core gắn .code) hoặc từ stub"""
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code
+    code = getattr(error, "status_code", None)
+    return code if isinstance(code, int) else None
+
+def is_retryable(error: BaseException) -> bool:
+    # HTTPException do chính server ném (vd. backend chưa cấu hình) không phải sự cố upstream
+    if isinstance(error, HTTPException):
+        return False
+    return isinstance(error, asyncio.TimeoutError) or error_status(error) in RETRYABLE_STATUS
+
+# ============================================================================
+# LATENCY TRACKER (cho hedged requests)
+# ============================================================================
+
+class LatencyTracker:
+    """Giữ cửa sổ latency gần nhất theo endpoint để ước lượng p95"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, endpoint: str, seconds: float):
+        samples = self._samples.get(endpoint)
+        if samples is None:
+            samples = self._samples[endpoint] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, endpoint: str, q: float) -> Optional[float]:
+        samples = self._samples.get(endpoint)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+# ============================================================================
+# CIRCUIT BREAKER
+# ============================================================================
+
+class CircuitBreaker:
+    """Ngắt mạch khi upstream lỗi liên tiếp.
+
+    closed -> (failure_threshold lỗi liên tiếp) -> open: từ chối ngay với 503
+    open -> (hết cooldown) -> half_open: cho một lời gọi thăm dò
+    half_open -> thành công: closed / lỗi: open lại
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, cooldown_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def retry_after(self) -> float:
+        return max(0.0, self._opened_at + self.cooldown_seconds - time.monotonic())
+
+    def before_call(self):
+        if self.failure_threshold <= 0 or self.state == self.CLOSED:
+            return
+        if self.state == self.OPEN and self.retry_after() <= 0:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return
+        raise HTTPException(
+            status_code=503,
+            detail="Dịch vụ AI đang gián đoạn, vui lòng thử lại sau",
+            headers={"Retry-After": str(max(1, round(self.retry_after())))}
+        )
+
+    def record_success(self):
+        self._failures = 0
+        self._probing = False
+        if self.state != self.CLOSED:
+            print("[LOG] Circuit breaker: upstream hoạt động lại, đóng mạch")
+        self.state = self.CLOSED
+
+    def release_probe(self):
+        """Lời gọi bị huỷ giữa chừng hoặc lỗi phía server: không kết luận được gì về upstream.
+
+        Nếu đó là lời gọi thăm dò thì trả lượt lại (về open, đã hết cooldown)
+        để lời gọi sau thăm dò tiếp thay vì kẹt ở half_open.
+        """
+        if self.state == self.HALF_OPEN and self._probing:
+            self._probing = False
+            self.state = self.OPEN
+
+    def record_failure(self):
+        self._failures += 1
+        self._probing = False
+        if self.failure_threshold <= 0:
+            return
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                print(f"[LOG] Circuit breaker: mở mạch sau {self._failures} lỗi liên tiếp")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+# ============================================================================
+# RESILIENT CALL
+# ============================================================================
+
+class ResiliencePolicy:
+    """Deadline theo endpoint, retry backoff mũ có jitter, hedged request và circuit breaker"""
+
+    def __init__(
+        self,
+        timeouts: Dict[str, float],
+        default_timeout: float,
+        max_retries: int,
+        backoff_base: float,
+        backoff_max: float,
+        hedge_enabled: bool,
+        hedge_min_delay: float,
+        breaker: CircuitBreaker,
+        latency: Optional[LatencyTracker] = None
+    ):
+        self.timeouts = timeouts
+        self.default_timeout = default_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_enabled = hedge_enabled
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = breaker
+        self.latency = latency or LatencyTracker()
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self.retries = 0
+
+    def timeout_for(self, endpoint: str) -> float:
+        return self.timeouts.get(endpoint, self.default_timeout)
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: ngẫu nhiên trong [0, min(max, base * 2^attempt)]"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def hedge_delay(self, endpoint: str) -> Optional[float]:
+        if not self.hedge_enabled:
+            return None
+        p95 = self.latency.percentile(endpoint, 0.95)
+        return None if p95 is None else max(self.hedge_min_delay, p95)
+
+    async def _hedged(self, call: Callable[[], Awaitable[Any]], endpoint: str) -> Any:
+        """Gửi thêm một bản sao nếu lời gọi đầu chậm hơn p95; lấy kết quả về trước.
+
+        Latency ghi theo từng bản: bản thắng ghi thời gian của chính nó, bản thua bị huỷ
+        ghi thời gian đã chạy (cận dưới) - không ghi min của hai bản để p95 không bị kéo thấp.
+        """
+        delay = self.hedge_delay(endpoint)
+        started: Dict[asyncio.Future, float] = {}
+
+        def launch() -> asyncio.Future:
+            task = asyncio.ensure_future(call())
+            started[task] = time.monotonic()
+            return task
+
+        primary = launch()
+        tasks = {primary}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    self.hedges_sent += 1
+                    tasks.add(launch())
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        now = time.monotonic()
+                        for attempt in (task, *tasks):
+                            self.latency.record(endpoint, now - started[attempt])
+                        if task is not primary:
+                            self.hedges_won += 1
+                        return task.result()
+                if not tasks:
+                    return done.pop().result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Chờ bản bị huỷ dừng hẳn (trả slot của gateway) trước khi trả kết quả
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def call(self, call: Callable[[], Awaitable[Any]], endpoint: str) -> Any:
+        """Chạy call() trong deadline của endpoint, thử lại lỗi tạm thời"""
+        deadline = time.monotonic() + self.timeout_for(endpoint)
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            remaining = deadline - time.monotonic()
+            try:
+                result = await asyncio.wait_for(self._hedged(call, endpoint), timeout=remaining)
+            except Exception as e:
+                if isinstance(e, HTTPException):
+                    # Lỗi phía server (hàng chờ gateway đầy, backend chưa cấu hình): upstream chưa được gọi
+                    self.breaker.release_probe()
+                    raise
+                if not is_retryable(e):
+                    # Upstream vẫn phản hồi (vd. prompt không hợp lệ): không tính là sự cố
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                wait = self.backoff(attempt)
+                if attempt >= self.max_retries or time.monotonic() + wait >= deadline:
+                    raise self._give_up(e, endpoint)
+                attempt += 1
+                self.retries += 1
+                print(f"[LOG] LLM '{endpoint}': lỗi tạm thời ({type(e).__name__}), thử lại lần {attempt} sau {wait:.2f}s")
+                await asyncio.sleep(wait)
+                continue
+            except BaseException:
+                # Bị huỷ (client ngắt, thua hedge, job bị huỷ): trả lượt thăm dò nếu đang giữ
+                self.breaker.release_probe()
+                raise
+            self.breaker.record_success()
+            return result
+
+    def _give_up(self, error: Exception, endpoint: str) -> HTTPException:
+        if isinstance(error, asyncio.TimeoutError):
+            print(f"[LOG] LLM '{endpoint}': quá deadline {self.timeout_for(endpoint)}s")
+            return HTTPException(status_code=504, detail="Dịch vụ AI phản hồi quá thời gian cho phép")
+        print(f"[LOG] LLM '{endpoint}': hết lượt thử lại ({error})")
+        return HTTPException(
+            status_code=503,
+            detail="Dịch vụ AI tạm thời không khả dụng, vui lòng thử lại sau",
+            headers={"Retry-After": str(max(1, round(self.backoff_max)))}
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "breaker": self.breaker.state,
+            "retries": self.retries,
+            "hedgesSent": self.hedges_sent,
+            "hedgesWon": self.hedges_won,
+        }
@@ -0,0 +1,191 @@
+import hashlib
+import math
+import re
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from models import ContentSection
+
+# ============================================================================
+# TOKENIZER (tiếng Việt)
+# ============================================================================
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# Hư từ xuất hiện ở mọi điều khoản, không giúp phân biệt
+VIETNAMESE_STOPWORDS = frozenset("""
+và của các có là được cho trong với theo này những một thì mà để khi đã sẽ đang
+bị tại từ về như nếu hoặc hay do vì nên các cũng rằng trên dưới ra vào lại nhưng
+sau trước đến qua thuộc bởi phải nào gì đó đây kể
+""".split())
+
+def fold_diacritics(token: str) -> str:
+    """Bỏ dấu tiếng Việt: 'bảo hiểm' -> 'bao hiem' (đ -> d)"""
+    token = token.replace("đ", "d").replace("Đ", "D")
+    decomposed = unicodedata.normalize("NFD", token)
+    return "".join(ch for ch in decomposed if unicodedata.category(ch) != "Mn")
+
+def tokenize(text: str) -> List[str]:
+    """Tách âm tiết + ghép cặp âm tiết liền kề (bigram).
+
+    Từ tiếng Việt thường gồm 2 âm tiết ("tai nạn", "bồi thường") nên bigram
+    giữ lại nghĩa mà unigram làm mất. Token được bỏ dấu để khớp cả văn bản
+    gõ không dấu.
+    """
+    text = unicodedata.normalize("NFC", text.lower())
+    syllables = [
+        fold_diacritics(word) for word in _WORD_RE.findall(text)
+        if word not in VIETNAMESE_STOPWORDS and not word.isdigit()
+    ]
+    bigrams = [f"{a}_{b}" for a, b in zip(syllables, syllables[1:])]
+    return syllables + bigrams
+
+# ============================================================================
+# TF-IDF INDEX
+# ============================================================================
+
+class TfidfIndex:
+    """Chỉ mục TF-IDF (tf log, vector chuẩn hoá L2) trên các ContentSection.
+
+    Điểm trả về là cosine similarity trong [0, 1], tính bằng phép nhân ma trận.
+    """
+
+    def __init__(self, sections: Sequence[ContentSection]):
+        self.ids = [s.id for s in sections]
+        self.texts = [s.text for s in sections]
+        docs = [Counter(tokenize(text)) for text in self.texts]
+
+        self.vocab: Dict[str, int] = {}
+        for counts in docs:
+            for term in counts:
+                self.vocab.setdefault(term, len(self.vocab))
+
+        df = np.zeros(len(self.vocab), dtype=np.float32)
+        for counts in docs:
+            for term in counts:
+                df[self.vocab[term]] += 1
+        n_docs = max(len(docs), 1)
+        self.idf = (np.log((1 + n_docs) / (1 + df)) + 1).astype(np.float32)
+        self.matrix = self._vectorize(docs)
+
+    def _vectorize(self, docs: List[Counter]) -> np.ndarray:
+        matrix = np.zeros((len(docs), len(self.vocab)), dtype=np.float32)
+        for row, counts in enumerate(docs):
+            for term, count in counts.items():
+                col = self.vocab.get(term)
+                if col is not None:
+                    matrix[row, col] = 1 + math.log(count)
+        if matrix.size:
+            matrix *= self.idf
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix /= np.where(norms == 0, 1, norms)
+        return matrix
+
+    def score_texts(self, queries: Sequence[str]) -> np.ndarray:
+        """Ma trận điểm (số query x số section)"""
+        if not self.ids or not queries:
+            return np.zeros((len(queries), len(self.ids)), dtype=np.float32)
+        query_matrix = self._vectorize([Counter(tokenize(q)) for q in queries])
+        return query_matrix @ self.matrix.T
+
+    def top_k(self, query: str, k: int) -> List[Tuple[str, float]]:
+        scores = self.score_texts([query])[0]
+        return _top_k_row(self.ids, scores, k)
+
+
+def _top_k_row(ids: List[str], scores: np.ndarray, k: int) -> List[Tuple[str, float]]:
+    if k <= 0 or not len(scores):
+        return []
+    k = min(k, len(scores))
+    idx = np.argpartition(-scores, k - 1)[:k]
+    idx = idx[np.argsort(-scores[idx], kind="stable")]
+    return [(ids[i], float(scores[i])) for i in idx]
+
+# ============================================================================
+# INDEX CACHE
+# ============================================================================
+
+_INDEX_CACHE_SIZE = 16
+_index_cache: "OrderedDict[str, TfidfIndex]" = OrderedDict()
+
+def _sections_key(sections: Sequence[ContentSection]) -> str:
+    digest = hashlib.sha256()
+    for s in sections:
+        digest.update(s.id.encode("utf-8") + b"\x1f" + s.text.encode("utf-8") + b"\x1e")
+    return digest.hexdigest()
+
+def get_index(sections: Sequence[ContentSection]) -> TfidfIndex:
+    """Lấy index đã build cho cùng bộ sections (hợp đồng ít khi đổi)"""
+    key = _sections_key(sections)
+    index = _index_cache.get(key)
+    if index is None:
+        index = TfidfIndex(sections)
+        _index_cache[key] = index
+        while len(_index_cache) > _INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    else:
+        _index_cache.move_to_end(key)
+    return index
+
+# ============================================================================
+# REPORT -> POLICY CANDIDATES
+# ============================================================================
+
+def rank_policy_candidates(
+    report_content: Sequence[ContentSection],
+    policy_content: Sequence[ContentSection],
+    top_k: int
+) -> Dict[str, List[Tuple[str, float]]]:
+    """Top-k điều khoản hợp đồng (kèm điểm) cho từng phần của biên bản"""
+    index = get_index(policy_content)
+    scores = index.score_texts([s.text for s in report_content])
+    return {
+        section.id: _top_k_row(index.ids, scores[row], top_k)
+        for row, section in enumerate(report_content)
+    }
+
+def best_mappings(
+    candidates: Dict[str, List[Tuple[str, float]]],
+    min_score: float
+) -> Dict[str, str]:
+    """Chọn điều khoản điểm cao nhất cho mỗi phần biên bản nếu vượt ngưỡng"""
+    return {
+        report_id: ranked[0][0]
+        for report_id, ranked in candidates.items()
+        if ranked and ranked[0][1] >= min_score
+    }
+
+# ============================================================================
+# CONTEXT SELECTION (RAG)
+# ============================================================================
+
+def select_sections(
+    sections: Sequence[ContentSection],
+    query: str,
+    top_k: int,
+    token_budget: int,
+    count_tokens: Callable[[str], int]
+) -> List[int]:
+    """Chọn vị trí các section liên quan nhất tới query trong giới hạn token.
+
+    Nếu không section nào khớp (câu hỏi chung chung) thì lấy theo thứ tự tài liệu.
+    Kết quả trả về theo thứ tự xuất hiện để giữ mạch văn bản.
+    """
+    if not sections:
+        return []
+    scores = get_index(sections).score_texts([query])[0]
+    ranked = [int(i) for i in np.argsort(-scores, kind="stable") if scores[i] > 0][:top_k]
+    if not ranked:
+        ranked = list(range(len(sections)))
+
+    selected, used = [], 0
+    for pos in ranked:
+        cost = count_tokens(sections[pos].text)
+        if used + cost > token_budget:
+            continue
+        selected.append(pos)
+        used += cost
+    return sorted(selected)
@@ -1,20 +1,91 @@
 import json
 import os
+from typing import List, Literal, Optional, Tuple
 from datetime import datetime
-from fastapi import APIRouter, File, UploadFile, HTTPException, Form
+from fastapi import APIRouter, File, UploadFile, HTTPException, Form, Request
+from fastapi.responses import StreamingResponse
 
 # Import models
 from models import (
     ProcessedReport, ChatRequest, ChatResponse, ClaimValidationResult,
-    ActionPlan, ValidateClaimRequest, SuggestPlanRequest, CalculatePayoutRequest
+    ActionPlan, ValidateClaimRequest, SuggestPlanRequest, CalculatePayoutRequest,
+    BatchValidateRequest, BatchStatus, PayoutResult
 )
 
 # Import services
 import services
 import utils
+import llm_gateway
+from pipeline import Pipeline
+from llm_cache import response_cache
+from workspace_store import workspace_store
+from batch_validation import batch_manager
+from jobs import job_engine
+from payout_store import payout_writer
+from tracing import TracedRoute
+import admission
+from config import ADMISSION_BATCH_ITEM_COST, ADMISSION_ROUTE_COSTS, BATCH_MAX_ITEMS, FULL_ANALYSIS_MODE
 
-# Khởi tạo Router
-router = APIRouter()
+# Khởi tạo Router (TracedRoute: span parse/endpoint/serialize cho Server-Timing)
+router = APIRouter(route_class=TracedRoute)
+
+# ============================================================================
+# HELPERS
+# ============================================================================
+
+def _sse_event(data: dict, event: Optional[str] = None) -> str:
+    """Đóng gói một Server-Sent Event"""
+    payload = json.dumps(data, ensure_ascii=False)
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {payload}\n\n"
+
+_WORKSPACE_FIELDS = ("reportContent", "policyContent", "mappings", "customerId")
+
+async def _resolve_workspace(request, required: Tuple[str, ...] = ()):
+    """Điền các trường client không gửi từ workspace phía server.
+
+    Trường nào client gửi kèm sẽ được giữ nguyên (ghi đè dữ liệu workspace).
+    """
+    updates = {}
+    if request.workspaceId:
+        workspace = await workspace_store.get(request.workspaceId)
+        if workspace is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Không tìm thấy workspace '{request.workspaceId}' (có thể đã hết hạn)"
+            )
+        updates = {
+            field: getattr(workspace, field)
+            for field in _WORKSPACE_FIELDS
+            if field in request.__fields__ and getattr(request, field) is None
+        }
+    resolved = request.copy(update=updates)
+
+    missing = [field for field in required if getattr(resolved, field) is None]
+    if missing:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Thiếu {', '.join(missing)}: gửi kèm nội dung hoặc workspaceId hợp lệ"
+        )
+    return resolved
+
+# ============================================================================
+# PIPELINES
+# ============================================================================
+
+def _build_upload_pipeline(text: str) -> Pipeline:
+    """DAG xử lý biên bản: report / customer_id / policy chạy song song, mapping chờ report + policy"""
+    return (
+        Pipeline("upload-report")
+        .add("report", lambda r: services.structure_content_with_ai(text, "report"))
+        .add("customer_id", lambda r: services.extract_customer_id(text))
+        .add("policy", lambda r: services.load_policy_document())
+        .add(
+            "mapping",
+            lambda r: services.create_mappings_with_ai(r["report"], r["policy"][1]),
+            deps=["report", "policy"]
+        )
+    )
 
 # ============================================================================
 # API ENDPOINTS
@@ -25,25 +96,30 @@ async def upload_report(file: UploadFile = File(...)):
     """Upload biên bản báo cáo và xử lý với AI"""
     try:
         file_bytes = await file.read()
-        text = utils.extract_text_from_file(file, file_bytes)
+        text = await utils.extract_text_from_file_async(file, file_bytes)
         
         if not text or len(text) < 50:
             raise HTTPException(status_code=400, detail="File không chứa đủ nội dung để xử lý")
         
-        report_content = await services.structure_content_with_ai(text, "report")
-        customer_id = await services.extract_customer_id_with_ai(text)
-        policy = await services.fetch_insurance_policy(customer_id)
-        mappings = await services.create_mappings_with_ai(report_content, policy.structuredContent)
+        result = await _build_upload_pipeline(text).run()
+        policy_size, policy_content = result["policy"]
+        customer = result["customer_id"]
+        workspace = await workspace_store.create(
+            customer.customer_id, result["report"], policy_content, result["mapping"]
+        )
         
         return ProcessedReport(
             reportId=f"report-{datetime.now().timestamp()}",
             reportName=file.filename,
             reportType=file.content_type,
             reportSize=len(file_bytes),
-            reportContent=report_content,
-            customerId=customer_id,
-            policy=policy,
-            mappings=mappings
+            reportContent=result["report"],
+            customerId=customer.customer_id,
+            customerIdSource=customer.source,
+            policy=services.build_policy_file(customer.customer_id, policy_size, policy_content),
+            mappings=result["mapping"],
+            stageTimings=result.timings,
+            workspaceId=workspace.workspaceId
         )
         
     except HTTPException:
@@ -55,6 +131,7 @@ async def upload_report(file: UploadFile = File(...)):
 @router.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """Chat với AI về hồ sơ và biên bản"""
+    request = await _resolve_workspace(request)
     try:
         response_text = await services.get_chat_response(
             request.message,
@@ -67,18 +144,63 @@ async def chat(request: ChatRequest):
             timestamp=datetime.now().isoformat()
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Lỗi /chat: {e}")
         raise HTTPException(status_code=500, detail=f"Lỗi xử lý chat: {str(e)}")
 
+@router.post("/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """Chat với AI, trả lời dạng Server-Sent Events (mỗi event là một đoạn text)"""
+    request = await _resolve_workspace(request)
+    chunks = services.stream_chat_response(
+        request.message,
+        request.reportContent,
+        request.policyContent
+    )
+    # Chờ chunk đầu tiên trước khi gửi header để lỗi (quá tải, API lỗi) vẫn trả đúng HTTP status
+    try:
+        first_chunk = await chunks.__anext__()
+    except StopAsyncIteration:
+        first_chunk = ""
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Lỗi /chat/stream: {e}")
+        raise HTTPException(status_code=500, detail=f"Lỗi xử lý chat: {str(e)}")
+
+    async def event_source():
+        try:
+            if first_chunk:
+                yield _sse_event({"delta": first_chunk})
+            async for text in chunks:
+                if await http_request.is_disconnected():
+                    print("[LOG] /chat/stream: client đã ngắt kết nối, dừng stream")
+                    break
+                yield _sse_event({"delta": text})
+            else:
+                yield _sse_event({"timestamp": datetime.now().isoformat()}, event="done")
+        except Exception as e:
+            print(f"Lỗi /chat/stream: {e}")
+            yield _sse_event({"detail": f"Lỗi xử lý chat: {str(e)}"}, event="error")
+        finally:
+            await chunks.aclose()
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.post("/verify_claim")
 async def verify_claim_with_gemini_endpoint(
     claim_text: str = Form(...),
-    file_anh: UploadFile = File(..., description="File ảnh (.jpg, .png) làm bằng chứng.")
+    file_anh: List[UploadFile] = File(..., description="Một hoặc nhiều file ảnh (.jpg, .png) làm bằng chứng.")
 ):
-    """Đối chiếu văn bản claim với bằng chứng hình ảnh"""
+    """Đối chiếu văn bản claim với bằng chứng hình ảnh (gửi lặp lại field file_anh cho nhiều ảnh)"""
     try:
-        result = await services.verify_claim_with_image(claim_text, file_anh)
+        result = await services.verify_claim_with_images(claim_text, file_anh)
         return {"ket_qua_doi_chieu": result}
     except HTTPException:
         raise
@@ -92,7 +214,7 @@ async def calculate_max_payout_from_contract_endpoint(
 ):
     """Tính toán số tiền chi trả tối đa dựa trên văn bản"""
     try:
-        result = await services.calculate_payout_from_text(request.contract_text)
+        result = await services.calculate_payout_from_text(request.contract_text, claim_id=request.claim_id)
         return result
     except HTTPException:
         raise
@@ -100,9 +222,27 @@ async def calculate_max_payout_from_contract_endpoint(
         print(f"Lỗi /calculate_max_payout: {e}")
         raise HTTPException(status_code=500, detail=f"Lỗi xử lý calculate_max_payout: {str(e)}")
 
+@router.get("/payout-results", response_model=List[PayoutResult])
+async def list_payout_results(
+    claim_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = 100
+):
+    """Tra cứu kết quả tính toán đã lưu theo claim và/hoặc khoảng thời gian [since, until), mới nhất trước"""
+    if not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="limit phải trong khoảng 1..1000")
+    return await payout_writer.query(
+        claim_id=claim_id,
+        since=since.timestamp() if since else None,
+        until=until.timestamp() if until else None,
+        limit=limit
+    )
+
 @router.post("/validate-claim", response_model=ClaimValidationResult)
 async def validate_claim(request: ValidateClaimRequest):
     """Validate claim - Kiểm tra tính hợp lệ của yêu cầu bồi thường"""
+    request = await _resolve_workspace(request, required=_WORKSPACE_FIELDS)
     try:
         validation_result = await services.validate_claim_with_ai(
             report_content=request.reportContent,
@@ -111,13 +251,69 @@ async def validate_claim(request: ValidateClaimRequest):
             customer_id=request.customerId
         )
         return validation_result
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Lỗi /validate-claim: {e}")
         raise HTTPException(status_code=500, detail=f"Lỗi validate claim: {str(e)}")
 
+@router.post("/validate-claim/batch", status_code=202)
+async def submit_validation_batch(request: BatchValidateRequest, http_request: Request):
+    """Nhận nhiều claim cùng lúc, xử lý nền bằng worker pool; trả về batchId để theo dõi"""
+    if not request.items:
+        raise HTTPException(status_code=400, detail="Batch không có claim nào")
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Batch tối đa {BATCH_MAX_ITEMS} claim")
+    # Từ chối sớm (429) trước khi đọc workspace của từng item
+    batch_manager.check_capacity(len(request.items))
+    # Middleware mới trừ chi phí cơ bản của route; phần còn lại tính theo số claim
+    await admission.charge(
+        http_request.scope,
+        ADMISSION_BATCH_ITEM_COST * len(request.items) - ADMISSION_ROUTE_COSTS.get("/api/validate-claim/batch", 0)
+    )
+
+    resolved, errors = [], {}
+    for index, item in enumerate(request.items):
+        try:
+            resolved.append(await _resolve_workspace(item, required=_WORKSPACE_FIELDS))
+        except HTTPException as e:
+            resolved.append(None)
+            errors[index] = str(e.detail)
+
+    batch_id = await batch_manager.submit(resolved, errors)
+    return {
+        "batchId": batch_id,
+        "total": len(resolved),
+        "statusUrl": f"/api/validate-claim/batch/{batch_id}",
+        "resultsUrl": f"/api/validate-claim/batch/{batch_id}/results"
+    }
+
+@router.get("/validate-claim/batch/{batch_id}", response_model=BatchStatus)
+async def get_validation_batch(batch_id: str, include_items: bool = True):
+    """Tiến độ của batch: số lượng theo trạng thái và trạng thái từng item"""
+    status = await batch_manager.status(batch_id, include_items=include_items)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy batch '{batch_id}'")
+    return status
+
+@router.get("/validate-claim/batch/{batch_id}/results")
+async def stream_validation_batch_results(batch_id: str, http_request: Request):
+    """Stream kết quả dạng NDJSON (mỗi dòng một claim) theo thứ tự hoàn thành"""
+    if not await batch_manager.exists(batch_id):
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy batch '{batch_id}'")
+
+    async def lines():
+        async for item in batch_manager.iter_completed(batch_id):
+            if await http_request.is_disconnected():
+                break
+            yield item.json() + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 @router.post("/suggest-plan", response_model=ActionPlan)
 async def suggest_plan(request: SuggestPlanRequest):
     """Suggest action plan - Đề xuất kế hoạch hành động xử lý claim"""
+    request = await _resolve_workspace(request, required=("reportContent", "policyContent", "customerId"))
     try:
         action_plan = await services.suggest_action_plan_with_ai(
             report_content=request.reportContent,
@@ -126,51 +322,140 @@ async def suggest_plan(request: SuggestPlanRequest):
             customer_id=request.customerId
         )
         return action_plan
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Lỗi /suggest-plan: {e}")
         raise HTTPException(status_code=500, detail=f"Lỗi suggest plan: {str(e)}")
 
-@router.post("/full-analysis", response_model=dict)
-async def full_analysis(request: ValidateClaimRequest):
-    """Full analysis - Phân tích toàn diện claim (validation + action plan)"""
-    try:
-        # Step 1: Validate claim
-        validation_result = await services.validate_claim_with_ai(
+async def _full_analysis_job(payload: dict, progress) -> dict:
+    """Job nền: validation rồi action plan, báo tiến độ theo từng stage"""
+    request = ValidateClaimRequest(**payload["request"])
+    mode = payload.get("mode", "two_call")
+
+    if mode == "combined":
+        await progress("analysis", 10)
+        validation_result, action_plan = await services.validate_and_plan_with_ai(
             report_content=request.reportContent,
             policy_content=request.policyContent,
             mappings=request.mappings,
-            customer_id=request.customerId
+            customer_id=request.customerId,
+            claim_id=payload["claimId"]
         )
-        
-        # Step 2: Generate action plan based on validation
-        action_plan = await services.suggest_action_plan_with_ai(
-            report_content=request.reportContent,
-            policy_content=request.policyContent,
-            validation_result=validation_result,
-            customer_id=request.customerId
-        )
-        
         return {
+            "mode": mode,
             "validation": validation_result.dict(),
             "actionPlan": action_plan.dict(),
             "timestamp": datetime.now().isoformat()
         }
-        
+
+    await progress("validation", 10)
+    validation_result = await services.validate_claim_with_ai(
+        report_content=request.reportContent,
+        policy_content=request.policyContent,
+        mappings=request.mappings,
+        customer_id=request.customerId,
+        claim_id=payload["claimId"]
+    )
+
+    await progress("plan", 55)
+    action_plan = await services.suggest_action_plan_with_ai(
+        report_content=request.reportContent,
+        policy_content=request.policyContent,
+        validation_result=validation_result,
+        customer_id=request.customerId
+    )
+    
+    return {
+        "mode": mode,
+        "validation": validation_result.dict(),
+        "actionPlan": action_plan.dict(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+job_engine.register("full_analysis", _full_analysis_job)
+
+def _job_view(job: dict) -> dict:
+    return {
+        "jobId": job["job_id"],
+        "claimId": job["claim_id"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "progress": job["progress"],
+        "stages": job["stages"],
+        "attempts": job["attempts"],
+        "maxAttempts": job["max_attempts"],
+        "error": job["error"],
+        "createdAt": datetime.fromtimestamp(job["created_at"]).isoformat(),
+        "lastUpdated": datetime.fromtimestamp(job["updated_at"]).isoformat(),
+    }
+
+@router.post("/full-analysis", status_code=202)
+async def full_analysis(
+    request: ValidateClaimRequest,
+    mode: Optional[Literal["two_call", "combined"]] = None
+):
+    """Full analysis - Phân tích toàn diện claim (validation + action plan), chạy nền.
+
+    Trả về jobId ngay; theo dõi qua /full-analysis/{job_id} hoặc /claim-status/{claim_id}.
+    mode mặc định theo FULL_ANALYSIS_MODE; "combined" chỉ dùng một lời gọi AI.
+    """
+    mode = mode or FULL_ANALYSIS_MODE
+    request = await _resolve_workspace(request, required=_WORKSPACE_FIELDS)
+    claim_id = f"claim-{request.customerId}-{int(datetime.now().timestamp())}"
+    try:
+        job_id = await job_engine.submit(
+            "full_analysis", claim_id, {"claimId": claim_id, "mode": mode, "request": request.dict()}
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Lỗi /full-analysis: {e}")
         raise HTTPException(status_code=500, detail=f"Lỗi full analysis: {str(e)}")
 
-@router.get("/claim-status/{claim_id}")
-async def get_claim_status(claim_id: str):
-    """(Demo) Lấy trạng thái hiện tại của claim"""
     return {
+        "jobId": job_id,
         "claimId": claim_id,
-        "status": "pending_review",
-        "lastUpdated": datetime.now().isoformat(),
-        "assignedTo": "Claims Team",
-        "progress": 45,
-        "message": "Đang chờ bổ sung tài liệu"
+        "mode": mode,
+        "status": "queued",
+        "statusUrl": f"/api/full-analysis/{job_id}",
+        "claimStatusUrl": f"/api/claim-status/{claim_id}"
+    }
+
+@router.get("/full-analysis/{job_id}")
+async def get_full_analysis(job_id: str):
+    """Trạng thái job full analysis; có kết quả khi status = succeeded"""
+    job = await job_engine.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy job '{job_id}'")
+    return {**_job_view(job), "result": job["result"]}
+
+@router.delete("/full-analysis/{job_id}")
+async def cancel_full_analysis(job_id: str):
+    """Huỷ job full analysis đang chờ hoặc đang chạy"""
+    if not await job_engine.cancel(job_id):
+        raise HTTPException(status_code=409, detail="Job không tồn tại hoặc đã kết thúc")
+    return {"jobId": job_id, "status": "cancelled"}
+
+@router.get("/claim-status/{claim_id:path}")
+async def get_claim_status(claim_id: str):
+    """Lấy trạng thái xử lý hiện tại của claim (theo job gần nhất)"""
+    job = await job_engine.latest_for_claim(claim_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Không có job nào cho claim '{claim_id}'")
+
+    view = _job_view(job)
+    messages = {
+        "queued": "Đang chờ xử lý",
+        "running": f"Đang xử lý bước '{job['stage']}'",
+        "succeeded": "Đã hoàn tất phân tích",
+        "failed": f"Phân tích thất bại: {job['error']}",
+        "cancelled": "Đã huỷ",
     }
+    view["message"] = messages.get(job["status"], job["status"])
+    if job["status"] == "succeeded" and job["result"]:
+        view["claimStatus"] = job["result"]["validation"]["status"]
+    return view
 
 @router.get("/health")
 async def health_check():
@@ -185,5 +470,7 @@ async def health_check():
             "validate-claim",
             "suggest-plan",
             "full-analysis"
-        ]
+        ],
+        "llmCache": response_cache.stats() if response_cache else None,
+        "llmResilience": llm_gateway.gateway.resilience.stats() if llm_gateway.gateway.resilience else None
     }
\ No newline at end of file
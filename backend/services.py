@@ -1,19 +1,34 @@
+import asyncio
 import json
 import re
-import io
 import os
 from datetime import datetime
 from fastapi import HTTPException, UploadFile
-from PIL import Image
-from typing import List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 # Import từ các module nội bộ
-from config import model
+import llm_gateway
 from models import (
     ContentSection, PolicyFile, ClaimValidationResult, ValidationIssue,
     ActionPlan, ActionItem, ClaimStatus, ValidationIssueType, ActionPriority
 )
-from utils import extract_text_from_docx
+from utils import extract_text_async, estimate_tokens
+from ingestion import DOCX_MIME
+from image_processing import prepare_image
+from llm_json import (
+    PartialJSONError, array_schema, object_schema, parse_json, parse_json_checked, response_schema
+)
+from policy_cache import DegradedResult, PolicyCache, policy_cache
+from customer_id_extractor import CustomerIdResult, customer_id_extractor
+from payout_store import payout_writer
+from tracing import span
+import retrieval
+import chunking
+from config import (
+    MAPPING_MODE, MAPPING_TOP_K, MAPPING_MIN_SCORE, CHAT_TOP_K, CHAT_CONTEXT_TOKEN_BUDGET,
+    IMAGE_MAX_EDGE, IMAGE_MAX_FILES, IMAGE_ANALYSIS_CONCURRENCY,
+    STRUCTURE_CHUNK_TOKENS, STRUCTURE_MAX_PARALLEL, POLICY_FILE_PATH
+)
 from prompts import (
     PROMPT_PHAN_TICH_ANH, PROMPT_SO_SANH_KEYPOINTS, PROMPT_TINH_TOAN_TOI_DA
 )
@@ -22,18 +37,89 @@ from prompts import (
 # UTILITY FUNCTIONS (AI-POWERED)
 # ============================================================================
 
-def _clean_json_response(response_text: str) -> str:
-    """Helper để dọn dẹp markdown (```json) khỏi response của AI"""
-    response_text = re.sub(r'^```json\s*', '', response_text)
-    response_text = re.sub(r'^```\s*', '', response_text)
-    response_text = re.sub(r'\s*```$', '', response_text)
-    return response_text.strip()
+# Schema cho các output JSON (model chỉ sinh các trường nội dung,
+# claimId/planId/timestamp do server điền)
+STRUCTURE_SCHEMA = array_schema(response_schema(ContentSection))
+VALIDATION_SCHEMA = response_schema(ClaimValidationResult, exclude=("claimId", "timestamp"))
+ACTION_PLAN_SCHEMA = response_schema(ActionPlan, exclude=("planId", "claimId", "timestamp"))
+ANALYSIS_SCHEMA = object_schema({"validation": VALIDATION_SCHEMA, "actionPlan": ACTION_PLAN_SCHEMA})
 
-async def structure_content_with_ai(text: str, file_type: str) -> List[ContentSection]:
-    """Sử dụng Gemini AI để cấu trúc nội dung thành các sections"""
-    
+def _json_validator(schema: Dict[str, Any]):
+    """Validator cho llm_gateway: output phải parse được, đúng kiểu và đủ trường required.
+
+    Chỉ output qua được validator mới được cache (output hỏng không bị trả lại suốt TTL).
+    """
+    expected = list if schema.get("type") == "array" else dict
+
+    def validate(text: str) -> bool:
+        data = parse_json(text, allow_partial=False)
+        return isinstance(data, expected) and (
+            expected is list or all(key in data for key in schema.get("required", []))
+        )
+    return validate
+
+_validate_structure = _json_validator(STRUCTURE_SCHEMA)
+_validate_mapping = _json_validator({"type": "object"})  # key của mapping là ID động
+_validate_validation = _json_validator(VALIDATION_SCHEMA)
+_validate_plan = _json_validator(ACTION_PLAN_SCHEMA)
+_validate_analysis = _json_validator(ANALYSIS_SCHEMA)
+
+def _validate_image_analysis(text: str) -> bool:
+    return "LOẠI ẢNH" in text.upper()
+
+def _validate_image_compare(text: str) -> bool:
+    return "KẾT LUẬN" in text.upper()
+
+# Nhãn có thể được in đậm/nghiêng kiểu markdown: "**expected_value:** 75000000"
+_LABEL_DECOR = r"[*_ \t]*"
+_EXPECTED_VALUE_RE = re.compile(rf"expected_value{_LABEL_DECOR}[:=]{_LABEL_DECOR}([\d.,]+)", re.IGNORECASE)
+_RECOMMENDED_RANGE_RE = re.compile(rf"recommended_range{_LABEL_DECOR}[:=]{_LABEL_DECOR}(.+)", re.IGNORECASE)
+_PROBABILITY_RE = re.compile(rf"probability_of_success{_LABEL_DECOR}[:=]{_LABEL_DECOR}([\d.]+%?)", re.IGNORECASE)
+
+def _extract_payout(raw_text: str) -> Dict[str, Any]:
+    """Trích expected_value / recommended_range / probability_of_success (None nếu thiếu)"""
+    expected_value_match = _EXPECTED_VALUE_RE.search(raw_text)
+    recommended_range_match = _RECOMMENDED_RANGE_RE.search(raw_text)
+    probability_match = _PROBABILITY_RE.search(raw_text)
+
+    expected_value_num = None
+    if expected_value_match:
+        try:
+            expected_value_str = expected_value_match.group(1).replace(",", "").split(".")[0]
+            expected_value_num = int(expected_value_str)
+        except ValueError:
+            expected_value_num = None
+
+    recommended_range_str = None
+    if recommended_range_match:
+        # Bỏ dấu đóng in đậm/nghiêng còn dính ở cuối dòng
+        recommended_range_str = recommended_range_match.group(1).strip().strip("*_").strip()
+
+    return {
+        "expected_value": expected_value_num,
+        "recommended_range": recommended_range_str,
+        "probability_of_success": probability_match.group(1) if probability_match else None
+    }
+
+def _validate_payout(text: str) -> bool:
+    # Output bị cắt thường mất các trường cuối: thiếu trường nào thì không cache
+    # (response vẫn trả về với trường None như trước)
+    return all(value is not None for value in _extract_payout(text).values())
+
+def _section_id(file_type: str, index: int) -> str:
+    """ID section theo thứ tự toàn văn bản: report_sec_A..Z, AA..; policy_sec_1, 2, ..."""
+    if file_type != "report":
+        return f"policy_sec_{index + 1}"
+    letters = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return f"report_sec_{letters}"
+
+def _structure_prompt(text: str, file_type: str, part: str = "") -> str:
     if file_type == "report":
-        prompt = f"""Phân tích biên bản báo cáo tai nạn bảo hiểm sau và chia thành các phần logic.
+        return f"""Phân tích biên bản báo cáo tai nạn bảo hiểm sau và chia thành các phần logic.{part}
         
 Yêu cầu:
 - Mỗi phần nên chứa thông tin về: mô tả tai nạn, thông tin khách hàng, điều trị, chi phí, hoặc hồ sơ đính kèm
@@ -48,8 +134,8 @@ Trả về CHÍNH XÁC JSON array với format (không thêm markdown, chỉ JSO
   {{"id": "report_sec_A", "text": "nội dung phần A"}},
   {{"id": "report_sec_B", "text": "nội dung phần B"}}
 ]"""
-    else:  # policy
-        prompt = f"""Phân tích hợp đồng bảo hiểm sau và chia thành các điều khoản chính.
+    # policy
+    return f"""Phân tích hợp đồng bảo hiểm sau và chia thành các điều khoản chính.{part}
 
 Yêu cầu:
 - Mỗi điều khoản nên rõ ràng về quyền lợi, trách nhiệm, hoặc điều kiện
@@ -65,36 +151,75 @@ Trả về CHÍNH XÁC JSON array với format (không thêm markdown, chỉ JSO
   {{"id": "policy_sec_2", "text": "nội dung điều khoản 2"}}
 ]"""
 
+async def _structure_chunk(text: str, file_type: str, part: str = "") -> Tuple[List[str], bool]:
+    """Cấu trúc một chunk, trả về (text của từng section theo thứ tự, có phải bản dự phòng không)"""
+    response_text = ""
     try:
-        response = model.generate_content(prompt)
-        response_text = _clean_json_response(response.text)
-        
-        sections_data = json.loads(response_text)
+        response_text = await llm_gateway.generate(
+            _structure_prompt(text, file_type, part), endpoint="structure", response_schema=STRUCTURE_SCHEMA,
+            validate=_validate_structure
+        )
         
-        sections = []
-        for idx, section_data in enumerate(sections_data):
-            if isinstance(section_data, dict) and "id" in section_data and "text" in section_data:
-                sections.append(ContentSection(**section_data))
-            else:
-                prefix = "report_sec_" if file_type == "report" else "policy_sec_"
-                sections.append(ContentSection(
-                    id=f"{prefix}{chr(65+idx) if file_type == 'report' else idx+1}",
-                    text=str(section_data) if isinstance(section_data, str) else json.dumps(section_data)
-                ))
+        # JSON bị cắt sẽ mất các điều khoản cuối: dùng fallback (giữ đủ nội dung) thay vì bản thiếu
+        sections_data = parse_json(response_text, allow_partial=False)
+        if not isinstance(sections_data, list):
+            raise json.JSONDecodeError("Response không phải JSON array", response_text, 0)
         
-        return sections
+        return ([
+            str(section_data["text"]) if isinstance(section_data, dict) and "text" in section_data
+            else str(section_data) if isinstance(section_data, str)
+            else json.dumps(section_data, ensure_ascii=False)
+            for section_data in sections_data
+        ], False)
         
     except json.JSONDecodeError as e:
         print(f"JSON Parse Error: {e}")
         print(f"Response text: {response_text}")
-        paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
-        prefix = "report_sec_" if file_type == "report" else "policy_sec_"
-        return [
-            ContentSection(
-                id=f"{prefix}{chr(65+i) if file_type == 'report' else i+1}",
-                text=p
-            ) for i, p in enumerate(paragraphs[:10])
-        ]
+        # Fallback: giữ toàn bộ nội dung chunk, mỗi điều khoản/đoạn là một section
+        return chunking.split_clauses(text), True
+
+async def structure_content_with_ai(text: str, file_type: str) -> List[ContentSection]:
+    """Sử dụng Gemini AI để cấu trúc nội dung thành các sections"""
+    sections, _ = await structure_content_checked(text, file_type)
+    return sections
+
+async def structure_content_checked(text: str, file_type: str) -> Tuple[List[ContentSection], bool]:
+    """Như structure_content_with_ai, kèm cờ degraded nếu có chunk phải dùng fallback.
+
+    Văn bản dài hơn STRUCTURE_CHUNK_TOKENS được chia theo ranh giới điều khoản
+    và cấu trúc song song từng chunk (map), sau đó ghép lại và đánh lại ID
+    liên tục cho toàn văn bản (reduce).
+    """
+    chunks = chunking.split_into_chunks(text, STRUCTURE_CHUNK_TOKENS, estimate_tokens)
+
+    try:
+        if len(chunks) == 1:
+            results = [await _structure_chunk(text, file_type)]
+        else:
+            print(f"[LOG] Structure ({file_type}): ~{estimate_tokens(text)} token, chia {len(chunks)} chunk")
+            semaphore = asyncio.Semaphore(STRUCTURE_MAX_PARALLEL)
+
+            async def run(idx: int, chunk: str) -> Tuple[List[str], bool]:
+                async with semaphore:
+                    part = f"\n(Đây là phần {idx + 1}/{len(chunks)} của văn bản.)"
+                    return await _structure_chunk(chunk, file_type, part)
+
+            tasks = [asyncio.create_task(run(i, c)) for i, c in enumerate(chunks)]
+            try:
+                results = await asyncio.gather(*tasks)
+            except BaseException:
+                # Một chunk lỗi (vd. 503/504 từ gateway) thì huỷ các chunk còn lại để trả slot
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+
+        texts = [t for chunk_sections, _ in results for t in chunk_sections if t.strip()]
+        degraded = any(chunk_degraded for _, chunk_degraded in results)
+        return [ContentSection(id=_section_id(file_type, i), text=t) for i, t in enumerate(texts)], degraded
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"AI Error: {e}")
         raise HTTPException(status_code=500, detail=f"Lỗi xử lý AI: {str(e)}")
@@ -116,8 +241,7 @@ Text biên bản:
 Chỉ trả về MÃ KHÁCH HÀNG duy nhất, không giải thích. Nếu không tìm thấy, trả về "UNKNOWN"."""
 
     try:
-        response = model.generate_content(prompt)
-        customer_id = response.text.strip()
+        customer_id = (await llm_gateway.generate(prompt, endpoint="customer_id")).strip()
         
         if customer_id and customer_id != "UNKNOWN" and len(customer_id) > 3:
             return customer_id
@@ -126,37 +250,114 @@ Chỉ trả về MÃ KHÁCH HÀNG duy nhất, không giải thích. Nếu không
         print(f"Error extracting customer ID: {e}")
         return "UNKNOWN"
 
-async def fetch_insurance_policy(customer_id: str) -> PolicyFile:
-    """Giả lập lấy hồ sơ bảo hiểm từ database"""
+async def load_policy_document(file_path: str = POLICY_FILE_PATH) -> Tuple[int, List[ContentSection]]:
+    """Đọc và cấu trúc file hợp đồng (không phụ thuộc mã khách hàng).
+
+    Trả về (kích thước file, danh sách sections) để có thể chạy song song
+    với bước trích xuất mã khách hàng.
+    """
     # Trong thực tế, bạn sẽ query DB tại đây
     # Giả lập đọc file
-    file_path = "policy_backend.docx" # Đảm bảo file này tồn tại
     if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail=f"Không tìm thấy file policy_backend.docx")
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy file {os.path.basename(file_path)}")
 
     with open(file_path, "rb") as f:
         file_bytes = f.read()
-    policy_text = extract_text_from_docx(file_bytes)
 
-    structured_content = await structure_content_with_ai(policy_text, "policy")
-    
+    async def structure_policy() -> List[ContentSection]:
+        # Span này chỉ xuất hiện khi cache miss
+        with span("policy.structure"):
+            policy_text = await extract_text_async(DOCX_MIME, file_path, file_bytes)
+            sections, degraded = await structure_content_checked(policy_text, "policy")
+            if degraded:
+                # Bản chia điều khoản cục bộ: dùng cho request này nhưng không cache vĩnh viễn
+                raise DegradedResult(sections, "AI trả JSON hỏng, dùng bản chia điều khoản dự phòng")
+            return sections
+
+    # Hợp đồng hầu như không đổi: chỉ gọi AI khi nội dung file thay đổi
+    with span("policy.load", bytes=len(file_bytes)):
+        structured_content = await policy_cache.get_or_create(
+            PolicyCache.content_key(file_bytes, "policy"), structure_policy
+        )
+    return len(file_bytes), structured_content
+
+async def warm_policy_cache(file_paths: List[str]) -> int:
+    """Cấu trúc sẵn các hợp đồng đã biết vào policy cache, trả về số hợp đồng đã sẵn sàng.
+
+    Cache nằm trên đĩa nên chạy một lần trước khi khởi động các worker là đủ;
+    trong từng worker, lời gọi này chỉ nạp file cache vào RAM.
+    Lỗi (thiếu file, AI không khả dụng) chỉ được ghi log: request đầu sẽ thử lại.
+    """
+    async def warm(path: str) -> bool:
+        try:
+            _, sections = await load_policy_document(path)
+            print(f"[LOG] Warm-up: {path} sẵn sàng ({len(sections)} điều khoản)")
+            return True
+        except HTTPException as e:
+            print(f"[LOG] Warm-up: bỏ qua {path}: {e.detail}")
+        except Exception as e:
+            print(f"[LOG] Warm-up: bỏ qua {path}: {e}")
+        return False
+
+    results = await asyncio.gather(*(warm(path) for path in file_paths))
+    return sum(results)
+
+def build_policy_file(customer_id: str, size: int, structured_content: List[ContentSection]) -> PolicyFile:
+    """Gắn hợp đồng đã cấu trúc với mã khách hàng"""
     return PolicyFile(
         id=f"policy-{customer_id}",
         name=f"Hợp đồng bảo hiểm - {customer_id}.pdf",
         type="application/pdf",
-        size=len(file_bytes),
+        size=size,
         uploadDate=datetime.now().isoformat(),
         structuredContent=structured_content
     )
 
+async def extract_customer_id(text: str) -> CustomerIdResult:
+    """Trích xuất mã khách hàng: thử regex trước, chỉ gọi AI khi kết quả chưa chắc chắn"""
+    result = customer_id_extractor.extract(text)
+    if result is not None:
+        print(f"[LOG] Customer ID: '{result.customer_id}' qua pattern (score={result.confidence:.2f})")
+        return result
+
+    customer_id = await extract_customer_id_with_ai(text)
+    source = "llm" if customer_id != "UNKNOWN" else "none"
+    print(f"[LOG] Customer ID: '{customer_id}' qua {source}")
+    return CustomerIdResult(customer_id, source, 0.0, customer_id_extractor.candidates(text))
+
+async def fetch_insurance_policy(customer_id: str) -> PolicyFile:
+    """Giả lập lấy hồ sơ bảo hiểm từ database"""
+    size, structured_content = await load_policy_document()
+    return build_policy_file(customer_id, size, structured_content)
+
 async def create_mappings_with_ai(
     report_content: List[ContentSection],
     policy_content: List[ContentSection]
 ) -> dict:
-    """Tạo mapping giữa biên bản và hợp đồng sử dụng AI"""
-    
-    report_text = "\n\n".join([f"ID: {s.id}\nNội dung: {s.text}" for s in report_content])
-    policy_text = "\n\n".join([f"ID: {s.id}\nNội dung: {s.text}" for s in policy_content])
+    """Tạo mapping giữa biên bản và hợp đồng.
+
+    Chỉ mục TF-IDF cục bộ xếp hạng điều khoản cho từng phần biên bản; tuỳ MAPPING_MODE:
+    - "local": dùng luôn kết quả xếp hạng, không gọi AI
+    - "hybrid": AI chỉ chọn trong top-k ứng viên của mỗi phần (prompt nhỏ hơn nhiều)
+    - "llm": gửi toàn bộ hợp đồng như trước
+    """
+    candidates = retrieval.rank_policy_candidates(report_content, policy_content, MAPPING_TOP_K)
+    local_mappings = retrieval.best_mappings(candidates, MAPPING_MIN_SCORE)
+    if MAPPING_MODE == "local" or not report_content or not policy_content:
+        return local_mappings
+
+    if MAPPING_MODE == "hybrid":
+        candidate_ids = {pid for ranked in candidates.values() for pid, _ in ranked}
+        prompt_policy = [s for s in policy_content if s.id in candidate_ids]
+        report_text = "\n\n".join([
+            f"ID: {s.id}\nNội dung: {s.text}\nĐiều khoản ứng viên: "
+            + ", ".join(pid for pid, _ in candidates[s.id])
+            for s in report_content
+        ])
+    else:
+        prompt_policy = policy_content
+        report_text = "\n\n".join([f"ID: {s.id}\nNội dung: {s.text}" for s in report_content])
+    policy_text = "\n\n".join([f"ID: {s.id}\nNội dung: {s.text}" for s in prompt_policy])
     
     prompt = f"""Bạn là chuyên gia bảo hiểm. Hãy phân tích và tạo liên kết giữa các phần trong BIÊN BẢN và ĐIỀU KHOẢN BẢO HIỂM.
 
@@ -177,10 +378,10 @@ Trả về CHÍNH XÁC JSON object với format (không thêm markdown, chỉ JS
 Chỉ tạo mapping cho các cặp có liên quan rõ ràng."""
 
     try:
-        response = model.generate_content(prompt)
-        response_text = _clean_json_response(response.text)
+        # Key của mapping là ID động nên không có response_schema, chỉ dùng parser chịu lỗi
+        response_text = await llm_gateway.generate(prompt, endpoint="mapping", validate=_validate_mapping)
         
-        mappings = json.loads(response_text)
+        mappings = parse_json(response_text)
         
         valid_report_ids = {s.id for s in report_content}
         valid_policy_ids = {s.id for s in policy_content}
@@ -192,23 +393,177 @@ Chỉ tạo mapping cho các cặp có liên quan rõ ràng."""
         
         return filtered_mappings
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error creating mappings: {e}")
-        mappings = {}
-        for i, report_sec in enumerate(report_content[:len(policy_content)]):
-            mappings[report_sec.id] = policy_content[i].id
-        return mappings
+        print(f"Error creating mappings: {e}, dùng mapping từ chỉ mục cục bộ")
+        return local_mappings
 
 # ============================================================================
 # CORE AI SERVICES (Validation, Plan, Chat)
 # ============================================================================
 
-async def get_chat_response(
-    message: str, 
-    report_content: Optional[List[ContentSection]], 
+VALIDATION_RULES = """QUAN TRỌNG:
+1. Khi tạo "issues", trường "issueType" PHẢI LÀ MỘT TRONG CÁC GIÁ TRỊ SAU:
+   "missing_document", "exclusion_clause", "coverage_limit", "expired_policy", "incomplete_info", "conflicting_info"
+2. Khi tạo "status" cho mỗi issue: "pass", "fail", "pending".
+3. Khi tạo "status" (tổng), PHẢI LÀ MỘT TRONG CÁC GIÁ TRỊ: "approved", "rejected", "needs_more_info", "pending_review".
+4. **BẮT BUỘC**: Phải tạo ít nhất 8-12 checklist items, bao gồm CẢ những mục đã PASS và những mục FAIL/PENDING."""
+
+VALIDATION_JSON_FORMAT = """{
+  "status": "approved/rejected/needs_more_info/pending_review",
+  "isValid": true/false,
+  "confidence": 0.85,
+  "estimatedAmount": 50000000,
+  "maxCoverageAmount": 100000000,
+  "issues": [
+    {
+      "issueType": "incomplete_info",
+      "severity": "critical/warning/info",
+      "status": "pass/fail/pending",
+      "checklistItem": "Tên mục kiểm tra cụ thể (VD: Giấy ra viện)",
+      "description": "Mô tả chi tiết về mục này - tìm thấy gì, thiếu gì, hoặc vấn đề gì",
+      "affectedSections": ["report_sec_A", "policy_sec_1"],
+      "recommendation": "Hành động cần thực hiện (VD: Yêu cầu bổ sung giấy ra viện có đóng dấu bệnh viện)"
+    }
+  ],
+  "summary": "Tóm tắt tổng quan: X/Y tiêu chí đạt, Z tiêu chí cần bổ sung, A tiêu chí không đạt"
+}"""
+
+ACTION_PLAN_JSON_FORMAT = """{
+  "status": "approved/rejected/needs_more_info/pending_review",
+  "actions": [
+    {
+      "id": "action_1",
+      "title": "Xác minh thông tin khách hàng",
+      "description": "Chi tiết cần làm gì",
+      "priority": "high/medium/low",
+      "dueDate": "2024-12-31",
+      "assignee": "Claims Team/Medical Review/Finance",
+      "relatedSections": ["report_sec_A", "policy_sec_1"],
+      "estimatedTime": "2 hours"
+    }
+  ],
+  "totalEstimatedTime": "1 day",
+  "criticalPath": ["action_1", "action_3"],
+  "nextSteps": "Tóm tắt các bước tiếp theo"
+}"""
+
+def _parse_validation_result(result: dict, claim_id: str) -> ClaimValidationResult:
+    """Dựng ClaimValidationResult từ JSON của AI, bỏ qua các issue không hợp lệ"""
+    validated_issues = []
+    for issue_data in result.get("issues", []):
+        if "status" not in issue_data:
+            issue_data["status"] = "pending"
+        if "checklistItem" not in issue_data:
+            issue_data["checklistItem"] = issue_data.get("description", "Mục kiểm tra")[:50]
+        
+        try:
+            validated_issues.append(ValidationIssue(**issue_data))
+        except Exception as e:
+            print(f"⚠️ Skipping invalid issue: {e} | Data: {issue_data}")
+            continue
+    
+    return ClaimValidationResult(
+        claimId=claim_id,
+        status=ClaimStatus(result.get("status", "pending_review")),
+        isValid=result.get("isValid", False),
+        confidence=result.get("confidence", 0.5),
+        estimatedAmount=result.get("estimatedAmount"),
+        maxCoverageAmount=result.get("maxCoverageAmount"),            
+        issues=validated_issues,
+        summary=result.get("summary", "Đang xử lý đánh giá"),
+        timestamp=datetime.now().isoformat()
+    )
+
+def _validation_fallback(claim_id: str, error: Exception) -> ClaimValidationResult:
+    """Kết quả validation mặc định khi AI lỗi (confidence = 0, chờ review)"""
+    return ClaimValidationResult(
+        claimId=claim_id,
+        status=ClaimStatus.PENDING_REVIEW,
+        isValid=False,
+        confidence=0.0,
+        estimatedAmount=None,
+        maxCoverageAmount=None,
+        issues=[
+            ValidationIssue(
+                issueType=ValidationIssueType.INCOMPLETE_INFO,
+                severity="critical",
+                status="fail",
+                checklistItem="Lỗi hệ thống",
+                description=f"Lỗi xử lý validation: {str(error)}",
+                affectedSections=[],
+                recommendation="Vui lòng thử lại hoặc liên hệ support"
+            )
+        ],
+        summary="Không thể hoàn thành validation do lỗi hệ thống",
+        timestamp=datetime.now().isoformat()
+    )
+
+def _parse_action_plan(result: dict, claim_id: str) -> ActionPlan:
+    """Dựng ActionPlan từ JSON của AI"""
+    actions = [ActionItem(**action) for action in result.get("actions", [])]
+    
+    return ActionPlan(
+        planId=f"plan-{int(datetime.now().timestamp())}",
+        claimId=claim_id,
+        status=ClaimStatus(result.get("status", "pending_review")),
+        actions=actions,
+        totalEstimatedTime=result.get("totalEstimatedTime", "Unknown"),
+        criticalPath=result.get("criticalPath", []),
+        nextSteps=result.get("nextSteps", "Đang xử lý"),
+        timestamp=datetime.now().isoformat()
+    )
+
+def _action_plan_fallback(claim_id: str, report_content: List[ContentSection]) -> ActionPlan:
+    """Kế hoạch mặc định khi AI không trả về kết quả dùng được"""
+    return ActionPlan(
+        planId=f"plan-{int(datetime.now().timestamp())}",
+        claimId=claim_id,
+        status=ClaimStatus.PENDING_REVIEW,
+        actions=[
+            ActionItem(
+                id="action_1",
+                title="Review documents",
+                description="Kiểm tra tất cả tài liệu đính kèm",
+                priority=ActionPriority.HIGH,
+                dueDate=None,
+                assignee="Claims Team",
+                relatedSections=[s.id for s in report_content[:2]],
+                estimatedTime="1 hour"
+            )
+        ],
+        totalEstimatedTime="1 hour",
+        criticalPath=["action_1"],
+        nextSteps="Bắt đầu review tài liệu",
+        timestamp=datetime.now().isoformat()
+    )
+
+def _select_chat_context(
+    message: str,
+    report_content: Optional[List[ContentSection]],
+    policy_content: Optional[List[ContentSection]]
+) -> Tuple[List[ContentSection], List[ContentSection]]:
+    """Chỉ giữ các section liên quan tới câu hỏi, trong ngân sách CHAT_CONTEXT_TOKEN_BUDGET"""
+    report_content = report_content or []
+    policy_content = policy_content or []
+    sections = report_content + policy_content
+    selected = retrieval.select_sections(
+        sections, message, CHAT_TOP_K, CHAT_CONTEXT_TOKEN_BUDGET, estimate_tokens
+    )
+    n_report = len(report_content)
+    print(f"[LOG] Chat: chọn {len(selected)}/{len(sections)} sections làm bối cảnh")
+    return (
+        [sections[i] for i in selected if i < n_report],
+        [sections[i] for i in selected if i >= n_report],
+    )
+
+def _build_chat_prompt(
+    message: str,
+    report_content: Optional[List[ContentSection]],
     policy_content: Optional[List[ContentSection]]
 ) -> str:
-    """Chat với AI về hồ sơ và biên bản"""
+    report_content, policy_content = _select_chat_context(message, report_content, policy_content)
     context_parts = []
         
     if report_content:
@@ -221,7 +576,7 @@ async def get_chat_response(
     
     context = "\n\n".join(context_parts)
     
-    prompt = f"""Bạn là một AI Teammate (đồng nghiệp AI) chuyên về nghiệp vụ bảo hiểm, 
+    return f"""Bạn là một AI Teammate (đồng nghiệp AI) chuyên về nghiệp vụ bảo hiểm, 
 đang hỗ trợ cho một nhân viên thẩm định (con người).
 
 BỐI CẢNH HỒ SƠ:
@@ -240,16 +595,33 @@ QUY TẮC ĐỊNH DẠNG (RẤT QUAN TRỌNG):
 
 Hãy trả lời ngay bây giờ."""
 
-    response = model.generate_content(prompt)
-    return response.text
+async def get_chat_response(
+    message: str, 
+    report_content: Optional[List[ContentSection]], 
+    policy_content: Optional[List[ContentSection]]
+) -> str:
+    """Chat với AI về hồ sơ và biên bản"""
+    prompt = _build_chat_prompt(message, report_content, policy_content)
+    return await llm_gateway.generate(prompt, endpoint="chat")
+
+def stream_chat_response(
+    message: str,
+    report_content: Optional[List[ContentSection]],
+    policy_content: Optional[List[ContentSection]]
+) -> AsyncIterator[str]:
+    """Giống get_chat_response nhưng trả từng đoạn text ngay khi model sinh ra"""
+    prompt = _build_chat_prompt(message, report_content, policy_content)
+    return llm_gateway.stream(prompt, endpoint="chat")
 
 async def validate_claim_with_ai(
     report_content: List[ContentSection],
     policy_content: List[ContentSection],
     mappings: dict,
-    customer_id: str
+    customer_id: str,
+    claim_id: Optional[str] = None
 ) -> ClaimValidationResult:
     """Validate claim sử dụng AI để kiểm tra tính hợp lệ và tạo checklist"""
+    claim_id = claim_id or f"claim-{customer_id}-{int(datetime.now().timestamp())}"
     
     report_text = "\n".join([f"[{s.id}] {s.text}" for s in report_content])
     policy_text = "\n".join([f"[{s.id}] {s.text}" for s in policy_content])
@@ -272,88 +644,24 @@ Nhiệm vụ:
 3. Đưa ra **kết quả cuối cùng** gồm trạng thái, độ tin cậy, số tiền ước tính, và các vấn đề.
 4. Phản hồi **duy nhất bằng JSON hợp lệ**, không dùng markdown.
 
-QUAN TRỌNG:
-1. Khi tạo "issues", trường "issueType" PHẢI LÀ MỘT TRONG CÁC GIÁ TRỊ SAU:
-   "missing_document", "exclusion_clause", "coverage_limit", "expired_policy", "incomplete_info", "conflicting_info"
-2. Khi tạo "status" cho mỗi issue: "pass", "fail", "pending".
-3. Khi tạo "status" (tổng), PHẢI LÀ MỘT TRONG CÁC GIÁ TRỊ: "approved", "rejected", "needs_more_info", "pending_review".
-4. **BẮT BUỘC**: Phải tạo ít nhất 8-12 checklist items, bao gồm CẢ những mục đã PASS và những mục FAIL/PENDING.
+{VALIDATION_RULES}
 
 Trả về JSON với format (không thêm markdown):
-{{
-  "status": "approved/rejected/needs_more_info/pending_review",
-  "isValid": true/false,
-  "confidence": 0.85,
-  "estimatedAmount": 50000000,
-  "maxCoverageAmount": 100000000,
-  "issues": [
-    {{
-      "issueType": "incomplete_info",
-      "severity": "critical/warning/info",
-      "status": "pass/fail/pending",
-      "checklistItem": "Tên mục kiểm tra cụ thể (VD: Giấy ra viện)",
-      "description": "Mô tả chi tiết về mục này - tìm thấy gì, thiếu gì, hoặc vấn đề gì",
-      "affectedSections": ["report_sec_A", "policy_sec_1"],
-      "recommendation": "Hành động cần thực hiện (VD: Yêu cầu bổ sung giấy ra viện có đóng dấu bệnh viện)"
-    }}
-  ],
-  "summary": "Tóm tắt tổng quan: X/Y tiêu chí đạt, Z tiêu chí cần bổ sung, A tiêu chí không đạt"
-}}"""
+{VALIDATION_JSON_FORMAT}"""
 
     try:
-        response = model.generate_content(prompt)
-        response_text = _clean_json_response(response.text)
-        
-        result = json.loads(response_text)
-        
-        validated_issues = []
-        for issue_data in result.get("issues", []):
-            if "status" not in issue_data:
-                issue_data["status"] = "pending"
-            if "checklistItem" not in issue_data:
-                issue_data["checklistItem"] = issue_data.get("description", "Mục kiểm tra")[:50]
-            
-            try:
-                validated_issues.append(ValidationIssue(**issue_data))
-            except Exception as e:
-                print(f"⚠️ Skipping invalid issue: {e} | Data: {issue_data}")
-                continue
-        
-        return ClaimValidationResult(
-            claimId=f"claim-{customer_id}-{int(datetime.now().timestamp())}",
-            status=ClaimStatus(result.get("status", "pending_review")),
-            isValid=result.get("isValid", False),
-            confidence=result.get("confidence", 0.5),
-            estimatedAmount=result.get("estimatedAmount"),
-            maxCoverageAmount=result.get("maxCoverageAmount"),            
-            issues=validated_issues,
-            summary=result.get("summary", "Đang xử lý đánh giá"),
-            timestamp=datetime.now().isoformat()
+        response_text = await llm_gateway.generate(
+            prompt, endpoint="validation", response_schema=VALIDATION_SCHEMA, validate=_validate_validation
         )
         
+        # Validation bị cắt có thể mất issues mà vẫn "approved": từ chối, dùng kết quả chờ review
+        return _parse_validation_result(parse_json(response_text, allow_partial=False), claim_id)
+        
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error validating claim: {e}")
-        return ClaimValidationResult(
-            claimId=f"claim-{customer_id}-{int(datetime.now().timestamp())}",
-            status=ClaimStatus.PENDING_REVIEW,
-            isValid=False,
-            confidence=0.0,
-            estimatedAmount=None,
-            maxCoverageAmount=None,
-            issues=[
-                ValidationIssue(
-                    issueType=ValidationIssueType.INCOMPLETE_INFO,
-                    severity="critical",
-                    status="fail",
-                    checklistItem="Lỗi hệ thống",
-                    description=f"Lỗi xử lý validation: {str(e)}",
-                    affectedSections=[],
-                    recommendation="Vui lòng thử lại hoặc liên hệ support"
-                )
-            ],
-            summary="Không thể hoàn thành validation do lỗi hệ thống",
-            timestamp=datetime.now().isoformat()
-        )
+        return _validation_fallback(claim_id, e)
 
 async def suggest_action_plan_with_ai(
     report_content: List[ContentSection],
@@ -394,120 +702,204 @@ Nhiệm vụ: Tạo action plan với các bước cụ thể để xử lý cla
 - Related sections
 
 Trả về JSON với format (không thêm markdown):
-{{
-  "status": "approved/rejected/needs_more_info/pending_review",
-  "actions": [
-    {{
-      "id": "action_1",
-      "title": "Xác minh thông tin khách hàng",
-      "description": "Chi tiết cần làm gì",
-      "priority": "high/medium/low",
-      "dueDate": "2024-12-31",
-      "assignee": "Claims Team/Medical Review/Finance",
-      "relatedSections": ["report_sec_A", "policy_sec_1"],
-      "estimatedTime": "2 hours"
-    }}
-  ],
-  "totalEstimatedTime": "1 day",
-  "criticalPath": ["action_1", "action_3"],
-  "nextSteps": "Tóm tắt các bước tiếp theo"
-}}"""
+{ACTION_PLAN_JSON_FORMAT}"""
 
     try:
-        response = model.generate_content(prompt)
-        response_text = _clean_json_response(response.text)
-        
-        result = json.loads(response_text)
+        response_text = await llm_gateway.generate(
+            prompt, endpoint="plan", response_schema=ACTION_PLAN_SCHEMA, validate=_validate_plan
+        )
         
-        actions = [ActionItem(**action) for action in result.get("actions", [])]
         claim_id = validation_result.claimId if validation_result else f"claim-{customer_id}-{int(datetime.now().timestamp())}"
+        return _parse_action_plan(parse_json(response_text), claim_id)
         
-        return ActionPlan(
-            planId=f"plan-{int(datetime.now().timestamp())}",
-            claimId=claim_id,
-            status=ClaimStatus(result.get("status", "pending_review")),
-            actions=actions,
-            totalEstimatedTime=result.get("totalEstimatedTime", "Unknown"),
-            criticalPath=result.get("criticalPath", []),
-            nextSteps=result.get("nextSteps", "Đang xử lý"),
-            timestamp=datetime.now().isoformat()
-        )
-        
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error suggesting action plan: {e}")
         claim_id = validation_result.claimId if validation_result else f"claim-{customer_id}-{int(datetime.now().timestamp())}"
-        
-        return ActionPlan(
-            planId=f"plan-{int(datetime.now().timestamp())}",
-            claimId=claim_id,
-            status=ClaimStatus.PENDING_REVIEW,
-            actions=[
-                ActionItem(
-                    id="action_1",
-                    title="Review documents",
-                    description="Kiểm tra tất cả tài liệu đính kèm",
-                    priority=ActionPriority.HIGH,
-                    dueDate=None,
-                    assignee="Claims Team",
-                    relatedSections=[s.id for s in report_content[:2]],
-                    estimatedTime="1 hour"
-                )
-            ],
-            totalEstimatedTime="1 hour",
-            criticalPath=["action_1"],
-            nextSteps="Bắt đầu review tài liệu",
-            timestamp=datetime.now().isoformat()
+        return _action_plan_fallback(claim_id, report_content)
+
+async def validate_and_plan_with_ai(
+    report_content: List[ContentSection],
+    policy_content: List[ContentSection],
+    mappings: dict,
+    customer_id: str,
+    claim_id: Optional[str] = None
+) -> Tuple[ClaimValidationResult, ActionPlan]:
+    """Chế độ combined: một lời gọi AI trả về cả validation lẫn action plan.
+
+    Biên bản và hợp đồng chỉ được gửi một lần thay vì hai lần như
+    validate_claim_with_ai + suggest_action_plan_with_ai.
+    """
+    claim_id = claim_id or f"claim-{customer_id}-{int(datetime.now().timestamp())}"
+    
+    report_text = "\n".join([f"[{s.id}] {s.text}" for s in report_content])
+    policy_text = "\n".join([f"[{s.id}] {s.text}" for s in policy_content])
+    mappings_text = json.dumps(mappings, indent=2)
+    
+    prompt = f"""Bạn là chuyên gia thẩm định và quản lý claims bảo hiểm. Hãy đánh giá yêu cầu bồi thường sau và lập kế hoạch xử lý:
+
+BIÊN BẢN BÁO CÁO:
+{report_text}
+
+HỢP ĐỒNG BẢO HIỂM:
+{policy_text}
+
+LIÊN KẾT GIỮA BIÊN BẢN VÀ HỢP ĐỒNG:
+{mappings_text}
+
+Nhiệm vụ:
+PHẦN 1 - VALIDATION ("validation"):
+1. Xác định xem **claim có hợp lệ hay không**.
+2. Kiểm tra **mức độ đầy đủ của thông tin**.
+3. Đưa ra **kết quả cuối cùng** gồm trạng thái, độ tin cậy, số tiền ước tính, và các vấn đề.
+
+PHẦN 2 - ACTION PLAN ("actionPlan"):
+Dựa trên chính kết quả validation ở PHẦN 1, tạo action plan với các bước cụ thể để xử lý claim.
+Mỗi action cần title rõ ràng, description chi tiết, priority (high/medium/low), estimated time và related sections.
+
+{VALIDATION_RULES}
+
+Phản hồi **duy nhất bằng một JSON object hợp lệ**, không dùng markdown, với format:
+{{
+  "validation": {VALIDATION_JSON_FORMAT},
+  "actionPlan": {ACTION_PLAN_JSON_FORMAT}
+}}"""
+
+    try:
+        response_text = await llm_gateway.generate(
+            prompt, endpoint="analysis", response_schema=ANALYSIS_SCHEMA, validate=_validate_analysis
         )
+        result, partial = parse_json_checked(response_text)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error in combined analysis: {e}")
+        return _validation_fallback(claim_id, e), _action_plan_fallback(claim_id, report_content)
+
+    try:
+        if partial:
+            # Không biết phần nào bị cắt: không tin validation (action plan thiếu bước vẫn dùng được)
+            raise PartialJSONError(response_text, result)
+        validation_result = _parse_validation_result(result["validation"], claim_id)
+    except Exception as e:
+        print(f"Error parsing combined validation: {e}")
+        validation_result = _validation_fallback(claim_id, e)
+
+    try:
+        action_plan = _parse_action_plan(result["actionPlan"], claim_id)
+    except Exception as e:
+        print(f"Error parsing combined action plan: {e}")
+        action_plan = _action_plan_fallback(claim_id, report_content)
+
+    return validation_result, action_plan
 
 # ============================================================================
 # EXTRA AI SERVICES (Image, Calculation)
 # ============================================================================
 
-async def verify_claim_with_image(claim_text: str, image_file: UploadFile) -> str:
-    """Service cho endpoint /verify_claim"""
-    
-    image_data = await image_file.read()
+async def _prepare_image(image_data: bytes, label: str) -> Tuple[Any, str, str]:
+    """Giải mã/thu nhỏ ảnh là việc nặng CPU: chạy ngoài event loop"""
     try:
-        img = Image.open(io.BytesIO(image_data))
-        if img.mode == 'RGBA' or img.mode == 'P':
-             img = img.convert('RGB')
+        return await asyncio.to_thread(prepare_image, image_data, IMAGE_MAX_EDGE)
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Không thể xử lý file ảnh: {e}")
+        raise HTTPException(status_code=400, detail=f"Không thể xử lý {label}: {e}")
+
+def _dedup_key(image_hash: str, phash: str) -> str:
+    """Ảnh trùng perceptual hash trong cùng request được phân tích một lần.
+
+    Ảnh gần như đồng màu cho dHash toàn 0/1 dù khác nhau: khi đó chỉ gộp nếu trùng pixel.
+    """
+    if phash.strip("0") and phash.strip("f"):
+        return f"phash:{phash}"
+    return f"sha256:{image_hash}"
+
+async def _analyze_image(img, image_hash: str, label: str, semaphore: asyncio.Semaphore) -> str:
+    """Bước 1 cho một ảnh: PROMPT_PHAN_TICH_ANH (giới hạn bởi semaphore)"""
+    async with semaphore:
+        # Cache theo SHA-256 của pixel: chỉ đúng ảnh đó mới dùng lại kết quả phân tích
+        print(f"[LOG] Bước 1: Phân tích {label} {img.size[0]}x{img.size[1]} (sha256 {image_hash[:16]})...")
+        return await llm_gateway.generate(
+            [PROMPT_PHAN_TICH_ANH, img], endpoint="image_analysis", content_id=f"sha256:{image_hash}",
+            validate=_validate_image_analysis
+        )
+
+async def verify_claim_with_images(claim_text: str, image_files: List[UploadFile]) -> str:
+    """Service cho endpoint /verify_claim (nhiều ảnh bằng chứng).
+
+    Bước 1 chạy song song cho từng ảnh (tối đa IMAGE_ANALYSIS_CONCURRENCY ảnh
+    cùng lúc), sau đó gộp tất cả báo cáo vào một lần đối chiếu duy nhất.
+    Các ảnh trùng perceptual hash trong cùng request chỉ được phân tích một lần.
+    """
+    if not image_files:
+        raise HTTPException(status_code=400, detail="Cần ít nhất một file ảnh")
+    if len(image_files) > IMAGE_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"Tối đa {IMAGE_MAX_FILES} ảnh mỗi yêu cầu")
+
+    images = [(await f.read(), f"ảnh {i} ({f.filename})") for i, f in enumerate(image_files, 1)]
 
     try:
-        # --- BƯỚC 1: Phân tích ảnh ---
-        print("[LOG] Bước 1: Gửi ảnh cho Gemini để phân tích...")
-        prompt_parts_1 = [PROMPT_PHAN_TICH_ANH, img]
-        response_1 = model.generate_content(prompt_parts_1)
-        image_analysis_result = response_1.text
+        # --- BƯỚC 1: Phân tích từng ảnh song song ---
+        print(f"[LOG] Bước 1: Phân tích {len(images)} ảnh...")
+        prepared = await asyncio.gather(*(_prepare_image(data, label) for data, label in images))
+
+        semaphore = asyncio.Semaphore(IMAGE_ANALYSIS_CONCURRENCY)
+        tasks: Dict[str, asyncio.Task] = {}  # khoá trùng lặp -> task phân tích
+        dedup_keys = [_dedup_key(image_hash, phash) for _, image_hash, phash in prepared]
+        for (img, image_hash, _), (_, label), key in zip(prepared, images, dedup_keys):
+            if key in tasks:
+                print(f"[LOG] Bước 1: {label} trùng ảnh đã gửi trong request ({key}), dùng chung kết quả")
+                continue
+            tasks[key] = asyncio.create_task(_analyze_image(img, image_hash, label, semaphore))
+        try:
+            reports = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+        except BaseException:
+            # Một ảnh lỗi thì huỷ các ảnh còn lại thay vì để chúng tiếp tục gọi model,
+            # và chờ chúng dừng hẳn trước khi request kết thúc
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        image_reports = [reports[key] for key in dedup_keys]
         print("[LOG] Bước 1: Đã có kết quả phân tích ảnh.")
 
         # --- BƯỚC 2: So sánh, đối chiếu ---
         print("[LOG] Bước 2: Gửi claim và phân tích ảnh để đối chiếu...")
-        
+
+        image_analysis_result = "\n\n".join(
+            f"### {label.capitalize()}\n{report.strip()}"
+            for (_, label), report in zip(images, image_reports)
+        )
         comparison_input_text = f"""
         --- HỒ SƠ YÊU CẦU TỪ KHÁCH HÀNG ---
         {claim_text}
         --- HẾT HỒ SƠ ---
         
-        --- BÁO CÁO TỰ ĐỘNG TỪ ẢNH HIỆN TRƯỜNG ---
+        --- BÁO CÁO TỰ ĐỘNG TỪ {len(images)} ẢNH HIỆN TRƯỜNG ---
         {image_analysis_result}
         --- HẾT BÁO CÁO ---
         """
         
         prompt_parts_2 = [PROMPT_SO_SANH_KEYPOINTS, comparison_input_text]
-        response_2 = model.generate_content(prompt_parts_2)
-        comparison_result = response_2.text
+        comparison_result = await llm_gateway.generate(
+            prompt_parts_2, endpoint="image_compare", validate=_validate_image_compare
+        )
         print("[LOG] Bước 2: Đã có kết quả đối chiếu.")
         
         return comparison_result.strip()
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"[LỖI API GEMINI] {e}")
         raise HTTPException(status_code=500, detail=f"Lỗi khi gọi API Gemini: {str(e)}")
 
+async def verify_claim_with_image(claim_text: str, image_file: UploadFile) -> str:
+    """Giữ tương thích: đối chiếu với một ảnh duy nhất"""
+    return await verify_claim_with_images(claim_text, [image_file])
+
 
-async def calculate_payout_from_text(contract_text: str) -> dict:
+async def calculate_payout_from_text(contract_text: str, claim_id: Optional[str] = None) -> dict:
     """Service cho endpoint /calculate_max_payout"""
     
     if not contract_text.strip():
@@ -517,48 +909,27 @@ async def calculate_payout_from_text(contract_text: str) -> dict:
         print("[LOG] /calculate_max_payout/: Gửi hồ sơ cho Gemini để phân tích...")
         
         prompt = PROMPT_TINH_TOAN_TOI_DA.format(text=contract_text)
-        response = model.generate_content(prompt)
-        raw_text = response.text.strip()
+        raw_text = (await llm_gateway.generate(prompt, endpoint="payout", validate=_validate_payout)).strip()
         print("[LOG] /calculate_max_payout/: Đã có kết quả tính toán.")
 
         # --- Trích xuất dữ liệu ---
-        expected_value_match = re.search(r"expected_value\s*[:=]\s*([\d.,]+)", raw_text, re.IGNORECASE)
-        recommended_range_match = re.search(r"recommended_range\s*[:=]\s*(.+)", raw_text, re.IGNORECASE)
-        probability_match = re.search(r"probability_of_success\s*[:=]\s*([\d.]+%?)", raw_text, re.IGNORECASE)
-
-        expected_value_num = None
-        if expected_value_match:
-            try:
-                expected_value_str = expected_value_match.group(1).replace(",", "").split(".")[0]
-                expected_value_num = int(expected_value_str)
-            except ValueError:
-                expected_value_num = None
-
-        recommended_range_str = recommended_range_match.group(1).strip() if recommended_range_match else None
-        probability_str = probability_match.group(1) if probability_match else None
-
-        data = {
-            "expected_value": expected_value_num,
-            "recommended_range": recommended_range_str,
-            "probability_of_success": probability_str
-        }
-
-        # --- Lưu file JSON ---
-        os.makedirs("outputs", exist_ok=True)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_path = f"outputs/ket_qua_tinh_toan_{timestamp}.json"
-
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        data = _extract_payout(raw_text)
 
-        print(f"[LOG] /calculate_max_payout/: ✅ Đã lưu file JSON -> {output_path}")
+        # --- Lưu kết quả (ghi nền theo batch, không chặn request) ---
+        # resultId = None nếu hàng chờ ghi quá tải: kết quả vẫn trả về nhưng không tra cứu lại được
+        result_id = await payout_writer.submit(data, raw_text, claim_id=claim_id)
+        if result_id:
+            print(f"[LOG] /calculate_max_payout/: ✅ Đã xếp hàng lưu kết quả -> {result_id}")
 
         return {
             "message": "✅ Tính toán thành công.",
+            "resultId": result_id,
             "ket_qua_tinh_toan_tu_hop_dong": raw_text,
             "du_lieu_trich_xuat": data
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"[LỖI API GEMINI] {e}")
         raise HTTPException(status_code=500, detail=f"Lỗi khi gọi API Gemini: {str(e)}")
\ No newline at end of file
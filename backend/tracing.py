@@ -0,0 +1,310 @@
+# Tracing nhẹ theo request: span lồng nhau qua contextvars (đi theo cả các
+# asyncio task con), trả về header Server-Timing, ghi trace chậm ra JSONL và
+# profiler lấy mẫu bật theo từng request. Module thuần, không import config.
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from fastapi.routing import APIRoute
+
+# ============================================================================
+# SPANS
+# ============================================================================
+
+class Trace:
+    def __init__(self, method: str, path: str):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.closed = False
+        self.root = Span("request", self)
+
+class Span:
+    __slots__ = ("name", "trace", "start", "end", "children", "attrs")
+
+    def __init__(self, name: str, trace: Trace, attrs: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace = trace
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.children: List["Span"] = []
+        self.attrs = attrs or {}
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.perf_counter()
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end if self.end is not None else time.perf_counter()
+        return (end - self.start) * 1000
+
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        data = {
+            "name": self.name,
+            "startMs": round((self.start - origin) * 1000, 2),
+            "durationMs": round(self.duration_ms, 2),
+        }
+        if self.attrs:
+            data["attrs"] = self.attrs
+        if self.children:
+            data["children"] = [child.to_dict(origin) for child in self.children]
+        return data
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+def current_trace() -> Optional[Trace]:
+    span_ = _current_span.get()
+    return span_.trace if span_ is not None else None
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Optional[Span]]:
+    """Mở span con của span hiện tại; không làm gì nếu không ở trong request đang trace.
+
+    Task nền (batch worker, job) có thể giữ context của request đã xong:
+    trace đã đóng thì bỏ qua để không giữ span mãi trong bộ nhớ.
+    """
+    parent = _current_span.get()
+    if parent is None or parent.trace.closed:
+        yield None
+        return
+    child = Span(name, parent.trace, attrs)
+    parent.children.append(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+    finally:
+        child.finish()
+        _current_span.reset(token)
+
+def open_span(name: str, **attrs) -> Optional[Span]:
+    """Span con không trở thành span hiện tại; người gọi tự .finish().
+
+    Dùng trong async generator: giữa các lần yield generator có thể chạy ở
+    context khác nên không set/reset contextvar qua yield được.
+    """
+    parent = _current_span.get()
+    if parent is None or parent.trace.closed:
+        return None
+    child = Span(name, parent.trace, attrs)
+    parent.children.append(child)
+    return child
+
+def annotate(**attrs):
+    """Gắn thuộc tính vào span hiện tại (vd. cache="hit")"""
+    current = _current_span.get()
+    if current is not None and not current.trace.closed:
+        current.attrs.update(attrs)
+
+def _iter_spans(root: Span) -> Iterator[Span]:
+    stack = list(reversed(root.children))
+    while stack:
+        item = stack.pop()
+        yield item
+        stack.extend(reversed(item.children))
+
+def server_timing(trace: Trace, limit: int = 20) -> str:
+    """Gộp span theo tên: "total;dur=..., llm.structure;dur=...;desc="x2"" """
+    totals: Dict[str, float] = {}
+    counts: Counter = Counter()
+    for item in _iter_spans(trace.root):
+        if item.end is None:
+            continue
+        totals[item.name] = totals.get(item.name, 0.0) + item.duration_ms
+        counts[item.name] += 1
+    entries = [f"total;dur={trace.root.duration_ms:.1f}"]
+    for name, total in sorted(totals.items(), key=lambda kv: -kv[1])[:limit]:
+        entry = f"{name};dur={total:.1f}"
+        if counts[name] > 1:
+            entry += f';desc="x{counts[name]}"'
+        entries.append(entry)
+    return ", ".join(entries)
+
+# ============================================================================
+# SAMPLING PROFILER
+# ============================================================================
+
+class SamplingProfiler:
+    """Lấy mẫu stack của thread chạy event loop mỗi interval (chạy trên thread riêng).
+
+    Event loop chạy chung mọi request nên mẫu có thể gồm cả stack của request
+    khác đang chạy xen kẽ; dùng để tìm hot path, không để đo chính xác từng request.
+    """
+
+    def __init__(self, target_thread_id: int, interval: float):
+        self.target_thread_id = target_thread_id
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.target_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        """Định dạng "collapsed stack" dùng được với flamegraph.pl / speedscope"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+# ============================================================================
+# ROUTE CLASS (đo parse, endpoint và serialize)
+# ============================================================================
+
+class TracedRoute(APIRoute):
+    """APIRoute tách thời gian parse request, chạy endpoint và serialize response (Pydantic)"""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if asyncio.iscoroutinefunction(endpoint):
+            original = endpoint
+
+            @functools.wraps(original)
+            async def endpoint(*args, **kw):
+                with span("endpoint"):
+                    return await original(*args, **kw)
+
+        super().__init__(path, endpoint, **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def traced_handler(request):
+            parent = _current_span.get()
+            started = time.perf_counter()
+            response = await handler(request)
+            if parent is not None and not parent.trace.closed:
+                endpoint_spans = [s for s in parent.children if s.name == "endpoint" and s.end is not None]
+                if endpoint_spans:
+                    endpoint_span = endpoint_spans[-1]
+                    # Trước endpoint: đọc body, parse multipart/JSON, validate tham số
+                    # Sau endpoint: validate + serialize response_model
+                    parse = Span("parse", parent.trace)
+                    parse.start, parse.end = started, endpoint_span.start
+                    serialize = Span("serialize", parent.trace)
+                    serialize.start, serialize.end = endpoint_span.end, time.perf_counter()
+                    parent.children.extend((parse, serialize))
+            return response
+
+        return traced_handler
+
+# ============================================================================
+# ASGI MIDDLEWARE
+# ============================================================================
+
+class TracingMiddleware:
+    """Tạo trace cho mỗi request, thêm header X-Trace-Id và Server-Timing.
+
+    - Trace lâu hơn slow_ms được ghi (cây span đầy đủ) vào slow_log dạng JSONL
+    - Header "X-Profile: 1" (khi profile_enabled) bật profiler lấy mẫu cho request đó,
+      kết quả ghi ra profile_dir/<traceId>.folded
+    """
+
+    def __init__(
+        self,
+        app,
+        slow_ms: float,
+        slow_log: Optional[str],
+        profile_enabled: bool = False,
+        profile_interval: float = 0.005,
+        profile_dir: Optional[str] = None
+    ):
+        self.app = app
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.profile_enabled = profile_enabled
+        self.profile_interval = profile_interval
+        self.profile_dir = profile_dir
+        self._write_lock = threading.Lock()
+
+    def _wants_profile(self, scope) -> bool:
+        if not self.profile_enabled:
+            return False
+        return any(name == b"x-profile" and value == b"1" for name, value in scope.get("headers", []))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        trace = Trace(scope["method"], scope["path"])
+        token = _current_span.set(trace.root)
+        status = {"code": None}
+        profiler = None
+        if self._wants_profile(scope):
+            profiler = SamplingProfiler(threading.get_ident(), self.profile_interval)
+            profiler.start()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-trace-id", trace.trace_id.encode()))
+                headers.append((b"server-timing", server_timing(trace).encode()))
+                if profiler is not None:
+                    headers.append((b"x-profile-id", trace.trace_id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            trace.root.end = time.perf_counter()
+            trace.closed = True
+            _current_span.reset(token)
+            if profiler is not None:
+                profiler.stop()
+                await asyncio.to_thread(self._write_profile, trace, profiler)
+            if self.slow_log and trace.root.duration_ms >= self.slow_ms:
+                await asyncio.to_thread(self._write_slow, trace, status["code"])
+
+    def _write_slow(self, trace: Trace, status: Optional[int]):
+        record = {
+            "traceId": trace.trace_id,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "method": trace.method,
+            "path": trace.path,
+            "status": status,
+            **trace.root.to_dict(trace.root.start),
+        }
+        try:
+            directory = os.path.dirname(self.slow_log)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            line = json.dumps(record, ensure_ascii=False) + "\n"
+            with self._write_lock, open(self.slow_log, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError as e:
+            print(f"[LOG] Tracing: không ghi được slow trace: {e}")
+
+    def _write_profile(self, trace: Trace, profiler: SamplingProfiler):
+        if not self.profile_dir:
+            return
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f"{trace.trace_id}.folded")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(profiler.folded())
+            print(f"[LOG] Tracing: profile {trace.method} {trace.path} -> {path}")
+        except OSError as e:
+            print(f"[LOG] Tracing: không ghi được profile: {e}")
@@ -1,29 +1,87 @@
-import os
-import tempfile
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
 from fastapi import UploadFile, HTTPException
-from docx import Document
+
+import ingestion
+from tracing import span
+from config import INGEST_POOL_WORKERS, INGEST_INLINE_MAX_BYTES
+
+_ingest_pool: Optional[ProcessPoolExecutor] = None
+
+def _get_ingest_pool() -> Optional[ProcessPoolExecutor]:
+    """Khởi tạo process pool khi cần lần đầu (không tốn chi phí lúc import)"""
+    global _ingest_pool
+    if _ingest_pool is None and INGEST_POOL_WORKERS > 0:
+        _ingest_pool = ProcessPoolExecutor(max_workers=INGEST_POOL_WORKERS)
+    return _ingest_pool
+
+def _reset_broken_pool(broken: ProcessPoolExecutor):
+    """Bỏ pool đã hỏng (worker chết) để lần gọi sau tạo pool mới; chỉ reset đúng pool đó một lần"""
+    global _ingest_pool
+    if _ingest_pool is broken:
+        print("[LOG] Ingest: process pool hỏng (worker bị dừng đột ngột), tạo lại pool")
+        _ingest_pool = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+def shutdown_ingest_pool():
+    global _ingest_pool
+    if _ingest_pool is not None:
+        _ingest_pool.shutdown(cancel_futures=True)
+        _ingest_pool = None
 
 def extract_text_from_docx(file_bytes: bytes) -> str:
-    """Trích xuất text từ DOCX"""
+    """Trích xuất text từ DOCX (đọc trực tiếp từ bộ nhớ, gồm cả bảng và heading)"""
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.docx') as tmp_file:
-            tmp_file.write(file_bytes)
-            tmp_path = tmp_file.name
-        
-        doc = Document(tmp_path)
-        text = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-        
-        os.unlink(tmp_path)
-        
-        return text.strip()
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Lỗi đọc DOCX: {str(e)}")
+        return ingestion.extract_text(ingestion.DOCX_MIME, file_bytes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 def extract_text_from_file(file: UploadFile, file_bytes: bytes) -> str:
     """Trích xuất text từ file dựa trên loại"""
-    if file.content_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-        return extract_text_from_docx(file_bytes)
-    elif file.content_type == "text/plain":
-        return file_bytes.decode('utf-8')
-    else:
-        raise HTTPException(status_code=400, detail="Loại file không được hỗ trợ")
\ No newline at end of file
+    try:
+        mime = ingestion.detect_mime(file.content_type, file.filename, file_bytes)
+        return ingestion.extract_text(mime, file_bytes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def extract_text_async(content_type: str, filename: str, file_bytes: bytes) -> str:
+    """Trích xuất text không chặn event loop: file lớn được parse trên process pool"""
+    try:
+        mime = ingestion.detect_mime(content_type, filename, file_bytes)
+        pool = _get_ingest_pool()
+        inline = pool is None or len(file_bytes) <= INGEST_INLINE_MAX_BYTES
+        with span("ingest.extract", mime=mime, bytes=len(file_bytes), inline=inline):
+            if inline:
+                return ingestion.extract_text(mime, file_bytes)
+            return await _extract_in_pool(pool, mime, file_bytes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def _extract_in_pool(pool: ProcessPoolExecutor, mime: str, file_bytes: bytes) -> str:
+    """Parse trên process pool; pool hỏng thì tạo lại và thử lại một lần.
+
+    Worker chết (segfault/OOM trong parser) làm hỏng cả pool và mọi file đang parse
+    trên đó: thử lại giúp các request vô can; nếu file vẫn làm hỏng pool mới
+    thì coi là file không đọc được.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, ingestion.extract_text, mime, file_bytes)
+    except BrokenProcessPool:
+        _reset_broken_pool(pool)
+    pool = _get_ingest_pool()
+    try:
+        return await loop.run_in_executor(pool, ingestion.extract_text, mime, file_bytes)
+    except BrokenProcessPool:
+        _reset_broken_pool(pool)
+        raise ValueError("Không xử lý được file (trình đọc file bị dừng đột ngột)")
+
+async def extract_text_from_file_async(file: UploadFile, file_bytes: bytes) -> str:
+    """Bản async của extract_text_from_file dùng trong các endpoint"""
+    return await extract_text_async(file.content_type, file.filename, file_bytes)
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng số token (tiếng Việt có dấu ~3 ký tự/token), không cần gọi API"""
+    return (len(text) + 2) // 3
@@ -0,0 +1,227 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from models import ClaimWorkspace, ContentSection
+from config import (
+    WORKSPACE_MAX_ENTRIES, WORKSPACE_TTL_SECONDS, WORKSPACE_SPILL_DIR,
+    WORKSPACE_SPILL_MAX_BYTES, WORKSPACE_SPILL_SWEEP_SECONDS, WORKSPACE_SHARED
+)
+
+# Chế độ dùng chung: cập nhật mtime file (lần truy cập cuối) tối đa mỗi chừng này giây
+_TOUCH_INTERVAL = 60
+
+# ============================================================================
+# WORKSPACE STORE
+# ============================================================================
+
+class WorkspaceStore:
+    """Giữ workspace của từng hồ sơ phía server, giới hạn số lượng trong RAM.
+
+    - LRU: vượt WORKSPACE_MAX_ENTRIES thì workspace ít dùng nhất bị đẩy ra
+    - Workspace bị đẩy ra được ghi xuống spill_dir (nếu có) và nạp lại khi cần
+    - Quá TTL kể từ lần truy cập cuối thì coi như hết hạn, cả trong RAM lẫn trên đĩa
+      (mtime file spill = lần truy cập cuối, không phải lúc bị đẩy ra)
+    - File spill hết hạn (không bao giờ được đọc lại) bị dọn lúc khởi động và định kỳ
+      mỗi spill_sweep_seconds; tổng dung lượng spill không vượt spill_max_bytes
+    - shared (nhiều worker process): workspace được ghi thẳng xuống spill_dir ngay khi tạo,
+      RAM chỉ là cache của từng worker; file không bị xoá khi đọc và mtime của file là
+      lần truy cập cuối trên mọi worker
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: int,
+        spill_dir: Optional[str],
+        spill_max_bytes: int = WORKSPACE_SPILL_MAX_BYTES,
+        spill_sweep_seconds: int = WORKSPACE_SPILL_SWEEP_SECONDS,
+        shared: bool = False
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.spill_dir = spill_dir or None
+        self.spill_max_bytes = spill_max_bytes
+        self.spill_sweep_seconds = spill_sweep_seconds
+        self.shared = shared and self.spill_dir is not None
+        self._items: "OrderedDict[str, Tuple[ClaimWorkspace, float]]" = OrderedDict()
+        self._last_sweep = 0.0
+        # Chế độ dùng chung: lần cuối cập nhật mtime file của từng workspace trong RAM
+        self._touched: Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _spill_path(self, workspace_id: str) -> str:
+        return os.path.join(self.spill_dir, f"{workspace_id}.json")
+
+    def _is_expired(self, last_access: float) -> bool:
+        return self.ttl_seconds > 0 and time.time() - last_access > self.ttl_seconds
+
+    async def create(
+        self,
+        customer_id: str,
+        report_content: List[ContentSection],
+        policy_content: List[ContentSection],
+        mappings: Dict[str, str]
+    ) -> ClaimWorkspace:
+        workspace = ClaimWorkspace(
+            workspaceId=f"ws-{uuid.uuid4().hex}",
+            customerId=customer_id,
+            reportContent=report_content,
+            policyContent=policy_content,
+            mappings=mappings,
+            createdAt=datetime.now().isoformat()
+        )
+        await self.put(workspace)
+        return workspace
+
+    async def put(self, workspace: ClaimWorkspace, persisted: bool = False):
+        if self.shared and not persisted:
+            # Ghi file trước khi trả workspaceId: request kế tiếp có thể tới worker khác
+            await asyncio.to_thread(self._spill, workspace)
+        self._items[workspace.workspaceId] = (workspace, time.time())
+        self._items.move_to_end(workspace.workspaceId)
+        if self.shared:
+            self._touched[workspace.workspaceId] = time.time()
+
+        evicted = False
+        while len(self._items) > self.max_entries:
+            workspace_id, (old, last_access) = next(iter(self._items.items()))
+            # Chế độ dùng chung: file đã có sẵn trên đĩa, chỉ bỏ khỏi RAM
+            if self.spill_dir and not self.shared and not self._is_expired(last_access):
+                # Ghi xong file rồi mới bỏ khỏi RAM: get() đồng thời không thấy "khoảng trống"
+                await asyncio.to_thread(self._spill, old, last_access)
+            # Trong lúc ghi, entry có thể vừa được get() (về cuối LRU) hoặc put() khác đẩy ra
+            if next(iter(self._items), None) == workspace_id and self._items[workspace_id][1] == last_access:
+                del self._items[workspace_id]
+                self._touched.pop(workspace_id, None)
+                evicted = True
+        # Chế độ dùng chung: mọi workspace đều nằm trên đĩa nên dọn định kỳ cả khi không có eviction
+        if (evicted or self.shared) and self.spill_dir and time.time() - self._last_sweep >= self.spill_sweep_seconds:
+            await self.sweep_spilled()
+
+    async def get(self, workspace_id: str) -> Optional[ClaimWorkspace]:
+        item = self._items.get(workspace_id)
+        if item is not None:
+            workspace, last_access = item
+            if not self._is_expired(last_access):
+                now = time.time()
+                self._items[workspace_id] = (workspace, now)
+                self._items.move_to_end(workspace_id)
+                if self.shared and now - self._touched.get(workspace_id, 0.0) >= _TOUCH_INTERVAL:
+                    self._touched[workspace_id] = now
+                    await asyncio.to_thread(self._touch, workspace_id)
+                return workspace
+            del self._items[workspace_id]
+            self._touched.pop(workspace_id, None)
+            if not self.shared:
+                return None
+            # Chế độ dùng chung: worker khác có thể vừa dùng workspace (mtime file mới hơn)
+
+        if not self.spill_dir:
+            return None
+        workspace = await asyncio.to_thread(self._load_spilled, workspace_id)
+        if workspace is not None:
+            await self.put(workspace, persisted=True)
+        return workspace
+
+    def _touch(self, workspace_id: str):
+        try:
+            os.utime(self._spill_path(workspace_id))
+        except OSError:
+            pass
+
+    def _spill(self, workspace: ClaimWorkspace, last_access: Optional[float] = None):
+        """Ghi workspace xuống đĩa; mtime của file = lần truy cập cuối (TTL tính như trong RAM)"""
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            tmp_path = f"{self._spill_path(workspace.workspaceId)}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(workspace.dict(), f, ensure_ascii=False)
+            if last_access is not None:
+                os.utime(tmp_path, (last_access, last_access))
+            os.replace(tmp_path, self._spill_path(workspace.workspaceId))
+        except OSError as e:
+            print(f"[LOG] Workspace: không ghi được {workspace.workspaceId} xuống đĩa: {e}")
+
+    def _load_spilled(self, workspace_id: str) -> Optional[ClaimWorkspace]:
+        # workspaceId do server sinh ra; chặn id lạ để không đọc file ngoài thư mục
+        if not workspace_id.startswith("ws-") or not workspace_id[3:].isalnum():
+            return None
+        path = self._spill_path(workspace_id)
+        try:
+            if self._is_expired(os.path.getmtime(path)):
+                os.unlink(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                workspace = ClaimWorkspace(**json.load(f))
+            if self.shared:
+                # Worker khác vẫn cần file; chỉ ghi nhận lần truy cập
+                os.utime(path)
+            else:
+                os.unlink(path)
+            return workspace
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"[LOG] Workspace: không đọc được {path}: {e}")
+            return None
+
+    async def sweep_spilled(self) -> int:
+        """Dọn thư mục spill (gọi lúc startup và định kỳ khi có spill), trả về số file đã xoá"""
+        if not self.spill_dir:
+            return 0
+        self._last_sweep = time.time()
+        removed = await asyncio.to_thread(self._sweep_spilled)
+        if removed:
+            print(f"[LOG] Workspace: dọn {removed} file spill hết hạn/vượt dung lượng")
+        return removed
+
+    def _sweep_spilled(self) -> int:
+        try:
+            names = os.listdir(self.spill_dir)
+        except FileNotFoundError:
+            return 0
+        now = time.time()
+        removed = 0
+        live = []  # (mtime, size, path) của các file còn hạn
+        for name in names:
+            path = os.path.join(self.spill_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            # .tmp sót lại sau khi process chết giữa chừng lúc ghi
+            stale_tmp = name.endswith(".tmp") and now - stat.st_mtime > self.spill_sweep_seconds
+            if stale_tmp or (name.endswith(".json") and self._is_expired(stat.st_mtime)):
+                removed += self._unlink(path)
+            elif name.endswith(".json"):
+                live.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in live)
+        if self.spill_max_bytes > 0 and total > self.spill_max_bytes:
+            for _, size, path in sorted(live):
+                if total <= self.spill_max_bytes:
+                    break
+                removed += self._unlink(path)
+                total -= size
+        return removed
+
+    @staticmethod
+    def _unlink(path: str) -> int:
+        try:
+            os.unlink(path)
+            return 1
+        except OSError:
+            return 0
+
+
+workspace_store = WorkspaceStore(
+    WORKSPACE_MAX_ENTRIES, WORKSPACE_TTL_SECONDS, WORKSPACE_SPILL_DIR, shared=WORKSPACE_SHARED
+)